@@ -0,0 +1,242 @@
+"""
+Unittests for the zoop.aio module
+"""
+import sys
+import unittest
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+
+from mock import Mock
+import zookeeper
+
+import zoop
+from zoop import exceptions, result
+
+try:
+    from zoop import aio
+except ImportError:
+    aio = None
+
+def completed(value=None, exception=None):
+    res = result.AsyncResult()
+    if exception is not None:
+        res.set_exception(exception)
+    else:
+        res.set(value)
+    return res
+
+@unittest.skipIf(aio is None, "Needs asyncio or trollius")
+class AioZooKeeperTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = aio.asyncio.new_event_loop()
+        self.zk = Mock(name='Mock ZooKeeper')
+        self.zk.known_paths = set(['/zooplocks/mylock', '/q'])
+        self.azk = aio.AioZooKeeper(self.zk, loop=self.loop)
+
+    def run_until(self, fut):
+        return self.loop.run_until_complete(fut)
+
+    def test_get(self):
+        "Bridge an AsyncResult onto the loop"
+        self.zk.aget.return_value = completed(('Data', {}))
+        self.assertEqual(('Data', {}), self.run_until(self.azk.get('/foo')))
+        self.zk.aget.assert_called_once_with('/foo', None)
+
+    def test_error(self):
+        "Errors are raised by awaiting"
+        self.zk.adelete.return_value = completed(
+            exception=exceptions.NoNodeError('!'))
+        with self.assertRaises(exceptions.NoNodeError):
+            self.run_until(self.azk.delete('/foo'))
+
+    def test_mkdirp(self):
+        "Create what we don't know about, tolerating what exists"
+        self.zk.known_paths = set(['/a'])
+        results = [completed(exception=exceptions.NodeExistsError('!')),
+                   completed('/a/b/c')]
+        self.zk.acreate.side_effect = lambda *a, **k: k['callback'](
+            results.pop(0))
+        self.assertEqual(None, self.run_until(self.azk.mkdirp('/a/b/c')))
+        self.assertEqual(['/a/b', '/a/b/c'],
+                         [c[0][0] for c in self.zk.acreate.call_args_list])
+        self.assertTrue('/a/b/c' in self.zk.known_paths)
+
+    def test_mkdirp_known(self):
+        "Nothing to make is made at once"
+        self.zk.known_paths = set(['/q'])
+        self.assertEqual(None, self.run_until(self.azk.mkdirp('/q/')))
+        self.assertEqual(None, self.run_until(self.azk.mkdirp('/')))
+        self.assertFalse(self.zk.acreate.called)
+
+    def test_mkdirp_error(self):
+        "Other errors are raised by awaiting"
+        self.zk.known_paths = set()
+        self.zk.acreate.side_effect = lambda *a, **k: k['callback'](
+            completed(exception=exceptions.LostConnectionError('!')))
+        with self.assertRaises(exceptions.LostConnectionError):
+            self.run_until(self.azk.mkdirp('/a'))
+        self.assertEqual(set(), self.zk.known_paths)
+
+    def test_lazy_paths(self):
+        "Make nothing until first use"
+        self.zk.known_paths = set()
+        self.azk.Lock('other')
+        self.azk.Queue('/other')
+        self.assertFalse(self.zk.acreate.called)
+        self.assertFalse(self.zk.mkdirp.called)
+
+    def test_lock(self):
+        "Acquire straight away when we're frist"
+        self.zk.acreate.side_effect = lambda *a, **k: k['callback'](
+            completed('/zooplocks/mylock/lock-0001'))
+        self.zk.aget_children.side_effect = lambda *a, **k: k['callback'](
+            completed(['lock-0001']))
+        lk = self.azk.Lock('mylock')
+        self.assertEqual(True, self.run_until(lk.acquire()))
+        self.assertEqual('/zooplocks/mylock/lock-0001', lk.node)
+
+        self.zk.adelete.side_effect = lambda *a, **k: k['callback'](completed())
+        self.assertEqual(True, self.run_until(lk.release()))
+        self.assertEqual('/zooplocks/mylock/lock-0001',
+                         self.zk.adelete.call_args[0][0])
+        self.assertEqual(None, lk.node)
+
+    def test_lock_cancelled_creating(self):
+        "Remove a wait node created after we gave up"
+        creates = []
+        self.zk.acreate.side_effect = lambda *a, **k: creates.append(k['callback'])
+        fut = self.azk.Lock('mylock').acquire()
+        fut.cancel()
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever() # Run the cancellation callbacks
+        self.assertFalse(self.zk.adelete.called)
+        creates[0](completed('/zooplocks/mylock/lock-0001'))
+        self.zk.adelete.assert_called_once_with('/zooplocks/mylock/lock-0001')
+        self.assertFalse(self.zk.aget_children.called)
+
+    def test_lock_failed(self):
+        "Remove our wait node when we fail after making it"
+        self.zk.acreate.side_effect = lambda *a, **k: k['callback'](
+            completed('/zooplocks/mylock/lock-0001'))
+        self.zk.aget_children.side_effect = lambda *a, **k: k['callback'](
+            completed(exception=exceptions.LostConnectionError('!')))
+        lk = self.azk.Lock('mylock')
+        with self.assertRaises(exceptions.LostConnectionError):
+            self.run_until(lk.acquire())
+        self.zk.adelete.assert_called_once_with('/zooplocks/mylock/lock-0001')
+        self.assertEqual(None, lk.node)
+
+    def test_lock_waits(self):
+        "Watch our predecessor, acquire when it goes"
+        self.zk.acreate.side_effect = lambda *a, **k: k['callback'](
+            completed('/zooplocks/mylock/lock-0002'))
+        kids = [['lock-0001', 'lock-0002'], ['lock-0002']]
+        self.zk.aget_children.side_effect = lambda *a, **k: k['callback'](
+            completed(kids.pop(0)))
+        watches = []
+        stats = [{'version': 0}, None]
+
+        def aexists(path, watch=None, callback=None):
+            watches.append(watch)
+            callback(completed(stats.pop(0)))
+
+        self.zk.aexists.side_effect = aexists
+        fut = self.azk.Lock('mylock').acquire()
+        self.assertEqual('/zooplocks/mylock/lock-0001',
+                         self.zk.aexists.call_args[0][0])
+        self.assertEqual(False, fut.done())
+        watches[0](0, zookeeper.DELETED_EVENT, 3, '/zooplocks/mylock/lock-0001')
+        self.assertEqual(True, self.run_until(fut))
+
+    def test_lock_walks_queue(self):
+        "Move up past predecessors that have gone without listing again"
+        self.zk.acreate.side_effect = lambda *a, **k: k['callback'](
+            completed('/zooplocks/mylock/lock-0003'))
+        kids = [['lock-0003', 'lock-0001', 'lock-0002'], ['lock-0003']]
+        self.zk.aget_children.side_effect = lambda *a, **k: k['callback'](
+            completed(kids.pop(0)))
+        self.zk.aexists.side_effect = lambda *a, **k: k['callback'](
+            completed(None))
+        self.assertEqual(True, self.run_until(
+            self.azk.Lock('mylock').acquire()))
+        self.assertEqual(['/zooplocks/mylock/lock-0002',
+                          '/zooplocks/mylock/lock-0001'],
+                         [c[0][0] for c in self.zk.aexists.call_args_list])
+        self.assertEqual(2, self.zk.aget_children.call_count)
+
+    def test_queue_get(self):
+        "Claim the frist item"
+        self.zk.aget_children.side_effect = lambda *a, **k: k['callback'](
+            completed(['q-2', 'q-1']))
+        self.zk.aget.return_value = completed(('Frist', {}))
+        self.zk.adelete.side_effect = lambda *a, **k: k['callback'](completed())
+        q = self.azk.Queue('/q')
+        self.assertEqual(('Frist', {}), self.run_until(q.get()))
+        self.assertEqual('/q/q-1', self.zk.aget.call_args[0][0])
+        self.assertEqual('/q/q-1', self.zk.adelete.call_args[0][0])
+
+    def test_queue_get_pipelined(self):
+        "Send the delete without waiting for the read"
+        self.zk.aget_children.side_effect = lambda *a, **k: k['callback'](
+            completed(['q-1']))
+        pending = result.AsyncResult()
+        self.zk.aget.return_value = pending
+        self.zk.adelete.side_effect = lambda *a, **k: k['callback'](completed())
+        fut = self.azk.Queue('/q').get()
+        self.assertTrue(self.zk.adelete.called)
+        pending.set(('Frist', {}))
+        self.assertEqual(('Frist', {}), self.run_until(fut))
+
+    def test_queue_put(self):
+        "Make the path first"
+        self.zk.known_paths = set()
+        self.zk.acreate.side_effect = lambda p, *a, **k: k['callback'](
+            completed(p))
+        self.assertEqual('/q/q-', self.run_until(
+            self.azk.Queue('/q').put('Item')))
+        self.assertEqual(['/q', '/q/q-'],
+                         [c[0][0] for c in self.zk.acreate.call_args_list])
+
+    def test_queue_get_raced(self):
+        "Move along when somebody else took the item"
+        self.zk.aget_children.side_effect = lambda *a, **k: k['callback'](
+            completed(['q-1', 'q-2']))
+        self.zk.aget.side_effect = lambda p: completed((p, {}))
+        deletes = [completed(exception=exceptions.NoNodeError('!')), completed()]
+        self.zk.adelete.side_effect = lambda *a, **k: k['callback'](deletes.pop(0))
+        q = self.azk.Queue('/q')
+        self.assertEqual(('/q/q-2', {}), self.run_until(q.get()))
+
+    def test_queue_iterate(self):
+        "Iteration yields bare values"
+        self.zk.aget_children.side_effect = lambda *a, **k: k['callback'](
+            completed(['q-1']))
+        self.zk.aget.return_value = completed(('Frist', {}))
+        self.zk.adelete.side_effect = lambda *a, **k: k['callback'](completed())
+        self.assertEqual('Frist', self.run_until(
+            self.azk.Queue('/q').__anext__()))
+
+    def test_queue_get_empty(self):
+        "Raise Empty"
+        self.zk.aget_children.side_effect = lambda *a, **k: k['callback'](
+            completed([]))
+        with self.assertRaises(exceptions.Empty):
+            self.run_until(self.azk.Queue('/q').get())
+
+    def test_watch(self):
+        "Feed events into the iterator"
+        w = self.azk.watch('/foo', zoop.Event.Changed)
+        self.assertEqual(w._fired, self.zk.watcher.spyon.call_args[0][1])
+        w._fired('/foo', zoop.Event.Changed)
+        self.assertEqual(('/foo', zoop.Event.Changed), self.run_until(w.__anext__()))
+        w.close()
+        self.zk.watcher.unspy.assert_called_once_with('/foo', w._fired,
+                                                      zoop.Event.Changed)
+
+    def tearDown(self):
+        self.loop.close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
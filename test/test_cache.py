@@ -0,0 +1,129 @@
+"""
+Unittests for the zoop.cache module
+"""
+import sys
+import unittest
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+
+from mock import patch, Mock
+
+from zoop import cache, enums, exceptions, watch
+
+class NodeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.zk = Mock(name='Mock ZooKeeper')
+        self.zk.get.side_effect = lambda path, *a: ('value of ' + path, {})
+        self.zk.get_children.return_value = ['a', 'b']
+        self.c = cache.NodeCache(self.zk, maxsize=3)
+
+    def test_read_through(self):
+        "Read once, then from memory"
+        self.assertEqual(('value of /foo', {}), self.c.get('/foo'))
+        self.assertEqual(('value of /foo', {}), self.c.get('/foo'))
+        self.assertEqual(1, self.zk.get.call_count)
+        self.assertEqual((1, 1), (self.c.hits, self.c.misses))
+        self.zk.watcher.spyon.assert_called_once_with(
+            '/foo', self.c._data_refreshed, enums.Event.Changed,
+            enums.Event.Deleted, payload=True)
+
+    def test_children(self):
+        "Cache listings too"
+        self.assertEqual(['a', 'b'], self.c.get_children('/foo'))
+        self.assertEqual(['a', 'b'], self.c.get_children('/foo'))
+        self.assertEqual(1, self.zk.get_children.call_count)
+
+    def test_refreshed(self):
+        "Watches refresh entries without another read"
+        self.c.get('/foo')
+        self.c.get_children('/foo')
+        self.c._data_refreshed('/foo', enums.Event.Changed, ('new', {'version': 1}))
+        self.c._children_refreshed('/foo', enums.Event.Child, ['a'])
+        self.assertEqual(('new', {'version': 1}), self.c.get('/foo'))
+        self.assertEqual(['a'], self.c.get_children('/foo'))
+        self.assertEqual(1, self.zk.get.call_count)
+        self.assertEqual(1, self.zk.get_children.call_count)
+
+    def test_deleted(self):
+        "Drop entries for Nodes that have gone"
+        self.c.get('/foo')
+        self.c.get_children('/foo')
+        self.c._data_refreshed('/foo', enums.Event.Deleted, None)
+        self.assertEqual(0, len(self.c))
+        self.assertEqual(2, self.zk.watcher.unspy.call_count)
+
+    def test_refreshed_while_loading(self):
+        "A refresh that beats our read wins"
+        def slow(path, *a):
+            self.c._data_refreshed(path, enums.Event.Changed, ('newer', {}))
+            return ('older', {})
+        self.zk.get.side_effect = slow
+        self.c.get('/foo')
+        self.assertEqual(('newer', {}), self.c.get('/foo'))
+
+    def test_missing(self):
+        "Don't cache what isn't there"
+        self.zk.get.side_effect = exceptions.NoNodeError('!')
+        with self.assertRaises(exceptions.NoNodeError):
+            self.c.get('/foo')
+        self.assertEqual(0, len(self.c))
+        self.zk.watcher.unspy.assert_called_once_with(
+            '/foo', self.c._data_refreshed, enums.Event.Changed, enums.Event.Deleted)
+
+    def test_lru(self):
+        "Evict the least recently used"
+        for path in ('/a', '/b', '/c'):
+            self.c.get(path)
+        self.c.get('/a')
+        self.c.get('/d')
+        self.assertEqual(1, self.c.evictions)
+        self.zk.watcher.unspy.assert_called_once_with(
+            '/b', self.c._data_refreshed, enums.Event.Changed, enums.Event.Deleted)
+        self.c.get('/a')
+        self.assertEqual(4, self.zk.get.call_count)
+
+    def test_watch_bypasses(self):
+        "Reads with a watch go to ZooKeeper"
+        watch = Mock(name='Mock Watch')
+        self.c.get('/foo', watch)
+        self.c.get('/foo', watch)
+        self.assertEqual(2, self.zk.get.call_count)
+        self.assertEqual(0, len(self.c))
+
+    def test_children_bypass(self):
+        "Listings with a watch go to ZooKeeper"
+        watch = Mock(name='Mock Watch')
+        self.assertEqual(['a', 'b'], self.c.get_children('/foo', watch))
+        self.zk.get_children.assert_called_once_with('/foo', watch)
+        self.assertEqual(0, len(self.c))
+
+    def test_kinds_subscribe_apart(self):
+        "Dropping one entry leaves the other listening for Deleted"
+        self.zk.watcher = watch.Watcher(1)
+        with patch.object(self.zk.watcher, '_arm'):
+            self.c.get('/n')
+            self.c.get_children('/n')
+            self.c.set('/n', 'new')
+        self.assertEqual([self.c._children_refreshed],
+                         self.zk.watcher.payload_callbacks['/n'][enums.Event.Deleted])
+        self.c._children_refreshed('/n', enums.Event.Deleted, None)
+        self.assertEqual(0, len(self.c))
+
+    def test_writes_invalidate(self):
+        "Writes through the cache invalidate what they touch"
+        self.c.get('/foo/bar')
+        self.c.get_children('/foo')
+        self.c.set('/foo/bar', 'new')
+        self.zk.set.assert_called_once_with('/foo/bar', 'new')
+        self.c.create('/foo/car', 'value')
+        self.assertEqual(0, len(self.c))
+
+    def test_passthrough(self):
+        "Everything else goes to the client"
+        self.c.exists('/foo')
+        self.zk.exists.assert_called_once_with('/foo')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
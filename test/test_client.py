@@ -2,6 +2,8 @@
 unittests for the zoop.client module
 """
 import sys
+import threading
+import time
 import unittest
 if sys.version_info < (2, 7):
     import unittest2 as unittest
@@ -10,7 +12,7 @@ from mock import patch, Mock
 import zookeeper
 
 import zoop
-from zoop import client, exceptions, logutils, queue
+from zoop import client, exceptions, logutils, queue, result
 
 logutils.set_loglevel('ERROR')
 
@@ -138,28 +140,145 @@ class ClientTestCase(unittest.TestCase):
             Pzk.get_children.assert_called_once_with(self.zk._zk, '/goo/car', None)
             self.assertEqual(Pzk.get_children.return_value, resp)
 
+    def test_mkdirp(self):
+        """ Make every node in one batch """
+        with patch.object(client, 'zookeeper') as pzk:
+            pzk.OK = zookeeper.OK
+
+            def acreate(zh, path, value, acl, flags, completion):
+                completion(zh, zookeeper.OK, path)
+
+            pzk.acreate.side_effect = acreate
+            self.zk.mkdirp('/foo/bar/baz')
+            paths = [c[0][1] for c in pzk.acreate.call_args_list]
+            self.assertEqual(['/foo', '/foo/bar', '/foo/bar/baz'], paths)
+
+    def test_mkdirp_exists(self):
+        """ Existing nodes are fine """
+        with patch.object(client.zookeeper, 'acreate') as Pcreate:
+
+            def acreate(zh, path, value, acl, flags, completion):
+                completion(zh, zookeeper.NODEEXISTS, None)
+
+            Pcreate.side_effect = acreate
+            self.zk.mkdirp('/foo/bar')
+
+    def test_mkdirp_inline(self):
+        """ Make nodes with synchronous calls from a callback """
+        with patch.object(client, 'zookeeper') as pzk:
+            pzk.NodeExistsException = zookeeper.NodeExistsException
+            pzk.create.side_effect = [zookeeper.NodeExistsException(), '/foo/bar']
+            result.completing(self.zk.mkdirp)('/foo/bar')
+            self.assertEqual(['/foo', '/foo/bar'],
+                             [c[0][1] for c in pzk.create.call_args_list])
+            self.assertFalse(pzk.acreate.called)
+            self.assertTrue('/foo/bar' in self.zk.known_paths)
+
+    def test_mkdirp_known(self):
+        """ Don't ask the server about paths we've made """
+        with patch.object(client, 'zookeeper') as pzk:
+            pzk.OK = zookeeper.OK
+            pzk.acreate.side_effect = lambda zh, path, v, a, f, completion: \
+                completion(zh, zookeeper.OK, path)
+            self.zk.mkdirp('/foo/bar')
+            self.zk.mkdirp('/foo/bar')
+            self.assertEqual(2, pzk.acreate.call_count)
+            self.zk.mkdirp('/foo/bar/baz/qux')
+            paths = [c[0][1] for c in pzk.acreate.call_args_list[2:]]
+            self.assertEqual(['/foo/bar/baz', '/foo/bar/baz/qux'], paths)
+
+    def test_forget_path(self):
+        """ Forget a path and its descendants """
+        self.zk.known_paths.update(['/foo', '/foo/bar', '/foobar'])
+        self.zk.forget_path('/foo')
+        self.assertEqual(set(['/foobar']), self.zk.known_paths)
+
+    def test_delete_forgets(self):
+        """ Deleting a path means we no longer know it exists """
+        self.zk.known_paths.add('/foo/bar')
+        with patch.object(client, 'zookeeper'):
+            self.zk.delete('/foo/bar')
+        self.assertEqual(set(), self.zk.known_paths)
+
     def test_rmrf(self):
-        """ Remove recursive """
-        rvals = ['child2', 'child']
-        def rets(*a,**kw ):
-            if rvals:
-                return [rvals.pop()]
-            else:
-                return []
+        """ Remove recursive, deepest first """
+        tree = {
+            '/foo': ['bar', 'baz'],
+            '/foo/bar': ['child'],
+            '/foo/baz': [],
+            '/foo/bar/child': []
+            }
+        progress = Mock(name='Mock Progress')
 
         with patch.object(client, 'zookeeper') as pzk:
-            pzk.get_children.side_effect = rets
-            self.zk.rm_rf('/foo/bar/baz')
-            pzk.delete.assert_any_call(self.zk._zk, '/foo/bar/baz/child/child2')
-            pzk.delete.assert_any_call(self.zk._zk, '/foo/bar/baz/child')
-            pzk.delete.assert_any_call(self.zk._zk, '/foo/bar/baz')
+            pzk.OK = zookeeper.OK
+            pzk.aget_children.side_effect = lambda zh, p, w, completion: completion(
+                zh, zookeeper.OK, tree[p])
+            pzk.adelete.side_effect = lambda zh, p, v, completion: completion(
+                zh, zookeeper.OK)
+            self.zk.rm_rf('/foo', window=2, progress=progress)
+            deleted = [c[0][1] for c in pzk.adelete.call_args_list]
+            self.assertEqual(['/foo/bar/child', '/foo/bar', '/foo/baz', '/foo'],
+                             deleted)
+            self.assertEqual([((1, 4), {}), ((3, 4), {}), ((4, 4), {})],
+                             progress.call_args_list)
+
+    def test_rmrf_vanishing(self):
+        """ Nodes deleted by somebody else are fine """
+        def akids(zh, path, watch, completion):
+            if path == '/foo':
+                return completion(zh, zookeeper.OK, ['gone'])
+            completion(zh, zookeeper.NONODE, None)
+
+        with patch.object(client, 'zookeeper') as pzk:
+            pzk.OK = zookeeper.OK
+            pzk.aget_children.side_effect = akids
+            pzk.adelete.side_effect = lambda zh, p, v, completion: completion(
+                zh, p == '/foo' and zookeeper.OK or zookeeper.NONODE)
+            self.zk.rm_rf('/foo')
+            deleted = [c[0][1] for c in pzk.adelete.call_args_list]
+            self.assertEqual(['/foo/gone', '/foo'], deleted)
+
+    def test_rmrf_written(self):
+        """ Nodes somebody creates children under are listed again """
+        tree = {'/foo': ['bar'], '/foo/bar': []}
+        def adelete(zh, path, version, completion):
+            if path == '/foo' and '/foo/late' not in tree:
+                tree['/foo'] = ['late'] # Created as we worked
+                tree['/foo/late'] = []
+                return completion(zh, zookeeper.NOTEMPTY)
+            completion(zh, zookeeper.OK)
+
+        with patch.object(client, 'zookeeper') as pzk:
+            pzk.OK = zookeeper.OK
+            pzk.aget_children.side_effect = lambda zh, p, w, completion: completion(
+                zh, zookeeper.OK, tree[p])
+            pzk.adelete.side_effect = adelete
+            self.zk.rm_rf('/foo')
+            deleted = [c[0][1] for c in pzk.adelete.call_args_list]
+            self.assertEqual(['/foo/bar', '/foo', '/foo/late', '/foo'], deleted)
 
     def test_watch(self):
         """ Register our desire to watch for events """
         cb = lambda *a,**k: True
         with patch.object(self.zk.watcher, 'spyon') as Pspy:
             self.zk.watch('/foo/bar', zoop.Event.Child, cb)
-            Pspy.assert_called_once_with('/foo/bar', zoop.Event.Child, cb)
+            Pspy.assert_called_once_with('/foo/bar', zoop.Event.Child, cb,
+                                         payload=False)
+
+    def test_watch_tree(self):
+        """ Watch a subtree """
+        cb = lambda *a,**k: True
+        with patch.object(self.zk.watcher, 'watch_tree') as Ptree:
+            self.assertEqual(Ptree.return_value, self.zk.watch_tree('/foo', cb))
+            Ptree.assert_called_once_with('/foo', cb)
+
+    def test_unwatch(self):
+        """ Unsubscribe """
+        cb = lambda *a,**k: True
+        with patch.object(self.zk.watcher, 'unspy') as Punspy:
+            self.zk.unwatch('/foo/bar', cb, zoop.Event.Child)
+            Punspy.assert_called_once_with('/foo/bar', cb, zoop.Event.Child)
 
     def test_queue_no_connection(self):
         """ Should raise an error """
@@ -172,13 +291,259 @@ class ClientTestCase(unittest.TestCase):
             q = self.zk.Queue('/myq')
             Pq.assert_called_once_with(self.zk, '/myq', prefix='q-')
 
+class TransactionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.zk = client.ZooKeeper('localhost:2181')
+        self.patcher = patch.object(client, 'zookeeper')
+        self.pzk = self.patcher.start()
+        self.pzk.OK = zookeeper.OK
+        self.pzk.NONODE = zookeeper.NONODE
+        self.pzk.BADVERSION = zookeeper.BADVERSION
+
+    def test_pipelined(self):
+        """ Send everything before waiting for anything """
+        completions = []
+        self.pzk.acreate.side_effect = lambda *a: completions.append(a[-1])
+        self.pzk.aset.side_effect = lambda *a: completions.append(a[-1])
+        txn = self.zk.transaction()
+        txn.create('/foo', 'Foo')
+        txn.set('/bar', 'Bar', 3)
+        self.assertEqual(0, len(completions))
+
+        results = []
+        t = threading.Thread(target=lambda: results.append(txn.commit()))
+        t.start()
+        while len(completions) < 2:
+            time.sleep(0.001)
+        completions[0](0, zookeeper.OK, '/foo')
+        completions[1](0, zookeeper.OK, {'version': 4})
+        t.join()
+        self.assertEqual([['/foo', {'version': 4}]], results)
+        self.assertEqual(('/bar', 'Bar', 3), self.pzk.aset.call_args[0][1:4])
+
+    def test_failures(self):
+        """ Failed operations leave their exception in the results """
+        self.pzk.adelete.side_effect = lambda zh, p, v, completion: completion(
+            zh, zookeeper.NONODE)
+        with self.zk.transaction() as txn:
+            txn.delete('/foo')
+        self.assertTrue(isinstance(txn.results[0], exceptions.NoNodeError))
+
+    def test_check(self):
+        """ Check the version of a node """
+        self.pzk.aexists.side_effect = lambda zh, p, w, completion: completion(
+            zh, zookeeper.OK, {'version': 2})
+        with self.zk.transaction() as txn:
+            txn.check('/foo', 2)
+            txn.check('/foo', 3)
+        self.assertEqual(True, txn.results[0])
+        self.assertTrue(isinstance(txn.results[1], exceptions.BadVersionError))
+
+    def test_failed_check_stops(self):
+        """ Nothing after a failed check is sent """
+        self.pzk.aexists.side_effect = lambda zh, p, w, completion: completion(
+            zh, zookeeper.OK, {'version': 2})
+        self.pzk.adelete.side_effect = lambda zh, p, v, completion: completion(
+            zh, zookeeper.OK)
+        with self.zk.transaction() as txn:
+            txn.delete('/foo')
+            txn.check('/bar', 3)
+            txn.delete('/bar')
+            txn.delete('/car')
+        self.assertEqual(None, txn.results[0])
+        self.assertTrue(isinstance(txn.results[1], exceptions.BadVersionError))
+        self.assertTrue(isinstance(txn.results[2], exceptions.SkippedError))
+        self.assertTrue(isinstance(txn.results[3], exceptions.SkippedError))
+        self.assertEqual(1, self.pzk.adelete.call_count)
+
+    def test_commit_inline(self):
+        """ Refuse to commit from a callback, sending nothing """
+        txn = self.zk.transaction()
+        txn.delete('/foo')
+        with self.assertRaises(exceptions.CompletionThreadError):
+            result.completing(txn.commit)()
+        self.assertFalse(self.pzk.adelete.called)
+
+    def test_send_raises(self):
+        """ Keep the results of what was sent before a send raised """
+        self.pzk.adelete.side_effect = lambda zh, p, v, completion: completion(
+            zh, zookeeper.OK)
+        self.pzk.aset.side_effect = ValueError("!")
+        txn = self.zk.transaction()
+        txn.delete('/foo')
+        txn.set('/bar', 'Bar')
+        txn.delete('/car')
+        with self.assertRaises(ValueError):
+            txn.commit()
+        self.assertEqual(None, txn.results[0])
+        self.assertTrue(isinstance(txn.results[1], ValueError))
+        self.assertEqual(2, len(txn.results))
+        self.assertEqual(1, self.pzk.adelete.call_count)
+
+    def test_exception_no_commit(self):
+        """ Don't commit if the block raised """
+        with self.assertRaises(ValueError):
+            with self.zk.transaction() as txn:
+                txn.delete('/foo')
+                raise ValueError("!")
+        self.assertEqual(False, self.pzk.adelete.called)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+class BulkReadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.zk = client.ZooKeeper('localhost:2181')
+        self.patcher = patch.object(client, 'zookeeper')
+        self.pzk = self.patcher.start()
+        self.pzk.OK = zookeeper.OK
+        self.pzk.NONODE = zookeeper.NONODE
+
+    def test_get_many(self):
+        """ Results in order, None for missing nodes """
+        def aget(zh, path, watch, completion):
+            if path == '/missing':
+                return completion(zh, zookeeper.NONODE, None, None)
+            completion(zh, zookeeper.OK, path.upper(), {})
+
+        self.pzk.aget.side_effect = aget
+        results = self.zk.get_many(['/foo', '/missing', '/bar'])
+        self.assertEqual([('/FOO', {}), None, ('/BAR', {})], results)
+
+    def test_exists_many(self):
+        """ Stat or None """
+        def aexists(zh, path, watch, completion):
+            if path == '/missing':
+                return completion(zh, zookeeper.NONODE, None)
+            completion(zh, zookeeper.OK, {'path': path})
+
+        self.pzk.aexists.side_effect = aexists
+        results = self.zk.exists_many(['/missing', '/foo'])
+        self.assertEqual([None, {'path': '/foo'}], results)
+
+    def test_get_children_many(self):
+        """ Children or None """
+        def akids(zh, path, watch, completion):
+            completion(zh, zookeeper.OK, [path[1:]])
+
+        self.pzk.aget_children.side_effect = akids
+        self.assertEqual([['a'], ['b']], self.zk.get_children_many(['/a', '/b']))
+
+    def test_window(self):
+        """ Don't send more than `window` requests before replies arrive """
+        completions = []
+        self.pzk.aget.side_effect = lambda zh, p, w, c: completions.append((p, c))
+        results = []
+        t = threading.Thread(
+            target=lambda: results.append(self.zk.get_many(['/a', '/b', '/c'], 2)))
+        t.start()
+        while len(completions) < 2:
+            time.sleep(0.001)
+        time.sleep(0.01)
+        self.assertEqual(2, len(completions))
+        path, completion = completions[0]
+        completion(0, zookeeper.OK, path, {})
+        while len(completions) < 3:
+            time.sleep(0.001)
+        for path, completion in completions[1:]:
+            completion(0, zookeeper.OK, path, {})
+        t.join()
+        self.assertEqual([[('/a', {}), ('/b', {}), ('/c', {})]], results)
+
+    def test_error(self):
+        """ Errors other than NoNode are raised """
+        self.pzk.aget.side_effect = lambda zh, p, w, c: c(
+            zh, zookeeper.CONNECTIONLOSS, None, None)
+        with self.assertRaises(exceptions.LostConnectionError):
+            self.zk.get_many(['/foo'])
+
+    def tearDown(self):
+        self.patcher.stop()
+
 class AsyncClientTestCase(unittest.TestCase):
     def setUp(self):
         self.zk = client.AsyncZooKeeper('localhost:2181')
 
     def test_create(self):
         """ Create a node """
-        pass
+        with patch.object(client, 'zookeeper') as Pzk:
+            Pzk.OK = zookeeper.OK
+
+            def acreate(zh, path, value, acl, flags, completion):
+                completion(zh, zookeeper.OK, path + '0001')
+
+            Pzk.acreate.side_effect = acreate
+            res = self.zk.create('/foo/bar-', 'YAY', flags=zookeeper.SEQUENCE)
+            self.assertEqual('/foo/bar-0001', res.get())
+            args = Pzk.acreate.call_args[0]
+            self.assertEqual(('/foo/bar-', 'YAY', [client.OPEN_ACL_UNSAFE],
+                              zookeeper.SEQUENCE), args[1:5])
+
+    def test_create_exists(self):
+        """ The AsyncResult raises if it exists """
+        with patch.object(client.zookeeper, 'acreate') as Pcreate:
+
+            def acreate(zh, path, value, acl, flags, completion):
+                completion(zh, zookeeper.NODEEXISTS, None)
+
+            Pcreate.side_effect = acreate
+            res = self.zk.create('/exists')
+            with self.assertRaises(exceptions.NodeExistsError):
+                res.get()
+
+    def test_pending(self):
+        """ Return before the server replies """
+        with patch.object(client.zookeeper, 'aget') as Pget:
+            res = self.zk.get('/foo/bar')
+            self.assertEqual(False, res.ready())
+            completion = Pget.call_args[0][3]
+            completion(0, zookeeper.OK, 'Data', {'version': 1})
+            self.assertEqual(('Data', {'version': 1}), res.get())
+
+    def test_callback(self):
+        """ Call our callback with the result """
+        cb = Mock(name='Mock Callback')
+        with patch.object(client.zookeeper, 'aget_children') as Pkids:
+
+            def akids(zh, path, watch, completion):
+                completion(zh, zookeeper.OK, ['a', 'b'])
+
+            Pkids.side_effect = akids
+            res = self.zk.get_children('/foo', callback=cb)
+            cb.assert_called_once_with(res)
+            self.assertEqual(['a', 'b'], res.get())
+
+    def test_exists_no_node(self):
+        """ A missing Node is not an error for exists """
+        with patch.object(client.zookeeper, 'aexists') as Pexists:
+
+            def aexists(zh, path, watch, completion):
+                completion(zh, zookeeper.NONODE, None)
+
+            Pexists.side_effect = aexists
+            self.assertEqual(None, self.zk.exists('/nope').get())
+
+    def test_delete_no_node(self):
+        """ Raise NoNodeError from the AsyncResult """
+        with patch.object(client.zookeeper, 'adelete') as Pdel:
+
+            def adelete(zh, path, version, completion):
+                completion(zh, zookeeper.NONODE)
+
+            Pdel.side_effect = adelete
+            with self.assertRaises(exceptions.NoNodeError):
+                self.zk.delete('/foo/bar').get()
+
+    def test_set(self):
+        """ Set a value """
+        with patch.object(client.zookeeper, 'aset') as Pset:
+
+            def aset(zh, path, value, version, completion):
+                completion(zh, zookeeper.OK, {'version': 2})
+
+            Pset.side_effect = aset
+            self.assertEqual({'version': 2}, self.zk.set('/foo', 'Bar').get())
+            self.assertEqual(('/foo', 'Bar', -1), Pset.call_args[0][1:4])
 
 
 
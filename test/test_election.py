@@ -0,0 +1,195 @@
+"""
+Unittests for the zoop.election module
+"""
+import sys
+import threading
+import time
+import unittest
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+
+from mock import Mock
+import zookeeper
+
+from zoop import election, exceptions
+
+class ElectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.zk = Mock(name='Mock ZooKeeper')
+        self.el = election.Election(self.zk, 'boss', 'host-a')
+
+    def test_init(self):
+        """ Initializer """
+        self.assertEqual('/zoopelections/boss', self.el.path)
+        self.zk.mkdirp.assert_called_with('/zoopelections/boss')
+        self.assertEqual(None, self.el.arbiter)
+        self.assertEqual(False, self.el.is_leader)
+
+    def test_create_waitnode(self):
+        "Stand with an ephemeral node holding our identifier"
+        self.zk.create.return_value = '/zoopelections/boss/candidate-0001'
+        self.assertEqual(('/zoopelections/boss/candidate-0001', 'candidate-0001'),
+                         self.el._create_waitnode())
+        self.zk.create.assert_called_once_with(
+            '/zoopelections/boss/candidate-', value='host-a',
+            flags=zookeeper.SEQUENCE | zookeeper.EPHEMERAL)
+
+    def test_elect(self):
+        "Lead straight away when we're frist"
+        self.zk.create.return_value = '/zoopelections/boss/candidate-0001'
+        self.zk.get_children.return_value = ['candidate-0001']
+        self.assertEqual(True, self.el.elect())
+        self.assertEqual(True, self.el.is_leader)
+        self.zk.exists.assert_called_once_with(
+            '/zoopelections/boss/candidate-0001', self.el._watch_node)
+
+    def test_elect_watches_predecessor(self):
+        "Only wake when the candidate ahead of us goes"
+        self.zk.create.return_value = '/zoopelections/boss/candidate-0003'
+        kids = [['candidate-0001', 'candidate-0002', 'candidate-0003'],
+                ['candidate-0003']]
+        self.zk.get_children.side_effect = lambda path: kids.pop(0)
+        self.zk.exists.side_effect = [None, None, {'version': 0}]
+        self.assertEqual(True, self.el.elect())
+        self.assertEqual(['/zoopelections/boss/candidate-0002',
+                          '/zoopelections/boss/candidate-0001',
+                          '/zoopelections/boss/candidate-0003'],
+                         [c[0][0] for c in self.zk.exists.call_args_list])
+
+    def test_resign(self):
+        "Hand leadership on"
+        self.el.node = self.el.standing = '/zoopelections/boss/candidate-0001'
+        self.assertEqual(True, self.el.resign())
+        self.zk.delete.assert_called_once_with('/zoopelections/boss/candidate-0001')
+        self.assertEqual(False, self.el.is_leader)
+        self.assertEqual(True, self.el.resign())
+        self.assertEqual(1, self.zk.delete.call_count)
+
+    def test_resign_standing(self):
+        "Stop standing, and stop waiting to be elected"
+        self.zk.create.return_value = '/zoopelections/boss/candidate-0002'
+        self.zk.get_children.return_value = ['candidate-0001', 'candidate-0002']
+        self.zk.exists.return_value = {'version': 0}
+        elected = Mock(name='Elected')
+        thread = self.el.volunteer(elected)
+        while self.zk.exists.call_count == 0:
+            time.sleep(0.001) # Wait for it to watch its predecessor
+        self.assertEqual(True, self.el.resign())
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.zk.delete.assert_called_once_with('/zoopelections/boss/candidate-0002')
+        self.assertEqual(0, elected.call_count)
+        self.assertEqual(False, self.el.is_leader)
+
+    def test_run(self):
+        "Lead for as long as our function runs"
+        self.zk.create.return_value = '/zoopelections/boss/candidate-0001'
+        self.zk.get_children.return_value = ['candidate-0001']
+        func = Mock(name='Leading', return_value='Done')
+        self.assertEqual('Done', self.el.run(func, 1, two=2))
+        func.assert_called_once_with(1, two=2)
+        self.zk.delete.assert_called_once_with('/zoopelections/boss/candidate-0001')
+
+    def test_run_resigned(self):
+        "Don't run when we resign before we're elected, nor count a timeout"
+        metrics = Mock(name='Mock metrics')
+        self.el.metrics = metrics
+        self.zk.create.return_value = '/zoopelections/boss/candidate-0002'
+        self.zk.get_children.return_value = ['candidate-0001', 'candidate-0002']
+        self.zk.exists.return_value = {'version': 0}
+        func = Mock(name='Leading')
+        returned = []
+        thread = threading.Thread(target=lambda: returned.append(self.el.run(func)))
+        thread.start()
+        while self.zk.exists.call_count == 0:
+            time.sleep(0.001) # Wait for it to watch its predecessor
+        self.el.resign()
+        thread.join(5)
+        self.assertEqual([None], returned)
+        self.assertEqual(0, func.call_count)
+        self.assertFalse('timeout' in [c[0][1] for c in metrics.call_args_list])
+
+    def test_hold(self):
+        "Record how long we led"
+        metrics = Mock(name='Mock metrics')
+        self.el.metrics = metrics
+        self.zk.create.return_value = '/zoopelections/boss/candidate-0001'
+        self.zk.get_children.return_value = ['candidate-0001']
+        self.el.elect()
+        self.el.resign()
+        self.el.resign()
+        events = [c[0][1] for c in metrics.call_args_list]
+        self.assertEqual(1, events.count('hold'))
+        self.assertFalse('timeout' in events)
+
+    def test_volunteer(self):
+        "Stand in the background"
+        self.zk.create.return_value = '/zoopelections/boss/candidate-0001'
+        self.zk.get_children.return_value = ['candidate-0001']
+        elected = Mock(name='Elected')
+        self.el.volunteer(elected).join()
+        elected.assert_called_once_with()
+
+    def test_lost(self):
+        "Tell our callback when our node goes without our resigning"
+        lost = Mock(name='Lost')
+        self.el.lost = lost
+        self.el.node = '/zoopelections/boss/candidate-0001'
+        self.el._watch_node(0, zookeeper.CHANGED_EVENT, 3, self.el.node)
+        self.zk.exists.assert_called_once_with(self.el.node, self.el._watch_node)
+        self.assertEqual(0, lost.call_count)
+
+        self.el._watch_node(0, zookeeper.DELETED_EVENT, 3, self.el.node)
+        lost.assert_called_once_with()
+        self.assertEqual(False, self.el.is_leader)
+
+    def test_expired(self):
+        "Losing our session loses us the lead"
+        lost = Mock(name='Lost')
+        self.el.lost = lost
+        self.el.node = '/zoopelections/boss/candidate-0001'
+        self.el._watch_node(0, zookeeper.SESSION_EVENT, 3, '')
+        self.assertEqual(0, lost.call_count)
+        self.el._watch_node(0, zookeeper.SESSION_EVENT,
+                            zookeeper.EXPIRED_SESSION_STATE, '')
+        lost.assert_called_once_with()
+
+    def test_resigned_not_lost(self):
+        "Resigning isn't losing"
+        lost = Mock(name='Lost')
+        self.el.lost = lost
+        self.el.node = self.el.standing = '/zoopelections/boss/candidate-0001'
+        self.el.resign()
+        self.el._watch_node(0, zookeeper.DELETED_EVENT, 3,
+                            '/zoopelections/boss/candidate-0001')
+        self.assertEqual(0, lost.call_count)
+
+    def test_leader(self):
+        "Ask once, then remember until the leader's node changes"
+        self.zk.get_children.return_value = ['candidate-0002', 'candidate-0001']
+        self.zk.get.return_value = ('host-b', {})
+        self.assertEqual('host-b', self.el.leader())
+        self.assertEqual('host-b', self.el.leader())
+        self.zk.get.assert_called_once_with('/zoopelections/boss/candidate-0001',
+                                            self.el._forget_leader)
+        self.el._forget_leader(0, zookeeper.DELETED_EVENT, 3,
+                               '/zoopelections/boss/candidate-0001')
+        self.zk.get_children.return_value = ['candidate-0002']
+        self.zk.get.return_value = ('host-c', {})
+        self.assertEqual('host-c', self.el.leader())
+
+    def test_leader_gone(self):
+        "Move on if the leader goes as we look"
+        kids = [['candidate-0001', 'candidate-0002'], ['candidate-0002']]
+        self.zk.get_children.side_effect = lambda path: kids.pop(0)
+        self.zk.get.side_effect = [exceptions.NoNodeError('!'), ('host-c', {})]
+        self.assertEqual('host-c', self.el.leader())
+
+    def test_no_leader(self):
+        "Nobody is standing"
+        self.zk.get_children.return_value = []
+        self.assertEqual(None, self.el.leader())
+
+
+if __name__ == '__main__':
+    unittest.main()
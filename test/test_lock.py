@@ -2,14 +2,15 @@
 unittests for the zoop.lock module
 """
 import sys
+import threading
 import unittest
 if sys.version_info < (2, 7):
     import unittest2 as unittest
 
-from mock import patch, Mock
+from mock import patch, ANY, Mock
 import zookeeper
 
-from zoop import lock
+from zoop import exceptions, lock
 
 class BaseLockTestCase(unittest.TestCase):
     def setUp(self):
@@ -18,14 +19,9 @@ class BaseLockTestCase(unittest.TestCase):
 
     def test_init(self):
         """ Initializer """
-        self.zk.exists.return_value = False
-
         lk = lock.BaseLock(self.zk, 'foolock', root='/lockz')
         self.assertEqual('/lockz/foolock', lk.path)
-        self.zk.exists.assert_any_call('/lockz/foolock')
-        self.zk.exists.assert_any_call('/lockz')
-        self.zk.create.assert_any_call('/lockz/foolock')
-        self.zk.create.assert_any_call('/lockz')
+        self.zk.mkdirp.assert_called_with('/lockz/foolock')
 
     def test_contextmanager(self):
         "Can we use it as a contextmanager?"
@@ -52,6 +48,86 @@ class BaseLockTestCase(unittest.TestCase):
         self.zk.get_children.return_value = ['lock-00000001']
         self.assertEqual(True, self.lk.acquire())
 
+    def test_acquire_predecessor(self):
+        "Only watch the node directly ahead of us"
+        self.zk.get.return_value = 'got'
+        self.zk.create.return_value = '/zooplocks/barlock/baselock-0003'
+        kids = [['baselock-0003', 'baselock-0001', 'baselock-0002'],
+                ['baselock-0003']]
+        self.zk.get_children.side_effect = lambda path: kids.pop(0)
+        self.zk.exists.return_value = None
+        self.assertEqual(True, self.lk.acquire())
+        self.assertEqual(['/zooplocks/barlock/baselock-0002',
+                          '/zooplocks/barlock/baselock-0001'],
+                         [c[0][0] for c in self.zk.exists.call_args_list])
+        self.assertEqual(2, self.zk.get_children.call_count)
+
+    def test_acquire_waits(self):
+        "Wait on our watch without asking ZooKeeper anything more"
+        self.zk.get.return_value = 'got'
+        self.zk.create.return_value = '/zooplocks/barlock/baselock-0002'
+        kids = [['baselock-0001', 'baselock-0002'], ['baselock-0002']]
+        self.zk.get_children.side_effect = lambda path: kids.pop(0)
+        self.zk.exists.side_effect = [{'version': 0}, None]
+        with patch.object(lock.threading, 'Event') as Pev:
+            self.assertEqual(True, self.lk.acquire())
+            Pev.return_value.wait.assert_called_once_with()
+        self.assertEqual(2, self.zk.exists.call_count)
+
+    def test_acquire_nonblocking(self):
+        "Give up straight away if someone has the lock"
+        self.zk.get.return_value = 'got'
+        self.zk.create.return_value = '/zooplocks/barlock/baselock-0002'
+        self.zk.get_children.return_value = ['baselock-0001', 'baselock-0002']
+        self.zk.exists.return_value = {'version': 0}
+        with patch.object(lock.threading, 'Event') as Pev:
+            Pev.return_value.is_set.return_value = False
+            self.assertEqual(False, self.lk.acquire(blocking=False))
+            self.assertEqual(0, Pev.return_value.wait.call_count)
+        self.zk.delete.assert_called_once_with('/zooplocks/barlock/baselock-0002')
+
+    def test_acquire_timeout(self):
+        "Give up when our watch doesn't fire in time"
+        self.zk.get.return_value = 'got'
+        self.zk.create.return_value = '/zooplocks/barlock/baselock-0002'
+        self.zk.get_children.return_value = ['baselock-0001', 'baselock-0002']
+        self.zk.exists.return_value = {'version': 0}
+        with patch.object(lock.threading, 'Event') as Pev:
+            Pev.return_value.is_set.return_value = False
+            self.assertEqual(False, self.lk.acquire(timeout=5))
+            self.assertTrue(0 < Pev.return_value.wait.call_args[0][0] <= 5)
+        self.assertEqual(1, self.zk.exists.call_count)
+        self.zk.delete.assert_called_once_with('/zooplocks/barlock/baselock-0002')
+
+    def test_acquire_local_turns(self):
+        "Local threads wait their turn before queueing in ZooKeeper"
+        self.zk.get.return_value = 'got'
+        self.zk.create.return_value = '/zooplocks/barlock/baselock-0001'
+        self.zk.get_children.return_value = ['baselock-0001']
+        self.assertEqual(True, self.lk.acquire())
+        other = lock.BaseLock(self.zk, 'barlock')
+        results = []
+
+        def contend():
+            results.append(other.acquire(blocking=False))
+            results.append(other.acquire(timeout=0.01))
+
+        thread = threading.Thread(target=contend)
+        thread.start()
+        thread.join()
+        self.assertEqual([False, False], results)
+        self.assertEqual(1, self.zk.create.call_count)
+
+        self.lk.release()
+        self.assertEqual(True, other.acquire(blocking=False))
+        self.assertEqual(2, self.zk.create.call_count)
+
+    def test_arbiter_per_session(self):
+        "Separate sessions don't share turns"
+        other = lock.BaseLock(Mock(name='Other ZooKeeper'), 'barlock')
+        self.assertTrue(self.lk.arbiter is lock.BaseLock(self.zk, 'barlock').arbiter)
+        self.assertFalse(self.lk.arbiter is other.arbiter)
+
     def test_create_waitnode(self):
         "Create a wait node."
         self.zk.create.return_value = '/zooplocks/barlock/baselock-00000001'
@@ -68,16 +144,309 @@ class BaseLockTestCase(unittest.TestCase):
         """ Do we have the lock """
         cases = [
             ((True, None), ('baselock-0001', ['baselock-0001', 'baselock-0002'])),
-            ((False, ['baselock-0001']), ('baselock-0002', ['baselock-0001', 'baselock-0002']))
+            ((False, ['baselock-0001']), ('baselock-0002', ['baselock-0001', 'baselock-0002'])),
+            ((False, ['lock-0001', 'lock-0002']), ('lock-0003', ['lock-0003', 'lock-0002', 'lock-0001']))
             ]
         for expected, arg in cases:
             actual = self.lk.has_lock(*arg)
             self.assertEqual(expected, actual)
 
+    def test_has_lock_unsorted(self):
+        """ Only nodes ahead of ours are sorted, and the listing is left be """
+        listing = ['lock-0004', 'lock-0001', 'lock-0003', 'lock-0002']
+        self.assertEqual((True, None), self.lk.has_lock('lock-0001', listing))
+        self.assertEqual((False, ['lock-0001', 'lock-0002']),
+                         self.lk.has_lock('lock-0003', listing))
+        self.assertEqual(['lock-0004', 'lock-0001', 'lock-0003', 'lock-0002'],
+                         listing)
+
     def test_release(self):
         "Can we release the lock?"
         self.assertEqual(True, self.lk.release())
 
+    def test_release_turn(self):
+        "Releasing hands our turn to the next local thread"
+        self.lk.tlocal.lock_node = '/zooplocks/barlock/baselock-0001'
+        self.lk.arbiter.acquire()
+        self.assertEqual(True, self.lk.release())
+        self.zk.delete.assert_called_once_with('/zooplocks/barlock/baselock-0001')
+        self.assertEqual(False, self.lk.arbiter.held)
+
+class LockStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.zk = Mock(name='Mock ZooKeeper')
+        self.zk.get.return_value = 'got'
+        self.stats = lock.LockStats()
+        self.lk = lock.Lock(self.zk, 'statlock', metrics=self.stats)
+
+    def test_acquire_release(self):
+        "Record how long we waited and held, and how deep the queue was"
+        self.zk.create.return_value = '/zooplocks/statlock/lock-0002'
+        kids = [['lock-0001', 'lock-0002'], ['lock-0002']]
+        self.zk.get_children.side_effect = lambda path: kids.pop(0)
+        self.zk.exists.side_effect = [{'version': 0}, None]
+        with patch.object(lock.threading, 'Event'):
+            self.assertEqual(True, self.lk.acquire())
+        self.lk.release()
+        stats = self.stats.stats['/zooplocks/statlock']
+        self.assertEqual(['acquire', 'depth', 'hold', 'wakeups'], sorted(stats))
+        self.assertEqual(1, stats['depth']['sum'])
+        self.assertEqual(1, stats['wakeups']['count'])
+        self.assertEqual(1, stats['hold']['count'])
+
+    def test_timeout(self):
+        "Count acquires that give up"
+        self.zk.create.return_value = '/zooplocks/statlock/lock-0002'
+        self.zk.get_children.return_value = ['lock-0001', 'lock-0002']
+        self.zk.exists.return_value = {'version': 0}
+        self.assertEqual(False, self.lk.acquire(blocking=False))
+        self.assertEqual({'count': 1, 'sum': 1, 'max': 1},
+                         self.stats.stats['/zooplocks/statlock']['timeout'])
+
+    def test_recreate(self):
+        "Count wait nodes we had to create again"
+        self.zk.create.side_effect = ['/zooplocks/statlock/lock-0001',
+                                      '/zooplocks/statlock/lock-0002']
+        kids = [[], ['lock-0002']]
+        self.zk.get_children.side_effect = lambda path: kids.pop(0)
+        self.assertEqual(True, self.lk.acquire())
+        self.assertEqual(1, self.stats.stats['/zooplocks/statlock']['recreate']['count'])
+
+    def test_callback(self):
+        "Any callable will do as a sink"
+        sink = Mock(name='Sink')
+        lk = lock.Lock(self.zk, 'cblock', metrics=sink)
+        self.zk.create.return_value = '/zooplocks/cblock/lock-0001'
+        self.zk.get_children.return_value = ['lock-0001']
+        lk.acquire()
+        sink.assert_any_call(lk, 'depth', 0)
+        self.assertEqual('acquire', sink.call_args[0][1])
+
+    def test_prometheus(self):
+        "Render totals for a scrape"
+        self.stats(self.lk, 'acquire', 0.5)
+        self.stats(self.lk, 'acquire', 1.5)
+        self.stats(self.lk, 'timeout', 1)
+        text = self.stats.prometheus()
+        self.assertIn('# TYPE zoop_lock_acquire_seconds summary\n', text)
+        self.assertIn('zoop_lock_acquire_seconds_sum{lock="/zooplocks/statlock"} 2.0\n', text)
+        self.assertIn('zoop_lock_acquire_seconds_count{lock="/zooplocks/statlock"} 2\n', text)
+        self.assertIn('zoop_lock_timeouts_total{lock="/zooplocks/statlock"} 1\n', text)
+
+class ReadWriteLockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.zk = Mock(name='Mock ZooKeeper')
+        self.rw = lock.ReadWriteLock(self.zk, 'rwlock')
+
+    def test_init(self):
+        """ Both halves share one Node """
+        self.assertEqual('/zooplocks/rwlock', self.rw.path)
+        self.assertEqual(self.rw.path, self.rw.read.path)
+        self.assertEqual(self.rw.path, self.rw.write.path)
+
+    def test_read_has_lock(self):
+        """ Readers only wait on earlier writers """
+        cases = [
+            ((True, None), ('read-0002', ['read-0001', 'read-0002'])),
+            ((True, None), ('read-0002', ['write-0003', 'read-0002', 'read-0001'])),
+            ((False, ['write-0002']), ('read-0003', ['read-0001', 'write-0002', 'read-0003'])),
+            ((False, ['write-0001', 'write-0003']),
+             ('read-0004', ['read-0004', 'write-0003', 'read-0002', 'write-0001']))
+            ]
+        for expected, arg in cases:
+            self.assertEqual(expected, self.rw.read.has_lock(*arg))
+
+    def test_write_has_lock(self):
+        """ Writers wait on everybody """
+        cases = [
+            ((True, None), ('write-0001', ['write-0001', 'read-0002'])),
+            ((False, ['read-0001']), ('write-0002', ['write-0002', 'read-0001']))
+            ]
+        for expected, arg in cases:
+            self.assertEqual(expected, self.rw.write.has_lock(*arg))
+
+    def test_readers_share_turns(self):
+        """ Only writers take turns locally """
+        self.assertEqual(None, self.rw.read.arbiter)
+        self.assertNotEqual(None, self.rw.write.arbiter)
+
+    def test_read_create_waitnode(self):
+        """ Readers queue with a read- node """
+        self.zk.create.return_value = '/zooplocks/rwlock/read-00000001'
+        self.zk.get.return_value = 'got'
+        self.rw.read._create_waitnode()
+        self.zk.create.assert_called_once_with('/zooplocks/rwlock/read-',
+                                               value='0',
+                                               flags=zookeeper.SEQUENCE)
+
+class SemaphoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.zk = Mock(name='Mock ZooKeeper')
+        self.zk.get.return_value = 'got'
+        self.sem = lock.Semaphore(self.zk, 'sem', 3)
+
+    def test_create_waitnode(self):
+        """ Wait nodes say how many leases they want """
+        self.zk.create.return_value = '/zooplocks/sem/lease-2-00000001'
+        self.sem.tlocal.leases = 2
+        self.sem._create_waitnode()
+        self.zk.create.assert_called_once_with('/zooplocks/sem/lease-2-',
+                                               value='0',
+                                               flags=zookeeper.SEQUENCE)
+
+    def test_has_lock(self):
+        """ Do our leases fit alongside everyone ahead of us? """
+        cases = [
+            ((True, None), ('lease-1-0003', ['lease-1-0001', 'lease-1-0002', 'lease-1-0003'])),
+            ((False, ['lease-1-0001', 'lease-2-0002']),
+             ('lease-1-0003', ['lease-1-0003', 'lease-2-0002', 'lease-1-0001'])),
+            ((True, None), ('lease-3-0001', ['lease-3-0001', 'lease-1-0002'])),
+            ((False, ['lease-1-0001']), ('lease-3-0002', ['lease-1-0001', 'lease-3-0002']))
+            ]
+        for expected, arg in cases:
+            self.assertEqual(expected, self.sem.has_lock(*arg))
+
+    def test_acquire(self):
+        "Take several leases at once"
+        self.zk.create.return_value = '/zooplocks/sem/lease-2-0002'
+        self.zk.get_children.return_value = ['lease-1-0001', 'lease-2-0002']
+        self.assertEqual(True, self.sem.acquire(leases=2))
+        self.assertEqual('/zooplocks/sem/lease-2-', self.zk.create.call_args[0][0])
+
+    def test_acquire_waits(self):
+        "Stop waiting once enough leases ahead have gone"
+        self.zk.create.return_value = '/zooplocks/sem/lease-2-0003'
+        kids = [['lease-2-0001', 'lease-1-0002', 'lease-2-0003'],
+                ['lease-1-0002', 'lease-2-0003'],
+                ['lease-1-0002', 'lease-2-0003']]
+        self.zk.get_children.side_effect = lambda path, watch=None: kids.pop(0)
+        self.assertEqual(True, self.sem.acquire(leases=2))
+        self.assertEqual(0, self.zk.exists.call_count)
+
+    def test_too_many_leases(self):
+        "We can't ask for more leases than there are"
+        with self.assertRaises(ValueError):
+            self.sem.acquire(leases=4)
+        self.assertEqual(0, self.zk.create.call_count)
+
+class MultiLockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.zk = Mock(name='Mock ZooKeeper')
+        self.zk.get.return_value = 'got'
+        self.txn = self.zk.transaction.return_value
+        self.ml = lock.MultiLock(self.zk, ['b', 'a', 'b'])
+
+    def test_init(self):
+        """ Canonical order, no duplicates """
+        self.assertEqual(['/zooplocks/a', '/zooplocks/b'],
+                         [lk.path for lk in self.ml.locks])
+
+    def test_acquire(self):
+        "Queue for every Lock in one batch, list them in another"
+        self.txn.commit.side_effect = [
+            ['/zooplocks/a/lock-0001', '/zooplocks/b/lock-0001'], []]
+        self.zk.get_children_many.return_value = [['lock-0001'], ['lock-0001']]
+        self.assertEqual(True, self.ml.acquire())
+        self.assertEqual([(('/zooplocks/a/lock-',), {'value': '0', 'flags': zookeeper.SEQUENCE}),
+                          (('/zooplocks/b/lock-',), {'value': '0', 'flags': zookeeper.SEQUENCE})],
+                         self.txn.create.call_args_list)
+        self.zk.get_children_many.assert_called_once_with(
+            ['/zooplocks/a', '/zooplocks/b'])
+        self.assertEqual(0, self.zk.get_children.call_count)
+
+        self.assertEqual(True, self.ml.release())
+        self.assertEqual([(('/zooplocks/a/lock-0001',), {}),
+                          (('/zooplocks/b/lock-0001',), {})],
+                         self.txn.delete.call_args_list)
+
+    def test_acquire_blocked(self):
+        "Give up our later places while we wait, then queue for them again"
+        self.txn.commit.side_effect = [
+            ['/zooplocks/a/lock-0002', '/zooplocks/b/lock-0001'], [],
+            ['/zooplocks/b/lock-0002']]
+        self.zk.get_children_many.side_effect = [
+            [['lock-0001', 'lock-0002'], ['lock-0001']], [['lock-0002']]]
+        self.zk.exists.return_value = None
+        self.zk.get_children.return_value = ['lock-0002']
+        self.assertEqual(True, self.ml.acquire())
+        self.txn.delete.assert_called_once_with('/zooplocks/b/lock-0001')
+        self.zk.exists.assert_called_once_with('/zooplocks/a/lock-0001', ANY)
+        self.assertEqual(['/zooplocks/a/lock-0002', '/zooplocks/b/lock-0002'],
+                         self.ml.tlocal.nodes)
+
+    def test_acquire_lost_place(self):
+        "Queue again when our wait node isn't listed"
+        self.txn.commit.side_effect = [
+            ['/zooplocks/a/lock-0001', '/zooplocks/b/lock-0001'], [],
+            ['/zooplocks/b/lock-0002']]
+        self.zk.get_children_many.side_effect = [
+            [[], ['lock-0001']], [['lock-0002']]]
+        self.zk.create.return_value = '/zooplocks/a/lock-0002'
+        self.zk.get_children.return_value = ['lock-0002']
+        self.assertEqual(True, self.ml.acquire())
+        self.assertEqual(1, self.zk.create.call_count)
+        self.txn.delete.assert_called_once_with('/zooplocks/b/lock-0001')
+        self.assertEqual(['/zooplocks/a/lock-0002', '/zooplocks/b/lock-0002'],
+                         self.ml.tlocal.nodes)
+
+    def test_acquire_nonblocking(self):
+        "Give back everything if we'd have to wait"
+        self.txn.commit.side_effect = [
+            ['/zooplocks/a/lock-0001', '/zooplocks/b/lock-0002'], []]
+        self.zk.get_children_many.return_value = [
+            ['lock-0001'], ['lock-0001', 'lock-0002']]
+        self.zk.exists.return_value = {'version': 0}
+        self.assertEqual(False, self.ml.acquire(blocking=False))
+        self.zk.delete.assert_called_once_with('/zooplocks/b/lock-0002')
+        self.txn.delete.assert_called_once_with('/zooplocks/a/lock-0001')
+        self.assertEqual(True, self.ml.release())
+
+    def test_wait_fails(self):
+        "Remove every wait node of ours when waiting raises"
+        self.txn.commit.side_effect = [
+            ['/zooplocks/a/lock-0002', '/zooplocks/b/lock-0001'], [], []]
+        self.zk.get_children_many.return_value = [
+            ['lock-0001', 'lock-0002'], ['lock-0001']]
+        self.zk.exists.side_effect = exceptions.LostConnectionError('!')
+        with self.assertRaises(exceptions.LostConnectionError):
+            self.ml.acquire()
+        self.assertEqual([(('/zooplocks/b/lock-0001',), {}),
+                          (('/zooplocks/a/lock-0002',), {})],
+                         self.txn.delete.call_args_list)
+
+    def test_listing_fails(self):
+        "Remove the batch we just queued when listing it raises"
+        self.txn.commit.side_effect = [
+            ['/zooplocks/a/lock-0001', '/zooplocks/b/lock-0001'], []]
+        self.zk.get_children_many.side_effect = exceptions.LostConnectionError('!')
+        with self.assertRaises(exceptions.LostConnectionError):
+            self.ml.acquire()
+        self.assertEqual([(('/zooplocks/a/lock-0001',), {}),
+                          (('/zooplocks/b/lock-0001',), {})],
+                         self.txn.delete.call_args_list)
+
+    def test_depth(self):
+        "Report how many are queued ahead of us for each Lock"
+        metrics = Mock(name='Mock metrics')
+        ml = lock.MultiLock(self.zk, ['a', 'b'], metrics=metrics)
+        self.txn.commit.side_effect = [
+            ['/zooplocks/a/lock-0001', '/zooplocks/b/lock-0003'], []]
+        self.zk.get_children_many.return_value = [
+            ['lock-0001'], ['lock-0001', 'lock-0002', 'lock-0003']]
+        self.zk.exists.return_value = {'version': 0}
+        self.assertEqual(False, ml.acquire(blocking=False))
+        depths = [(c[0][0].path, c[0][2]) for c in metrics.call_args_list
+                  if c[0][1] == 'depth']
+        self.assertEqual([('/zooplocks/a', 0), ('/zooplocks/b', 2)], depths)
+
+    def test_create_fails(self):
+        "Don't leave wait nodes behind when a create fails"
+        self.txn.commit.side_effect = [
+            ['/zooplocks/a/lock-0001', exceptions.NoNodeError('!')], []]
+        with self.assertRaises(exceptions.NoNodeError):
+            self.ml.acquire()
+        self.txn.delete.assert_called_once_with('/zooplocks/a/lock-0001')
+
 class LockTestCase(unittest.TestCase):
     def setUp(self):
         pass
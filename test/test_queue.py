@@ -7,30 +7,21 @@ import unittest
 if sys.version_info < (2, 7):
     import unittest2 as unittest
 
-from mock import Mock
+from mock import Mock, patch
 import zookeeper
 
-from zoop import exceptions, queue
+from zoop import client, enums, exceptions, queue, result, watch
 
 class QueueTestCase(unittest.TestCase):
     def setUp(self):
         self.zk = Mock(name='Mock ZooKeeper')
         self.q = queue.Queue(self.zk, '/foo/q')
 
-    def test_init_exists(self):
-        "Don't create, it exists"
+    def test_init(self):
+        "Make sure the Queue's node exists"
         zk = Mock(name='Mock ZooKeeper')
-        zk.exists.return_value = True
         queue.Queue(zk, '/bar/q')
-        zk.exists.assert_any_call('/bar/q')
-
-    def test_init_doesnt_exist(self):
-        "Don't create, it exists"
-        zk = Mock(name='Mock ZooKeeper')
-        zk.exists.return_value = False
-        queue.Queue(zk, '/bar/q')
-        zk.exists.assert_any_call('/bar/q')
-        zk.create.assert_any_call('/bar/q')
+        zk.mkdirp.assert_any_call('/bar/q')
 
     def test_empty(self):
         """ The queue is empty """
@@ -46,21 +37,44 @@ class QueueTestCase(unittest.TestCase):
         "Flush a Q"
         nodes = ['q-1', 'q-2']
         self.zk.get_children.return_value = nodes
+        self.zk.transaction.return_value = client.Transaction(self.zk)
         self.q.flush()
         self.zk.get_children.assert_called_once()
         for n in nodes:
-            self.zk.delete.assert_any_call(os.path.join('/foo/q', n))
+            self.zk.adelete.assert_any_call(os.path.join('/foo/q', n), -1)
 
     def test_get(self):
         """ Take the next element from the Queue"""
         self.zk.get_children.return_value = ['q-1', 'q-2']
-        self.zk.get.return_value = 'Q1 Data'
+        self.zk.aget.return_value.get.return_value = 'Q1 Data'
 
         self.assertEqual("Q1 Data", self.q.get())
 
         self.zk.get_children.assert_called_once_with('/foo/q')
-        self.zk.get.assert_called_once_with('/foo/q/q-1')
-        self.zk.delete.assert_called_once_with('/foo/q/q-1')
+        self.zk.aget.assert_called_once_with('/foo/q/q-1')
+        self.zk.adelete.assert_called_once_with('/foo/q/q-1')
+
+    def test_get_raced(self):
+        "Another consumer deleted the frist item, so take the next"
+        self.zk.get_children.return_value = ['q-1', 'q-2']
+        raced, claimed = result.AsyncResult(), result.AsyncResult()
+        raced.set_exception(exceptions.NoNodeError('!'))
+        claimed.set()
+        claims = [raced, claimed]
+        self.zk.adelete.side_effect = lambda p: claims.pop(0)
+        self.zk.aget.return_value.get.return_value = 'Q2 Data'
+
+        self.assertEqual('Q2 Data', self.q.get())
+        self.zk.aget.assert_called_with('/foo/q/q-2')
+
+    def test_get_all_raced(self):
+        "Every item went to somebody else"
+        self.zk.get_children.return_value = ['q-1']
+        raced = result.AsyncResult()
+        raced.set_exception(exceptions.NoNodeError('!'))
+        self.zk.adelete.return_value = raced
+        with self.assertRaises(exceptions.Empty):
+            self.q.get()
 
     def test_get_empty(self):
         "The Queue is empty, raise an Empty error"
@@ -68,11 +82,98 @@ class QueueTestCase(unittest.TestCase):
         with self.assertRaises(exceptions.Empty):
             self.q.get()
 
+    def test_get_many(self):
+        "Take a batch from one listing"
+        self.zk.get_children.return_value = ['q-3', 'q-1', 'q-2']
+        self.zk.aget.side_effect = lambda p: Mock(
+            get=Mock(return_value=p[-3:] + ' Data'))
+
+        self.assertEqual(['q-1 Data', 'q-2 Data'], self.q.get_many(2))
+        self.zk.get_children.assert_called_once_with('/foo/q')
+        self.assertEqual(['/foo/q/q-1', '/foo/q/q-2'],
+                         [c[0][0] for c in self.zk.adelete.call_args_list])
+
+    def test_get_many_windowed(self):
+        "Keep no more than window items in flight, skipping raced ones"
+        self.zk.get_children.return_value = ['q-1', 'q-2', 'q-3', 'q-4']
+        self.zk.aget.side_effect = lambda p: Mock(
+            get=Mock(return_value=p[-3:] + ' Data'))
+        raced = result.AsyncResult()
+        raced.set_exception(exceptions.NoNodeError('!'))
+        self.zk.adelete.side_effect = lambda p: raced if p.endswith('q-1') else Mock()
+
+        self.assertEqual(['q-2 Data', 'q-3 Data', 'q-4 Data'],
+                         self.q.get_many(10, window=2))
+        self.assertEqual(4, self.zk.adelete.call_count)
+
+    def test_get_many_all_raced(self):
+        "Every item went to somebody else"
+        self.zk.get_children.return_value = ['q-1', 'q-2']
+        raced = result.AsyncResult()
+        raced.set_exception(exceptions.NoNodeError('!'))
+        self.zk.adelete.return_value = raced
+        with self.assertRaises(exceptions.Empty):
+            self.q.get_many(2)
+
+    def test_get_many_none(self):
+        "Asking for no items gets no items"
+        self.zk.get_children.return_value = ['q-1']
+        self.assertEqual([], self.q.get_many(0))
+        self.assertFalse(self.zk.get_children.called)
+
+    def test_get_many_error(self):
+        "Drain the window before raising, keeping what we took"
+        self.zk.get_children.return_value = ['q-1', 'q-2', 'q-3', 'q-4']
+        self.zk.aget.side_effect = lambda p: Mock(
+            get=Mock(return_value=p[-3:] + ' Data'))
+        lost = result.AsyncResult()
+        lost.set_exception(exceptions.LostConnectionError('!'))
+        self.zk.adelete.side_effect = lambda p: lost if p.endswith('q-1') else Mock()
+
+        with self.assertRaises(exceptions.LostConnectionError) as cm:
+            self.q.get_many(10, window=2)
+        self.assertEqual(['q-2 Data'], cm.exception.items)
+        self.assertEqual(2, self.zk.adelete.call_count)
+
+    def test_get_many_empty(self):
+        "The Queue is empty, raise an Empty error"
+        self.zk.get_children.return_value = []
+        with self.assertRaises(exceptions.Empty):
+            self.q.get_many(5)
+
     def test_put(self):
         """ Put an item into the Queue """
         self.q.put('Foo')
         self.zk.create.assert_called_once_with('/foo/q/q-', value='Foo', flags=zookeeper.SEQUENCE)
 
+    def test_put_many(self):
+        "Put a batch of items, window at a time"
+        self.zk.transaction.side_effect = lambda: client.Transaction(self.zk)
+        created = []
+
+        def acreate(path, value, acl, flags):
+            res = result.AsyncResult()
+            created.append(value)
+            res.set('/foo/q/q-{0}'.format(len(created)))
+            return res
+
+        self.zk.acreate.side_effect = acreate
+        self.assertEqual(['/foo/q/q-1', '/foo/q/q-2', '/foo/q/q-3'],
+                         self.q.put_many(['A', 'B', 'C'], window=2))
+        self.assertEqual(['A', 'B', 'C'], created)
+        self.assertEqual(2, self.zk.transaction.call_count)
+        self.assertEqual(('/foo/q/q-', 'A', [client.OPEN_ACL_UNSAFE], zookeeper.SEQUENCE),
+                         self.zk.acreate.call_args_list[0][0])
+
+    def test_put_many_fails(self):
+        "Tell us if an item couldn't be added"
+        self.zk.transaction.side_effect = lambda: client.Transaction(self.zk)
+        failed = result.AsyncResult()
+        failed.set_exception(exceptions.NoNodeError('!'))
+        self.zk.acreate.return_value = failed
+        with self.assertRaises(exceptions.NoNodeError):
+            self.q.put_many(['A'])
+
     def test_qsize(self):
         "Length of the Q"
         self.zk.get_children.return_value = ['q-1']
@@ -93,11 +194,40 @@ class QueueTestCase(unittest.TestCase):
         self.q.watch(cb)
         self.assertEqual(True, self.zk.watch.called)
 
+    def test_watch_payload(self):
+        """ Use the listing the watch was re-armed with """
+        cb = Mock(name='Mock Callback')
+        self.q.watch(cb)
+        watcher = self.zk.watch.call_args[0][1]
+        self.assertEqual(True, self.zk.watch.call_args[1]['payload'])
+        self.zk.get_children.reset_mock()
+        watcher('/foo/q', enums.Event.Child, ['q-2', 'q-1'])
+        cb.assert_called_once_with(['q-1', 'q-2'])
+        self.assertFalse(self.zk.get_children.called)
+        watcher('/foo/q', enums.Event.Child, None)
+        self.assertEqual(1, cb.call_count)
+
     def test_watchitem(self):
         cb = Mock(name='Mock Callback')
         self.q.watchitem(cb)
         self.assertEqual(True, self.zk.watch.called)
 
+    def test_watchitem_inline(self):
+        "Take the item with synchronous calls on the completion thread"
+        cb = Mock(name='Mock Callback')
+        w = watch.Watcher(2)
+        self.zk.watch.side_effect = lambda path, callback, event: w.spyon(
+            path, callback, event)
+        self.q.watchitem(cb)
+        self.zk.get_children.return_value = ['q-2', 'q-1']
+        self.zk.get.return_value = ('Q1 Data', {})
+        with patch.dict(watch.Watcher._watch_funcs, {enums.Event.Child: Mock()}):
+            w.dispatch(2, enums.Event.Child, None, '/foo/q')
+        cb.assert_called_once_with('Q1 Data')
+        self.zk.delete.assert_called_once_with('/foo/q/q-1')
+        self.assertFalse(self.zk.aget.called)
+        self.assertFalse(self.zk.adelete.called)
+
     def tearDown(self):
         pass
 
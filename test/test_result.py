@@ -0,0 +1,90 @@
+"""
+Unittests for the zoop.result module
+"""
+import sys
+import unittest
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+
+from mock import Mock
+import zookeeper
+
+from zoop import exceptions, result
+
+class ErrorForTestCase(unittest.TestCase):
+    def test_known(self):
+        "Map return codes to our exceptions"
+        cases = [
+            (exceptions.NoNodeError, zookeeper.NONODE),
+            (exceptions.NodeExistsError, zookeeper.NODEEXISTS),
+            (exceptions.NotEmptyError, zookeeper.NOTEMPTY),
+            (exceptions.BadVersionError, zookeeper.BADVERSION),
+            (exceptions.LostConnectionError, zookeeper.CONNECTIONLOSS)
+            ]
+        for errcls, rc in cases:
+            self.assertTrue(isinstance(result.error_for(rc, '/foo'), errcls))
+
+    def test_unknown(self):
+        "Fall back to the base Error"
+        err = result.error_for(zookeeper.APIERROR, '/foo')
+        self.assertEqual(exceptions.Error, type(err))
+
+
+class AsyncResultTestCase(unittest.TestCase):
+    def setUp(self):
+        self.res = result.AsyncResult()
+
+    def test_set(self):
+        "Complete with a value"
+        self.assertEqual(False, self.res.ready())
+        self.res.set('Frist')
+        self.assertEqual(True, self.res.successful())
+        self.assertEqual('Frist', self.res.get())
+
+    def test_set_exception(self):
+        "Complete with an error"
+        self.res.set_exception(exceptions.NoNodeError('!'))
+        self.assertEqual(False, self.res.successful())
+        with self.assertRaises(exceptions.NoNodeError):
+            self.res.get()
+
+    def test_first_wins(self):
+        "Ignore later outcomes"
+        self.res.set('Frist')
+        self.res.set('Next')
+        self.assertEqual('Frist', self.res.get())
+
+    def test_timeout(self):
+        "Raise if we don't complete in time"
+        with self.assertRaises(exceptions.Timeout):
+            self.res.get(timeout=0.01)
+
+    def test_completion_thread(self):
+        "Refuse to wait where the reply would be delivered"
+        self.assertFalse(result.on_completion_thread())
+        seen = []
+        result.completing(lambda: seen.append(result.on_completion_thread()))()
+        self.assertEqual([True], seen)
+        self.assertFalse(result.on_completion_thread())
+        with self.assertRaises(exceptions.CompletionThreadError):
+            result.completing(self.res.get)()
+        with self.assertRaises(exceptions.CompletionThreadError):
+            result.completing(self.res.wait)(0.01)
+        self.res.set('Frist')
+        self.assertEqual('Frist', result.completing(self.res.get)())
+
+    def test_rawlink(self):
+        "Callbacks run on completion, or immediately if complete"
+        cb = Mock(name='Mock Callback')
+        self.res.rawlink(cb)
+        self.assertEqual(False, cb.called)
+        self.res.set('Frist')
+        cb.assert_called_once_with(self.res)
+        late = Mock(name='Mock Late Callback')
+        self.res.rawlink(late)
+        late.assert_called_once_with(self.res)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,13 @@
 """
 Unittests for the zoop.tree module
 """
+from StringIO import StringIO
 import sys
 import unittest
 if sys.version_info < (2, 7):
     import unittest2 as unittest
 
-from mock import patch
+from mock import patch, Mock
 
 from zoop import tree
 
@@ -29,6 +30,69 @@ NESTED_TREE = """/
  |   |-- car
  |-- goo"""
 
+def mock_zk(namespace):
+    """
+    A Mock ZooKeeper serving listings and stats from `namespace`,
+    a dict of path: (children, cversion, version)
+    """
+    zk = Mock(name='Mock ZooKeeper')
+
+    def listing(paths, window):
+        return [namespace[p][0] if p in namespace else None for p in paths]
+
+    def stats(paths, window):
+        return [dict(cversion=namespace[p][1], pzxid=namespace[p][1],
+                     version=namespace[p][2]) if p in namespace else None
+                for p in paths]
+
+    zk.get_children_many.side_effect = listing
+    zk.exists_many.side_effect = stats
+    return zk
+
+def namespace():
+    return {
+        '/': (['foo', 'goo'], 1, 0),
+        '/foo': (['bar', 'car'], 1, 0),
+        '/foo/bar': ([], 0, 0),
+        '/foo/car': ([], 0, 0),
+        '/goo': ([], 0, 0)
+        }
+
+def footprint(obj, seen=None):
+    """
+    The bytes held by `obj` and the containers and strings below it.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += footprint(k, seen) + footprint(v, seen)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += footprint(item, seen)
+    elif hasattr(obj, '__dict__'):
+        size += footprint(obj.__dict__, seen)
+    return size
+
+def wide_zk():
+    """
+    A Mock ZooKeeper with 20 * 50 Nodes below /, whose listings
+    are fresh strings every time, as they would be off the wire.
+    """
+    zk = Mock(name='Mock ZooKeeper')
+
+    def listing(paths, window):
+        return [['n-{0}-{1:04d}'.format(p.count('/') if p != '/' else 0, i)
+                 for i in range(20 if p == '/' else 50)]
+                if p.count('/') < 2 else [] for p in paths]
+
+    zk.get_children_many.side_effect = listing
+    return zk
+
 class TreeTestCase(unittest.TestCase):
     def setUp(self):
         self.t = tree.Tree()
@@ -45,6 +109,159 @@ class TreeTestCase(unittest.TestCase):
         self.t.add_nodes('/foo/bar', ['goo', 'car'])
         self.assertEqual(expected, self.t.nodes)
 
+    def test_add_nodes_keeps_children(self):
+        """ Don't clobber nodes we've already listed """
+        self.t.add_nodes('/foo/bar', ['goo'])
+        self.t.add_nodes('/foo', ['bar', 'car'])
+        self.assertEqual({'foo': {'bar': {'goo': None}, 'car': None}},
+                         self.t.nodes)
+
+    def test_from_zk(self):
+        """ Crawl the namespace a level at a time """
+        zk = Mock(name='Mock ZooKeeper')
+        listings = {
+            '/': ['foo', 'goo'],
+            '/foo': ['bar', 'car'],
+            '/goo': [],
+            '/foo/bar': [],
+            '/foo/car': None
+            }
+        zk.get_children_many.side_effect = lambda paths, window: [
+            listings[p] for p in paths]
+
+        t = tree.Tree.from_zk(zk)
+        self.assertEqual(SIMPLE_TREE, t.tree())
+        self.assertEqual(3, zk.get_children_many.call_count)
+        self.assertEqual(['/foo', '/goo'], zk.get_children_many.call_args_list[1][0][0])
+
+    def test_from_zk_level(self):
+        """ Only descend `level` levels """
+        zk = Mock(name='Mock ZooKeeper')
+        zk.get_children_many.side_effect = lambda paths, window: [
+            ['foo'] for p in paths]
+        t = tree.Tree.from_zk(zk, root='/', level=2)
+        self.assertEqual({'foo': {'foo': None}}, t.nodes)
+        self.assertEqual(2, zk.get_children_many.call_count)
+
+    def test_from_zk_filters(self):
+        """ Prune before descending """
+        zk = Mock(name='Mock ZooKeeper')
+        listings = {
+            '/': ['foo', 'goo', 'fixme'],
+            '/foo': ['far']
+            }
+        zk.get_children_many.side_effect = lambda paths, window: [
+            listings.get(p, []) for p in paths]
+        t = tree.Tree.from_zk(zk, pattern='^f', exclude='me$')
+        self.assertEqual({'foo': {'far': None}}, t.nodes)
+        self.assertEqual([['/'], ['/foo'], ['/foo/far']],
+                         [c[0][0] for c in zk.get_children_many.call_args_list])
+
+    def test_stat(self):
+        "Stat fields are kept per Node"
+        self.t.set_stat('/foo/', dict(version=3, dataLength=12))
+        self.assertEqual(['foo'], self.t.children('/'))
+        self.assertEqual(3, self.t.stat('/foo')['version'])
+        self.assertFalse('dataLength' in self.t.stat('/foo'))
+        self.assertEqual(None, self.t.stat('/'))
+
+    def test_paths(self):
+        "Walk depth first in name order"
+        self.t.add_nodes('/foo/bar', ['goo'])
+        self.t.add_nodes('/', ['car'])
+        self.assertEqual(['/', '/car', '/foo', '/foo/bar', '/foo/bar/goo'],
+                         list(self.t.paths()))
+        self.assertEqual(['/foo/bar', '/foo/bar/goo'],
+                         list(self.t.paths('/foo/bar')))
+
+    def test_diff(self):
+        "Added, removed and changed paths"
+        old = tree.Tree.from_zk(mock_zk(namespace()), stats=True)
+        ns = namespace()
+        ns['/'] = (['foo', 'hoo'], 2, 0)
+        ns['/hoo'] = (['x'], 1, 0)
+        ns['/hoo/x'] = ([], 0, 0)
+        ns['/foo/car'] = ([], 0, 1)
+        del ns['/goo']
+        new = tree.Tree.from_zk(mock_zk(ns), stats=True)
+        diff = old.diff(new)
+        self.assertEqual(['/hoo', '/hoo/x'], diff.added)
+        self.assertEqual(['/goo'], diff.removed)
+        self.assertEqual(['/foo/car'], diff.changed)
+
+    def test_refresh(self):
+        "Only list what changed"
+        self.t = tree.Tree.from_zk(mock_zk(namespace()), stats=True)
+        ns = namespace()
+        ns['/foo'] = (['bar', 'dar'], 2, 0)
+        ns['/foo/dar'] = (['x'], 1, 0)
+        ns['/foo/dar/x'] = ([], 0, 0)
+        ns['/goo'] = ([], 0, 4)
+        del ns['/foo/car']
+        zk = mock_zk(ns)
+        diff = self.t.refresh(zk)
+        self.assertEqual(['/foo/dar', '/foo/dar/x'], diff.added)
+        self.assertEqual(['/foo/car'], diff.removed)
+        self.assertEqual(['/goo'], diff.changed)
+        self.assertEqual(tree.Tree.from_zk(mock_zk(ns)).nodes, self.t.nodes)
+        self.assertEqual([['/foo'], ['/foo/dar'], ['/foo/dar/x']],
+                         [c[0][0] for c in zk.get_children_many.call_args_list])
+        self.assertEqual(4, self.t.stat('/goo')['version'])
+
+    def test_refresh_unchanged(self):
+        "Nothing to list"
+        self.t = tree.Tree.from_zk(mock_zk(namespace()), stats=True)
+        zk = mock_zk(namespace())
+        self.assertEqual(([], [], []), self.t.refresh(zk))
+        self.assertEqual([[]], [c[0][0] for c in
+                                zk.get_children_many.call_args_list])
+
+    def test_refresh_level(self):
+        "Descend no further than the level we were built to"
+        def deep():
+            return {
+                '/': (['a'], 1, 0),
+                '/a': (['b'], 1, 0),
+                '/a/b': (['c'], 1, 0),
+                '/a/b/c': (['d'], 1, 0),
+                '/a/b/c/d': ([], 0, 0)
+                }
+        for cls in (tree.Tree, tree.CompactTree):
+            t = cls.from_zk(mock_zk(deep()), level=1, stats=True)
+            zk = mock_zk(deep())
+            self.assertEqual(([], [], []), t.refresh(zk))
+            self.assertEqual([[]], [c[0][0] for c in
+                                    zk.get_children_many.call_args_list])
+
+            ns = deep()
+            ns['/'] = (['a', 'e'], 2, 0)
+            ns['/e'] = (['f'], 1, 0)
+            ns['/e/f'] = ([], 0, 0)
+            zk = mock_zk(ns)
+            self.assertEqual((['/e'], [], []), t.refresh(zk))
+            self.assertEqual([['/']], [c[0][0] for c in
+                                       zk.get_children_many.call_args_list])
+            self.assertEqual(['a', 'e'], t.children('/'))
+
+    def test_refresh_root(self):
+        "Refresh below the root we were built from, and nothing above it"
+        for cls in (tree.Tree, tree.CompactTree):
+            ns = namespace()
+            ns['/goo'] = (['x'], 1, 0)
+            ns['/goo/x'] = ([], 0, 0)
+            t = cls.from_zk(mock_zk(ns), root='/foo', stats=True)
+            zk = mock_zk(ns)
+            self.assertEqual(([], [], []), t.refresh(zk))
+            self.assertEqual([[]], [c[0][0] for c in
+                                    zk.get_children_many.call_args_list])
+
+            ns['/foo'] = (['bar', 'car', 'new'], 2, 0)
+            ns['/foo/new'] = ([], 0, 0)
+            zk = mock_zk(ns)
+            self.assertEqual((['/foo/new'], [], []), t.refresh(zk))
+            self.assertEqual(['/foo'], zk.get_children_many.call_args_list[0][0][0])
+            self.assertEqual(['foo'], t.children('/'))
+
     def test_simple_tree(self):
         """ Stringify ourselves. """
         self.t.nodes = {
@@ -76,17 +293,139 @@ class TreeTestCase(unittest.TestCase):
             }
         self.assertEqual(NESTED_TREE, self.t.tree())
 
+    def test_iter_lines_depth(self):
+        "Stop descending at `depth`"
+        self.t.add_nodes('/foo/bar', ['goo', 'car'])
+        self.t.add_nodes('/', ['zoo'])
+        self.assertEqual(['/', ' |-- foo', ' |   |-- bar', ' |-- zoo'],
+                         list(self.t.iter_lines(depth=2)))
+
+    def test_iter_lines_max_children(self):
+        "Summarise huge fan-out"
+        self.t.add_nodes('/q', ['item-{0}'.format(i) for i in range(5)])
+        self.t.add_nodes('/q/item-0', ['x'])
+        expected = ['/q',
+                    ' |-- item-0',
+                    ' |   |-- x',
+                    ' |-- item-1',
+                    ' |-- ... 3 more']
+        self.assertEqual(expected,
+                         list(self.t.iter_lines('/q', max_children=2)))
+
+    def test_iter_lines_no_node(self):
+        "Can't render what isn't there"
+        with self.assertRaises(tree.exceptions.NoNodeError):
+            list(self.t.iter_lines('/nope'))
+
     def test_pprint(self):
         "Test our Printing"
-        with patch.object(self.t, 'tree') as Psc:
-            Psc.return_value = ''
-            self.t.pprint()
-            Psc.assert_called_once_with()
+        stream = StringIO()
+        with patch.object(self.t, 'iter_lines') as Psc:
+            Psc.return_value = iter(['/', ' |-- foo'])
+            self.t.pprint(stream, depth=3)
+            Psc.assert_called_once_with('/', depth=3, max_children=None)
+        self.assertEqual("/\n |-- foo\n", stream.getvalue())
 
     def tearDown(self):
         pass
 
 
+class CompactTreeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.t = tree.CompactTree()
+        self.t.add_nodes('/foo/bar', ['hoo', 'joo', 'koo'])
+        self.t.add_nodes('/foo/bar/hoo', ['har', 'dar', 'far', 'gar'])
+        self.t.add_nodes('/foo', ['car'])
+        self.t.add_nodes('/', ['goo'])
+
+    def test_tree(self):
+        "Renders the same as a Tree"
+        self.assertEqual(NESTED_TREE, self.t.tree())
+
+    def test_len(self):
+        "Count the Nodes"
+        self.assertEqual(11, len(self.t))
+
+    def test_interned(self):
+        "Names are only stored once"
+        self.t.add_nodes('/goo', ['bar', 'car'])
+        self.assertEqual(1, self.t.names.count('bar'))
+
+    def test_lookups(self):
+        "Find Nodes by path"
+        self.assertTrue('/foo/bar/hoo/gar' in self.t)
+        self.assertFalse('/foo/bar/zoo' in self.t)
+        self.assertEqual(['bar', 'car'], self.t.children('/foo'))
+        self.assertEqual([], self.t.children('/goo'))
+        with self.assertRaises(tree.exceptions.NoNodeError):
+            self.t.children('/nope')
+
+    def test_add_after_compact(self):
+        "Adding Nodes after a lookup recompacts"
+        self.assertEqual(['foo', 'goo'], self.t.children('/'))
+        self.t.add_nodes('/', ['aardvark'])
+        self.t.add_nodes('/foo', ['bar'])
+        self.assertEqual(['aardvark', 'foo', 'goo'], self.t.children('/'))
+        self.assertEqual(['bar', 'car'], self.t.children('/foo'))
+
+    def test_stat(self):
+        "Stat fields are kept per Node"
+        self.assertEqual(None, self.t.stat('/foo'))
+        self.t.set_stat('/foo', dict(version=3, czxid=7, dataLength=12))
+        self.t.add_nodes('/', ['aardvark'])
+        stat = self.t.stat('/foo')
+        self.assertEqual(3, stat['version'])
+        self.assertEqual(7, stat['czxid'])
+        self.assertFalse('dataLength' in stat)
+        self.assertEqual(None, self.t.stat('/aardvark'))
+
+    def test_from_zk(self):
+        "Crawl into a CompactTree"
+        zk = Mock(name='Mock ZooKeeper')
+        listings = {
+            '/': ['goo', 'foo'],
+            '/foo': ['car', 'bar'],
+            }
+        zk.get_children_many.side_effect = lambda paths, window: [
+            listings.get(p, []) for p in paths]
+        t = tree.CompactTree.from_zk(zk)
+        self.assertTrue(isinstance(t, tree.CompactTree))
+        self.assertEqual(SIMPLE_TREE, t.tree())
+
+    def test_from_zk_footprint(self):
+        "Hold less than a Tree, and no per-Node indexes"
+        with patch.object(tree.CompactTree, '_building') as building:
+            t = tree.CompactTree.from_zk(wide_zk())
+        self.assertFalse(building.called)
+        self.assertEqual(1020, len(t))
+        self.assertEqual(None, t._index)
+        self.assertEqual(None, t._name_ids)
+        self.assertEqual(70, len(t.names)) # Interned when compacted
+        self.assertTrue(footprint(t) < footprint(tree.Tree.from_zk(wide_zk())))
+
+    def test_add_after_from_zk(self):
+        "Indexes are rebuilt when we need them again"
+        t = tree.CompactTree.from_zk(wide_zk())
+        t.add_nodes('/n-0-0001', ['n-1-0000', 'new'])
+        t._remove('/n-0-0002')
+        self.assertEqual(970, len(t))
+        self.assertEqual(51, len(t.children('/n-0-0001')))
+        self.assertFalse('/n-0-0002' in t)
+
+    def test_refresh(self):
+        "Refresh a CompactTree"
+        t = tree.CompactTree.from_zk(mock_zk(namespace()), stats=True)
+        ns = namespace()
+        ns['/'] = (['foo', 'hoo'], 2, 0)
+        ns['/hoo'] = ([], 0, 0)
+        del ns['/goo']
+        diff = t.refresh(mock_zk(ns))
+        self.assertEqual((['/hoo'], ['/goo'], []), diff)
+        self.assertEqual(['foo', 'hoo'], t.children('/'))
+        self.assertEqual(['bar', 'car'], t.children('/foo'))
+        self.assertEqual(4, len(t))
+        self.assertEqual(1, t.stat('/foo')['cversion'])
+
 
 if __name__ == '__main__':
     unittest.main()
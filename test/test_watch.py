@@ -2,11 +2,14 @@
 Unittests for the zoop.watch module
 """
 import sys
+import threading
+import time
 import unittest
 if sys.version_info < (2, 7):
     import unittest2 as unittest
 
 from mock import patch, Mock
+import zookeeper
 
 import zoop
 from zoop import enums, exceptions, watch
@@ -22,6 +25,28 @@ class WatcherTestCase(unittest.TestCase):
         self.w.set_zhandle(mock_handle)
         self.assertTrue(self.w._zk is mock_handle)
 
+    def test_sethandle_rearms(self):
+        "A new session has none of our watches - arm them again"
+        aget = Mock(name='Mock aget()')
+        aget_children = Mock(name='Mock aget_children()')
+        self.w.callbacks['/foo'][enums.Event.Changed].append(self.mock_callback)
+        self.w.payload_callbacks['/bar'][enums.Event.Child].append(self.mock_callback)
+        self.w._armed.update([('/foo', 'data'), ('/bar', 'child'), ('/old', 'data')])
+        values = {enums.Event.Changed: aget, enums.Event.Child: aget_children}
+        mock_handle = Mock(name='Mock Handle')
+        with patch.dict(watch.Watcher._watch_funcs, values):
+            self.w.set_zhandle(mock_handle)
+        self.assertEqual((mock_handle, '/foo', self.w.dispatch), aget.call_args[0][:3])
+        self.assertEqual((mock_handle, '/bar', self.w.dispatch),
+                         aget_children.call_args[0][:3])
+        self.assertEqual(set([('/foo', 'data'), ('/bar', 'child')]), self.w._armed)
+
+    def test_session_expired(self):
+        "Nothing is armed once the session has gone"
+        self.w._armed.add(('/foo', 'data'))
+        self.w.dispatch(2, enums.Event.Session, zookeeper.EXPIRED_SESSION_STATE, '')
+        self.assertEqual(set(), self.w._armed)
+
     def test_dispatch(self):
         """ Run our callbacks and reregister them """
         cb = Mock(name='Mock Callback')
@@ -35,6 +60,119 @@ class WatcherTestCase(unittest.TestCase):
             self.assertEqual(self.w._zk, args[0])
             self.assertEqual('/foo/bar', args[1])
 
+    def test_dispatch_executor(self):
+        """ Hand callbacks to the executor """
+        cb = Mock(name='Mock Callback')
+        self.w.executor = Mock(name='Mock Executor')
+        self.w.callbacks['/foo/bar'][enums.Event.Child].append(cb)
+        with patch.dict(watch.Watcher._watch_funcs,
+                        {enums.Event.Child: Mock(name='Mock aget_children()')}):
+            self.w.dispatch(2, enums.Event.Child, None, '/foo/bar')
+        self.assertFalse(cb.called)
+        key, func, callbacks, path, etype = self.w.executor.submit.call_args[0]
+        self.assertEqual('/foo/bar', key)
+        func(callbacks, path, etype)
+        cb.assert_called_once_with('/foo/bar', enums.Event.Child)
+
+    def test_dispatch_rearm_nonblocking(self):
+        """ Re-arm with the async calls """
+        self.assertTrue(
+            watch.Watcher._watch_funcs[enums.Event.Child] is zookeeper.aget_children)
+        mock_kids = Mock(name='Mock aget_children()')
+        self.w.callbacks['/foo/bar'][enums.Event.Child].append(self.mock_callback)
+        with patch.dict(watch.Watcher._watch_funcs, {enums.Event.Child: mock_kids}):
+            self.w.dispatch(2, enums.Event.Child, None, '/foo/bar')
+        args = mock_kids.call_args[0]
+        self.assertEqual((self.w._zk, '/foo/bar', self.w.dispatch), args[:3])
+
+    def test_coalesce_while_running(self):
+        """ Events that arrive during delivery collapse into one more """
+        self.w.coalesce = 0
+        calls = []
+        rearm = Mock(name='Mock aget_children()')
+        rearm.side_effect = lambda zh, path, watcher, completion: completion(
+            zh, zookeeper.OK, ['q-1'])
+
+        def cb(path, etype):
+            calls.append(path)
+            if len(calls) == 1:
+                for i in range(5):
+                    self.w.dispatch(2, enums.Event.Child, None, '/foo/bar')
+
+        self.w.callbacks['/foo/bar'][enums.Event.Child].append(cb)
+        with patch.dict(watch.Watcher._watch_funcs, {enums.Event.Child: rearm}):
+            self.w.dispatch(2, enums.Event.Child, None, '/foo/bar')
+        self.assertEqual(['/foo/bar', '/foo/bar'], calls)
+        self.assertEqual(2, rearm.call_count)
+        self.assertEqual(5, self.w.coalesced)
+        self.assertEqual({}, self.w._pending)
+
+    def test_coalesce_raising(self):
+        """ Deliver what arrived meanwhile even if a callback raises """
+        self.w.coalesce = 0
+        calls = []
+        rearm = Mock(name='Mock aget_children()')
+        rearm.side_effect = lambda zh, path, watcher, completion: completion(
+            zh, zookeeper.OK, ['q-1'])
+
+        def cb(path, etype):
+            calls.append(path)
+            if len(calls) == 1:
+                self.w.dispatch(2, enums.Event.Child, None, '/foo/bar')
+                raise ValueError('!')
+
+        self.w.callbacks['/foo/bar'][enums.Event.Child].append(cb)
+        with patch.dict(watch.Watcher._watch_funcs, {enums.Event.Child: rearm}):
+            with self.assertRaises(ValueError):
+                self.w.dispatch(2, enums.Event.Child, None, '/foo/bar')
+        self.assertEqual(['/foo/bar', '/foo/bar'], calls)
+        self.assertEqual(2, rearm.call_count)
+        self.assertEqual({}, self.w._pending)
+
+    def test_coalesce_window(self):
+        """ Events inside the window are delivered once """
+        self.w.coalesce = 0.05
+        cb = Mock(name='Mock Callback')
+        rearm = Mock(name='Mock aget()')
+        rearm.side_effect = lambda zh, path, watcher, completion: completion(
+            zh, zookeeper.OK, 'value', {})
+        self.w.callbacks['/foo'][enums.Event.Changed].append(cb)
+        with patch.dict(watch.Watcher._watch_funcs, {enums.Event.Changed: rearm}):
+            for i in range(3):
+                self.w.dispatch(2, enums.Event.Changed, None, '/foo')
+            self.assertFalse(cb.called)
+            time.sleep(0.2)
+        cb.assert_called_once_with('/foo', enums.Event.Changed)
+        self.assertEqual(1, rearm.call_count)
+        self.assertEqual(2, self.w.coalesced)
+
+    def test_dispatch_payload(self):
+        """ Hand what the re-arm read to payload callbacks """
+        cb = Mock(name='Mock Callback')
+        rich = Mock(name='Mock Payload Callback')
+        rearm = Mock(name='Mock aget_children()')
+        self.w.callbacks['/foo'][enums.Event.Child].append(cb)
+        self.w.payload_callbacks['/foo'][enums.Event.Child].append(rich)
+        with patch.dict(watch.Watcher._watch_funcs, {enums.Event.Child: rearm}):
+            self.w.dispatch(2, enums.Event.Child, None, '/foo')
+        cb.assert_called_once_with('/foo', enums.Event.Child)
+        self.assertFalse(rich.called)
+        completion = rearm.call_args[0][3]
+        completion(2, zookeeper.OK, ['q-2', 'q-1'])
+        rich.assert_called_once_with('/foo', enums.Event.Child, ['q-2', 'q-1'])
+
+    def test_dispatch_payload_gone(self):
+        """ The payload is None when the Node has gone """
+        rich = Mock(name='Mock Payload Callback')
+        rearm = Mock(name='Mock aget()')
+        rearm.side_effect = lambda zh, path, watcher, completion: completion(
+            zh, zookeeper.NONODE, None, None)
+        self.w.payload_callbacks['/foo'][enums.Event.Deleted].append(rich)
+        self.w._armed.add(('/foo', 'data'))
+        with patch.dict(watch.Watcher._watch_funcs, {enums.Event.Deleted: rearm}):
+            self.w.dispatch(2, enums.Event.Deleted, None, '/foo')
+        rich.assert_called_once_with('/foo', enums.Event.Deleted, None)
+
     def test_spyon_no_events(self):
         """ Raise when no events passed """
         with self.assertRaises(exceptions.NoEventError):
@@ -52,6 +190,71 @@ class WatcherTestCase(unittest.TestCase):
             self.assertEqual(self.w._zk, args[0])
             self.assertEqual('/foo/bar', args[1])
 
+    def test_one_watch_per_path(self):
+        """ Many subscribers share one armed watch """
+        mock_get = Mock(name='Mock aget()')
+        cbs = [Mock(name='Mock Callback {0}'.format(i)) for i in range(3)]
+        with patch.dict(watch.Watcher._watch_funcs, {
+                enums.Event.Changed: mock_get,
+                enums.Event.Deleted: mock_get}):
+            for cb in cbs:
+                self.w.spyon('/conf', cb, zoop.Event.Changed, zoop.Event.Deleted)
+            self.assertEqual(1, mock_get.call_count)
+            self.w.dispatch(2, enums.Event.Changed, None, '/conf')
+            self.assertEqual(2, mock_get.call_count)
+        for cb in cbs:
+            cb.assert_called_once_with('/conf', enums.Event.Changed)
+
+    def test_deleted_once(self):
+        """ Deliver a deletion once, though both watches fire """
+        cb = Mock(name='Mock Callback')
+        with patch.dict(watch.Watcher._watch_funcs, {
+                enums.Event.Deleted: Mock(name='Mock aget()'),
+                enums.Event.Child: Mock(name='Mock aget_children()')}):
+            self.w.spyon('/conf', cb, zoop.Event.Deleted, zoop.Event.Child)
+            self.w.dispatch(2, enums.Event.Deleted, None, '/conf')
+            self.w.dispatch(2, enums.Event.Deleted, None, '/conf')
+        cb.assert_called_once_with('/conf', enums.Event.Deleted)
+
+    def test_rearm_gone(self):
+        """ Forget a watch that couldn't be set """
+        rearm = Mock(name='Mock aget()')
+        rearm.side_effect = lambda zh, path, watcher, completion: completion(
+            zh, zookeeper.NONODE, None, None)
+        with patch.dict(watch.Watcher._watch_funcs, {enums.Event.Changed: rearm}):
+            self.w.spyon('/conf', self.mock_callback, zoop.Event.Changed)
+            self.w.spyon('/conf', self.mock_callback, zoop.Event.Changed)
+        self.assertEqual(2, rearm.call_count)
+        self.assertEqual(set(), self.w._armed)
+
+    def test_unspy(self):
+        """ Stop re-arming when the last subscriber leaves """
+        mock_get = Mock(name='Mock aget()')
+        other = Mock(name='Other Callback')
+        with patch.dict(watch.Watcher._watch_funcs, {enums.Event.Changed: mock_get}):
+            self.w.spyon('/conf', self.mock_callback, zoop.Event.Changed)
+            self.w.spyon('/conf', other, zoop.Event.Changed)
+            self.w.unspy('/conf', other, zoop.Event.Changed)
+            self.w.dispatch(2, enums.Event.Changed, None, '/conf')
+            self.assertEqual(2, mock_get.call_count)
+            self.assertFalse(other.called)
+            self.w.unspy('/conf', self.mock_callback)
+            self.w.dispatch(2, enums.Event.Changed, None, '/conf')
+            self.assertEqual(2, mock_get.call_count)
+        self.assertEqual(1, self.mock_callback.call_count)
+        self.assertFalse('/conf' in self.w.callbacks)
+        self.assertEqual(set(), self.w._armed)
+
+    def test_spyon_payload(self):
+        """ Register for the payload """
+        cb = lambda *a,**k: True
+        with patch.dict(watch.Watcher._watch_funcs,
+                        {enums.Event.Changed: Mock(name='Mock aget()')}):
+            self.w.spyon('/foo/bar', cb, zoop.Event.Changed, payload=True)
+        self.assertEqual([], self.w.callbacks['/foo/bar'][zoop.Event.Changed])
+        self.assertEqual([cb],
+                         self.w.payload_callbacks['/foo/bar'][zoop.Event.Changed])
+
     def test_spyon_changed(self):
         """ Register our desire to watch for events """
         cb = lambda *a,**k: True
@@ -70,6 +273,160 @@ class WatcherTestCase(unittest.TestCase):
             self.assertEqual('/foo/bar', args[1])
 
 
+class DispatchPoolTestCase(unittest.TestCase):
+    def test_bad_policy(self):
+        """ Only known policies """
+        with self.assertRaises(ValueError):
+            watch.DispatchPool(policy='shrug')
+
+    def test_ordered_per_key(self):
+        """ Tasks for one key run in order, off our thread """
+        pool = watch.DispatchPool(workers=3)
+        seen = []
+        threads = set()
+
+        def task(n):
+            seen.append(n)
+            threads.add(threading.current_thread())
+
+        for n in range(100):
+            pool.submit('/foo', task, n)
+        pool.shutdown()
+        self.assertEqual(list(range(100)), seen)
+        self.assertEqual(1, len(threads))
+        self.assertFalse(threading.current_thread() in threads)
+
+    def test_spill(self):
+        """ Never wait for room - queue beyond maxsize, in order """
+        pool = watch.DispatchPool(workers=1, maxsize=1)
+        gate = threading.Event()
+        ran = []
+        pool.submit('/foo', gate.wait)
+        while not pool._queues[0].empty():
+            time.sleep(0.001) # Wait for the worker to block
+        for n in range(5):
+            self.assertTrue(pool.submit('/foo', ran.append, n))
+        self.assertEqual(4, pool.spilled)
+        gate.set()
+        pool.shutdown()
+        self.assertEqual(list(range(5)), ran)
+
+    def test_full(self):
+        """ Drop or run inline when a worker is backed up """
+        for policy in ('drop', 'inline'):
+            pool = watch.DispatchPool(workers=1, maxsize=1, policy=policy)
+            gate = threading.Event()
+            ran = []
+            pool.submit('/foo', gate.wait)
+            while not pool._queues[0].empty():
+                time.sleep(0.001) # Wait for the worker to block
+            self.assertTrue(pool.submit('/foo', ran.append, 1))
+            full = pool.submit('/foo', ran.append, 2)
+            gate.set()
+            pool.shutdown()
+            if policy == 'drop':
+                self.assertFalse(full)
+                self.assertEqual(1, pool.dropped)
+                self.assertEqual([1], ran)
+            else:
+                self.assertTrue(full)
+                self.assertEqual([2, 1], ran)
+
+class TreeWatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.w = watch.Watcher(2)
+        self.ns = {
+            '/c': ['a', 'b'],
+            '/c/a': ['x'],
+            '/c/a/x': [],
+            '/c/b': []
+            }
+        self.calls = []
+
+        def akids(zh, path, watcher, completion):
+            if path in self.ns:
+                completion(zh, zookeeper.OK, list(self.ns[path]))
+            else:
+                completion(zh, zookeeper.NONODE, None)
+
+        def aget(zh, path, watcher, completion):
+            if path in self.ns:
+                completion(zh, zookeeper.OK, 'value', {})
+            else:
+                completion(zh, zookeeper.NONODE, None, None)
+
+        self.funcs = patch.dict(watch.Watcher._watch_funcs, {
+                enums.Event.Child: akids,
+                enums.Event.Changed: aget,
+                enums.Event.Deleted: aget})
+        self.funcs.start()
+        self.tw = self.w.watch_tree('/c', lambda *a: self.calls.append(a))
+
+    def test_start(self):
+        """ Index what's there without reporting it """
+        self.assertEqual([], self.calls)
+        for path in self.ns:
+            self.assertTrue(path in self.tw)
+        self.assertEqual(set(['x']), self.tw.children['/c/a'])
+
+    def test_created(self):
+        """ Report new Nodes, and what's below them """
+        self.ns['/c/b'] = ['y']
+        self.ns['/c/b/y'] = ['z']
+        self.ns['/c/b/y/z'] = []
+        self.w.dispatch(2, enums.Event.Child, None, '/c/b')
+        self.assertEqual([('/c/b/y', enums.Event.Created),
+                          ('/c/b/y/z', enums.Event.Created)], self.calls)
+        self.assertTrue('/c/b/y/z' in self.tw)
+
+    def test_deleted(self):
+        """ Report a deleted subtree, deepest first """
+        self.ns['/c'] = ['b']
+        del self.ns['/c/a'], self.ns['/c/a/x']
+        self.w.dispatch(2, enums.Event.Child, None, '/c')
+        self.assertEqual([('/c/a/x', enums.Event.Deleted),
+                          ('/c/a', enums.Event.Deleted)], self.calls)
+        self.assertFalse('/c/a' in self.w.callbacks)
+        self.assertFalse('/c/a/x' in self.w.payload_callbacks)
+
+    def test_changed(self):
+        """ Report data changes """
+        self.w.dispatch(2, enums.Event.Changed, None, '/c/a/x')
+        self.assertEqual([('/c/a/x', enums.Event.Changed)], self.calls)
+
+    def test_root_recreated(self):
+        """ Keep watching when the root is deleted and created again """
+        ns, self.ns = self.ns, {}
+        with patch.object(watch.zookeeper, 'aexists') as aexists:
+            self.w.dispatch(2, enums.Event.Deleted, None, '/c')
+            self.assertEqual(('/c', enums.Event.Deleted), self.calls[-1])
+            self.assertFalse('/c' in self.tw)
+            zh, path, watcher, completion = aexists.call_args[0]
+            self.assertEqual('/c', path)
+            completion(zh, zookeeper.NONODE, None)
+            self.calls = []
+
+            self.ns = {'/c': ['n'], '/c/n': []}
+            watcher(zh, enums.Event.Created, 3, '/c')
+        self.assertEqual([('/c', enums.Event.Created),
+                          ('/c/n', enums.Event.Created)], self.calls)
+        self.assertTrue('/c/n' in self.tw)
+        self.calls = []
+        self.w.dispatch(2, enums.Event.Changed, None, '/c/n')
+        self.assertEqual([('/c/n', enums.Event.Changed)], self.calls)
+        self.assertEqual(1, aexists.call_count)
+
+    def test_close(self):
+        """ Leave nothing subscribed """
+        self.tw.close()
+        self.assertEqual({}, self.w.callbacks)
+        self.assertEqual({}, self.w.payload_callbacks)
+        self.w.dispatch(2, enums.Event.Changed, None, '/c')
+        self.assertEqual([], self.calls)
+
+    def tearDown(self):
+        self.funcs.stop()
+
 
 if __name__ == '__main__':
     unittest.main()
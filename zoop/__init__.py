@@ -3,12 +3,14 @@ Make us a package  please!
 """
 from zoop._version import __version__
 from zoop import exceptions
+from zoop.cache import NodeCache
 from zoop.client import ZooKeeper
+from zoop.election import Election
 from zoop.enums import Event
-from zoop.lock import Lock
+from zoop.lock import Lock, MultiLock, ReadWriteLock, Semaphore
 from zoop.logutils import divert_zoolog
 from zoop.queue import Queue
-from zoop.tree import Tree
+from zoop.tree import Tree, CompactTree
 
 __all__ = [
     'exceptions',
@@ -17,6 +19,12 @@ __all__ = [
     'divert_zoolog',
     'Event',
     'Lock',
+    'MultiLock',
+    'ReadWriteLock',
+    'Semaphore',
     'Queue',
-    'Tree'
+    'Tree',
+    'CompactTree',
+    'NodeCache',
+    'Election'
     ]
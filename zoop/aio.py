@@ -0,0 +1,682 @@
+# Copyright (c) 2012 David Miller (david@deadpansincerity.com)
+#
+# This file is part of zoop (http://github.com/davidmiller/zoop)
+#
+# zoop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+zoop.aio
+
+An asyncio front-end for zoop clients.
+
+Every method returns an asyncio Future, completed on the event loop
+with call_soon_threadsafe() when libzookeeper's completion callback
+fires, so nothing here ever blocks the loop:
+
+>>> zk = ZooKeeper('localhost:2181')
+>>> zk.connect()
+>>> azk = AioZooKeeper(zk)
+>>> value, stat = await azk.get('/config')
+>>> async with azk.Lock('mylock'):
+...     pass
+>>> async for item in azk.Queue('/myq'):
+...     print item
+
+On Python 2 this uses the trollius backport of asyncio.
+"""
+import os
+import threading
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        raise ImportError("zoop.aio requires asyncio (or trollius on Python 2)")
+
+import zookeeper
+
+from zoop import exceptions, lock
+
+try:
+    StopAsyncIteration
+except NameError: # Python < 3.5 has no async iteration anyway
+    class StopAsyncIteration(Exception):
+        "Raised by __anext__ when an async iterator is exhausted."
+
+def _transfer(res, fut):
+    """
+    Copy the outcome of an AsyncResult onto an asyncio Future.
+    This must run on the Future's event loop.
+
+    Arguments:
+    - `res`: AsyncResult
+    - `fut`: asyncio.Future
+
+    Return: None
+    Exceptions: None
+    """
+    if fut.done():
+        return # Cancelled while in flight
+    if res.exception is not None:
+        fut.set_exception(res.exception)
+    else:
+        fut.set_result(res.value)
+    return
+
+
+class AioZooKeeper(object):
+    """
+    Awaitable adapter over a zoop client.
+
+    Arguments:
+    - `zk`: ZooKeeper - a connected client
+    - `loop`: the event loop to complete Futures on. Defaults to
+              the current event loop.
+    """
+
+    def __init__(self, zk, loop=None):
+        self.zk = zk
+        self.loop = loop or asyncio.get_event_loop()
+
+    def __repr__(self):
+        return "<AioZooKeeper for {0}>".format(self.zk.server)
+
+    def future(self):
+        """
+        Return a new Future bound to our event loop.
+
+        Return: asyncio.Future
+        Exceptions: None
+        """
+        return asyncio.Future(loop=self.loop)
+
+    def resolve(self, fut, value=None, exception=None):
+        """
+        Thread-safely complete `fut` from any thread.
+
+        Arguments:
+        - `fut`: asyncio.Future
+        - `value`: object
+        - `exception`: Exception or None
+
+        Return: None
+        Exceptions: None
+        """
+        def settle():
+            if fut.done():
+                return
+            if exception is not None:
+                fut.set_exception(exception)
+            else:
+                fut.set_result(value)
+
+        self.loop.call_soon_threadsafe(settle)
+        return
+
+    def bridge(self, res):
+        """
+        Return a Future that completes on our loop when the
+        AsyncResult `res` does.
+
+        Arguments:
+        - `res`: AsyncResult
+
+        Return: asyncio.Future
+        Exceptions: None
+        """
+        fut = self.future()
+
+        def done(res):
+            self.loop.call_soon_threadsafe(_transfer, res, fut)
+
+        res.rawlink(done)
+        return fut
+
+    def create(self, path, value='', flags=0):
+        """
+        Create a new Node at `path` containing `value`.
+
+        Arguments:
+        - `path`: string - new path
+        - `value`: string - value of the Node
+        - `flags`: int - the ZooKeeper flags (SEQUENCE|EPHEMERAL)
+
+        Return: Future - resolves to the path actually created
+        Exceptions: None
+        """
+        return self.bridge(self.zk.acreate(path, value, flags=flags))
+
+    def delete(self, path, version=-1):
+        """
+        Delete the Node at `path`
+
+        Arguments:
+        - `path`: string
+        - `version`: int - expected version, -1 for any
+
+        Return: Future
+        Exceptions: None
+        """
+        return self.bridge(self.zk.adelete(path, version))
+
+    def exists(self, path, watch=None):
+        """
+        Determine whether the Node at `path` exists
+
+        Arguments:
+        - `path`: string
+        - `watch`: callable - optional watcher function
+
+        Return: Future - resolves to a dict of stats or None
+        Exceptions: None
+        """
+        return self.bridge(self.zk.aexists(path, watch))
+
+    def get(self, path, watch=None):
+        """
+        Get the value of the Node at `path`
+
+        Arguments:
+        - `path`: string
+        - `watch`: callable - optional watcher function
+
+        Return: Future - resolves to a tuple of (Value, Statsdict)
+        Exceptions: None
+        """
+        return self.bridge(self.zk.aget(path, watch))
+
+    def get_children(self, path, watch=None):
+        """
+        List the child nodes of `path`
+
+        Arguments:
+        - `path`: string
+        - `watch`: callable - optional watcher function
+
+        Return: Future - resolves to a list of strings
+        Exceptions: None
+        """
+        return self.bridge(self.zk.aget_children(path, watch))
+
+    def set(self, path, value, version=-1):
+        """
+        Set the value of the Node at `path`
+
+        Arguments:
+        - `path`: string
+        - `value`: string
+        - `version`: int - expected version, -1 for any
+
+        Return: Future - resolves to the new Statsdict
+        Exceptions: None
+        """
+        return self.bridge(self.zk.aset(path, value, version))
+
+    def mkdirp(self, path):
+        """
+        Recursively make all nodes in the given path, as
+        ZooKeeper.mkdirp() does, without blocking the loop.
+
+        Arguments:
+        - `path`: string
+
+        Return: Future - resolves to None
+        Exceptions: None
+        """
+        fut = self.future()
+        self._mkdirp(path, lambda exc: self.resolve(fut, exception=exc))
+        return fut
+
+    def _mkdirp(self, path, then):
+        """
+        Send a create for each node of `path` the client doesn't
+        already know about, and call then(exception) once they have
+        all completed - with None if `path` now exists.
+
+        `then` runs on the libzookeeper completion thread, or right
+        away when there is nothing to make.
+
+        Arguments:
+        - `path`: string
+        - `then`: callable
+
+        Return: None
+        Exceptions: None
+        """
+        zk = self.zk
+        if path in zk.known_paths:
+            return then(None)
+        parts = [p for p in path.split('/') if p]
+        paths = ['/' + '/'.join(parts[:i + 1]) for i in range(len(parts))]
+        missing = [p for p in paths if p not in zk.known_paths]
+        if not missing:
+            return then(None)
+        guard = threading.Lock()
+        state = dict(left=len(missing), error=None)
+
+        def made(res):
+            exc = res.exception
+            with guard:
+                if exc is not None and state['error'] is None and \
+                        not isinstance(exc, exceptions.NodeExistsError):
+                    state['error'] = exc
+                state['left'] -= 1
+                if state['left']:
+                    return
+            if state['error'] is None:
+                zk.known_paths.update(paths)
+            then(state['error'])
+
+        for p in missing: # Replies come in order, so parents come first
+            zk.acreate(p, callback=made)
+        return
+
+    def Lock(self, name, root='/zooplocks'):
+        """
+        Returns an AioLock called `name`
+
+        Arguments:
+        - `name`: str
+        - `root`: str
+
+        Return: AioLock
+        Exceptions: None
+        """
+        return AioLock(self, name, root=root)
+
+    def Queue(self, path, prefix='q-'):
+        """
+        Returns an AioQueue rooted at `path`
+
+        Arguments:
+        - `path`: string - the root of your Queue.
+        - `prefix`: prefix string for the item nodes.
+
+        Return: AioQueue
+        Exceptions: None
+        """
+        return AioQueue(self, path, prefix=prefix)
+
+    def watch(self, path, *events):
+        """
+        Return an async iterator over the (path, event) pairs of
+        `events` happening at `path`
+
+        Arguments:
+        - `path`: string - Path to watch
+        - `*events`: int - one or more zoop.Event attribute
+
+        Return: AioWatch
+        Exceptions:
+        - NoEventError: No events passed.
+        """
+        return AioWatch(self, path, *events)
+
+
+class AioLock(object):
+    """
+    The zoop Lock recipe, driven entirely by completion callbacks
+    rather than a waiting thread.
+
+    One AioLock may only be held by one task at a time - create
+    one per task that wants to contend.
+
+    >>> async with azk.Lock('mylock'):
+    ...     print await azk.get_children('/zooplocks/mylock')
+    ['lock-0000001']
+    """
+    prefix = lock.Lock.prefix
+
+    def __init__(self, aio, name, root='/zooplocks'):
+        self.aio = aio
+        self.path = os.path.join(root, name)
+        self.node = None
+
+    def __repr__(self):
+        return "<AioLock for {0}>".format(self.path)
+
+    def __aenter__(self):
+        return self.acquire()
+
+    def __aexit__(self, exc_type, exc_value, traceback):
+        return self.release()
+
+    def acquire(self):
+        """
+        Attempt to acquire the lock.
+
+        Cancel the returned Future (e.g. with asyncio.wait_for) to
+        give up waiting - our wait node is then removed.
+
+        The Lock's path is made on first use, asynchronously.
+
+        Return: Future - resolves to True once we hold the Lock
+        Exceptions: None
+        """
+        aio, zk = self.aio, self.aio.zk
+        fut = aio.future()
+        guard = threading.Lock()
+        state = dict(gone=False)
+
+        def discard():
+            # Whichever thread finds we're done with our wait node
+            # removes it, once.
+            with guard:
+                node = state.pop('node', None)
+                state['gone'] = True
+            if node is not None:
+                zk.adelete(node)
+            return node
+
+        def failed(exc):
+            discard()
+            aio.resolve(fut, exception=exc)
+
+        def created(res):
+            if res.exception is not None:
+                return failed(res.exception)
+            with guard:
+                gone = state['gone']
+                if not gone:
+                    state['node'] = res.value
+                    state['key'] = os.path.basename(res.value)
+            if gone:
+                return zk.adelete(res.value) # Cancelled while in flight
+            check()
+
+        def check(*event):
+            if fut.done():
+                return
+            zk.aget_children(self.path, callback=listed)
+
+        def listed(res):
+            if res.exception is not None:
+                return failed(res.exception)
+            ahead = lock._ahead(res.value, state['key'])
+            if not ahead:
+                with guard:
+                    self.node = state.get('node')
+                if self.node is not None:
+                    aio.resolve(fut, True)
+                return
+            state['blocking'] = sorted(ahead, key=lock._sequence)
+            wait()
+
+        def wait(*event):
+            if fut.done():
+                return
+            zk.aexists(os.path.join(self.path, state['blocking'][-1]),
+                       watch=wait, callback=blocked)
+
+        def blocked(res):
+            if res.exception is not None:
+                return failed(res.exception)
+            if res.value is None:
+                # Already free - move up the queue, listing again
+                # only once everyone ahead of us has gone.
+                state['blocking'].pop()
+                if state['blocking']:
+                    return wait()
+                check()
+
+        def abandoned(fut):
+            if fut.cancelled():
+                node = discard()
+                if node is not None and self.node == node:
+                    self.node = None
+
+        def made(exc):
+            if exc is not None:
+                return failed(exc)
+            zk.acreate(os.path.join(self.path, self.prefix), "0",
+                       flags=zookeeper.SEQUENCE, callback=created)
+
+        fut.add_done_callback(abandoned)
+        aio._mkdirp(self.path, made)
+        return fut
+
+    def release(self):
+        """
+        Release the Lock!
+
+        Return: Future - resolves to True
+        Exceptions: None
+        """
+        fut = self.aio.future()
+        node, self.node = self.node, None
+        if node is None:
+            fut.set_result(True) # We never had the Lock!
+            return fut
+
+        def deleted(res):
+            self.aio.resolve(fut, True)
+
+        self.aio.zk.adelete(node, callback=deleted)
+        return fut
+
+
+class AioQueue(object):
+    """
+    The zoop Queue recipe with awaitable methods.
+
+    Async iteration blocks (without blocking the loop) until an item
+    is available, then yields its value - while get(), like Queue.get(),
+    resolves to the value and its Statsdict:
+
+    >>> async for item in azk.Queue('/myq'):
+    ...     print item
+
+    The Queue's path is made on first use, asynchronously.
+    """
+
+    def __init__(self, aio, path, prefix='q-'):
+        self.aio = aio
+        self.path = path
+        self.prefix = prefix
+
+    def __repr__(self):
+        return "<ZooKeeper asyncio Queue at {0}{1}>".format(
+            self.aio.zk.server, self.path)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        fut = self.aio.future()
+        self._take(fut, wait=True)
+        return fut
+
+    def put(self, item):
+        """
+        Put `item` at the end of the queue.
+
+        Arguments:
+        - `item`: string - data to add
+
+        Return: Future - resolves to the item's path
+        Exceptions: None
+        """
+        aio = self.aio
+        fut = aio.future()
+
+        def created(res):
+            aio.loop.call_soon_threadsafe(_transfer, res, fut)
+
+        def made(exc):
+            if exc is not None:
+                return aio.resolve(fut, exception=exc)
+            aio.zk.acreate(os.path.join(self.path, self.prefix), item,
+                           flags=zookeeper.SEQUENCE, callback=created)
+
+        aio._mkdirp(self.path, made)
+        return fut
+
+    def get(self):
+        """
+        Return the next item from the Queue
+
+        Return: Future - resolves to a tuple of (string data item,
+                Statsdict), as Queue.get() returns
+        Exceptions: None (the Future raises Empty)
+        """
+        fut = self.aio.future()
+        self._take(fut, wait=False, stat=True)
+        return fut
+
+    def _take(self, fut, wait, stat=False):
+        """
+        Take the frist item from the Queue and complete `fut` with
+        its value.
+
+        The read and the delete of an item are pipelined, as in
+        Queue.get(). If another consumer deletes an item before we
+        do, move along to the next one.
+
+        Arguments:
+        - `fut`: asyncio.Future
+        - `wait`: bool - when the Queue is empty, wait for an item
+                         rather than failing with Empty
+        - `stat`: bool - complete with (value, Statsdict) rather
+                         than the value alone
+
+        Return: None
+        Exceptions: None
+        """
+        aio, zk = self.aio, self.aio.zk
+        guard = threading.Lock()
+        state = dict(busy=False, dirty=False)
+
+        def listed(res):
+            if res.exception is not None:
+                return aio.resolve(fut, exception=res.exception)
+            with guard:
+                if state['busy']:
+                    state['dirty'] = True
+                    return # Only one claim in flight, or we lose items
+                state['busy'] = True
+            claim(sorted(res.value))
+
+        def idle():
+            with guard:
+                state['busy'] = False
+                again, state['dirty'] = state['dirty'], False
+            if again:
+                zk.aget_children(self.path, callback=listed)
+
+        def claim(kids):
+            if fut.done():
+                return
+            if not kids:
+                if wait:
+                    return idle() # Our child watch will call again
+                err = "Queue at {0} has no items".format(self.path)
+                return aio.resolve(fut, exception=exceptions.Empty(err))
+            ipath = os.path.join(self.path, kids[0])
+
+            def got(res):
+                if res.exception is not None:
+                    return aio.resolve(fut, exception=res.exception)
+                aio.resolve(fut, res.value if stat else res.value[0])
+
+            def deleted(dres):
+                if dres.exception is not None:
+                    return claim(kids[1:]) # Somebody beat us to it
+                item.rawlink(got)
+
+            item = zk.aget(ipath)
+            zk.adelete(ipath, callback=deleted)
+
+        def rearm(*event):
+            if not fut.done():
+                zk.aget_children(self.path, watch=rearm, callback=listed)
+
+        def made(exc):
+            if exc is not None:
+                return aio.resolve(fut, exception=exc)
+            if wait:
+                rearm()
+            else:
+                zk.aget_children(self.path, callback=listed)
+
+        aio._mkdirp(self.path, made)
+        return
+
+
+class AioWatch(object):
+    """
+    An async iterator over ZooKeeper events at a path.
+
+    >>> async with azk.watch('/config', Event.Changed) as events:
+    ...     async for path, etype in events:
+    ...         print path, etype
+    """
+
+    def __init__(self, aio, path, *events):
+        self.aio = aio
+        self.path = path
+        self.events = events
+        self.closed = False
+        self._queue = asyncio.Queue()
+        aio.zk.watcher.spyon(path, self._fired, *events)
+
+    def __repr__(self):
+        return "<AioWatch on {0}>".format(self.path)
+
+    def __aenter__(self):
+        fut = self.aio.future()
+        fut.set_result(self)
+        return fut
+
+    def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+        fut = self.aio.future()
+        fut.set_result(False)
+        return fut
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration()
+        return self._queue.get()
+
+    def _fired(self, path, etype):
+        """
+        Watcher callback - hand the event over to the loop.
+
+        Arguments:
+        - `path`: string
+        - `etype`: int
+
+        Return: None
+        Exceptions: None
+        """
+        if not self.closed:
+            self.aio.loop.call_soon_threadsafe(self._queue.put_nowait,
+                                               (path, etype))
+        return
+
+    def close(self):
+        """
+        Stop delivering events to this iterator.
+
+        Return: None
+        Exceptions: None
+        """
+        self.closed = True
+        self.aio.zk.watcher.unspy(self.path, self._fired, *self.events)
+        return
@@ -0,0 +1,327 @@
+# Copyright (c) 2012 David Miller (david@deadpansincerity.com)
+#
+# This file is part of zoop (http://github.com/davidmiller/zoop)
+#
+# zoop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+zoop.cache
+
+A read-through cache of Node data and children, kept fresh by watches.
+"""
+import collections
+from os.path import dirname
+import threading
+
+from zoop import enums
+
+class NodeCache(object):
+    """
+    Wraps a ZooKeeper client, answering get() and get_children()
+    from memory where it can.
+
+    The first read of a path goes to ZooKeeper, and we spy on the
+    path through the client's Watcher. When the Node changes, the
+    payload the watch is re-armed with replaces our entry, so it
+    never costs another read. Deleted Nodes drop out.
+
+    At most `maxsize` entries are kept, the least recently used
+    being evicted first, along with their subscriptions. Everything
+    else is passed straight through to the client, and writes made
+    through the cache invalidate what they touch.
+
+    >>> zk = NodeCache(ZooKeeper('localhost:2181'), maxsize=5000)
+    >>> zk.connect()
+    >>> zk.get('/config')
+    ('hello', {...})
+    >>> zk.get('/config') # From memory
+    ('hello', {...})
+    >>> zk.hits, zk.misses
+    (1, 1)
+    """
+    _events = {
+        'data': (enums.Event.Changed, enums.Event.Deleted),
+        'children': (enums.Event.Child, enums.Event.Deleted)
+        }
+
+    def __init__(self, client, maxsize=10000):
+        """
+        Store vars
+
+        Arguments:
+        - `client`: ZooKeeper
+        - `maxsize`: int - maximum number of entries
+
+        Return: None
+        Exceptions: None
+        """
+        self.zk = client
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<zoop NodeCache of {0} entries for {1}>".format(
+            len(self), self.zk)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getattr__(self, name):
+        return getattr(self.zk, name)
+
+    def _read(self, kind, path, fetch):
+        """
+        Return the cached `kind` of `path`, or read it with `fetch`,
+        cache it and watch it.
+
+        Arguments:
+        - `kind`: string - 'data' or 'children'
+        - `path`: string
+        - `fetch`: callable - reads `path` from ZooKeeper
+
+        Return: whatever `fetch` returns
+        Exceptions: Whatever `fetch` raises
+        """
+        key = (kind, path)
+        with self._lock:
+            if key in self._entries:
+                value = self._entries.pop(key)
+                if value is not None:
+                    self._entries[key] = value # Most recently used
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            token = object()
+            self._entries[key] = None
+            self._loading[key] = token
+        # Arm the watch before we read, so no change can slip between
+        self.zk.watcher.spyon(path, self._subscriber(kind),
+                              *self._events[kind], payload=True)
+        try:
+            value = fetch(path)
+        except Exception:
+            self._forget(key)
+            raise
+        with self._lock:
+            if self._loading.get(key) is token:
+                del self._loading[key]
+                if key in self._entries:
+                    self._entries[key] = value
+            self._evict()
+        return value
+
+    def _evict(self):
+        """
+        Drop least recently used entries until we fit in `maxsize`.
+        Call with self._lock held.
+
+        Return: None
+        Exceptions: None
+        """
+        while len(self._entries) > self.maxsize:
+            key, value = self._entries.popitem(last=False)
+            self.evictions += 1
+            self._unspy(key)
+        return
+
+    def _subscriber(self, kind):
+        """
+        The watcher callback for entries of `kind`. Each kind has its
+        own, so that unspying one entry leaves the other subscribed
+        to Deleted.
+
+        Arguments:
+        - `kind`: string - 'data' or 'children'
+
+        Return: callable
+        Exceptions: None
+        """
+        if kind == 'children':
+            return self._children_refreshed
+        return self._data_refreshed
+
+    def _unspy(self, key):
+        """
+        Stop watching for changes to the entry at `key`.
+
+        Arguments:
+        - `key`: tuple of (kind, path)
+
+        Return: None
+        Exceptions: None
+        """
+        kind, path = key
+        self.zk.watcher.unspy(path, self._subscriber(kind),
+                              *self._events[kind])
+        return
+
+    def _forget(self, key):
+        """
+        Drop the entry at `key` and stop watching it.
+
+        Arguments:
+        - `key`: tuple of (kind, path)
+
+        Return: None
+        Exceptions: None
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._loading.pop(key, None)
+        self._unspy(key)
+        return
+
+    def _refreshed(self, key, payload):
+        """
+        Replace our entry at `key` with what its watch was re-armed
+        with, or drop everything for the path if the Node has gone.
+
+        Arguments:
+        - `key`: tuple of (kind, path)
+        - `payload`: (value, Statsdict), list of children or None
+
+        Return: None
+        Exceptions: None
+        """
+        if payload is None:
+            self.invalidate(key[1])
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = payload
+                self._loading.pop(key, None)
+        return
+
+    def _data_refreshed(self, path, etype, payload):
+        """
+        Payload watcher callback for our data entries.
+
+        Arguments:
+        - `path`: string
+        - `etype`: Enum - Event type
+        - `payload`: (value, Statsdict) or None
+
+        Return: None
+        Exceptions: None
+        """
+        self._refreshed(('data', path), payload)
+
+    def _children_refreshed(self, path, etype, payload):
+        """
+        Payload watcher callback for our children entries.
+
+        Arguments:
+        - `path`: string
+        - `etype`: Enum - Event type
+        - `payload`: list of children or None
+
+        Return: None
+        Exceptions: None
+        """
+        self._refreshed(('children', path), payload)
+
+    def get(self, path, watch=None):
+        """
+        Get the value of the ZooKeeper Node at `path`, from memory
+        if we can. Reads with a `watch` always go to ZooKeeper.
+
+        Arguments:
+        - `path`: string
+        - `watch`: callable - optional watcher function
+
+        Return: Tuple of (Value, Statsdict)
+        Exceptions: NoNodeError
+        """
+        if watch is not None:
+            return self.zk.get(path, watch)
+        return self._read('data', path, self.zk.get)
+
+    def get_children(self, path, watch=None):
+        """
+        Return a list of strings representing the child nodes of
+        `path`, from memory if we can. Listings with a `watch` always
+        go to ZooKeeper.
+
+        Arguments:
+        - `path`: string
+        - `watch`: callable - optional watcher function
+
+        Return: list of strings
+        Exceptions: NoNodeError
+        """
+        if watch is not None:
+            return self.zk.get_children(path, watch)
+        return list(self._read('children', path, self.zk.get_children))
+
+    def invalidate(self, path):
+        """
+        Drop anything we have cached for `path`
+
+        Arguments:
+        - `path`: string
+
+        Return: None
+        Exceptions: None
+        """
+        for kind in self._events:
+            self._forget((kind, path))
+        return
+
+    def clear(self):
+        """
+        Drop everything we have cached.
+
+        Return: None
+        Exceptions: None
+        """
+        with self._lock:
+            keys = list(self._entries)
+        for key in keys:
+            self._forget(key)
+        return
+
+    def create(self, path, *args, **kwargs):
+        """
+        Create a Node as ZooKeeper.create(), then invalidate its parent's
+        children.
+        """
+        try:
+            return self.zk.create(path, *args, **kwargs)
+        finally:
+            self._forget(('children', dirname(path)))
+
+    def set(self, path, value):
+        """
+        Set a Node's value as ZooKeeper.set(), then invalidate it.
+        """
+        try:
+            return self.zk.set(path, value)
+        finally:
+            self._forget(('data', path))
+
+    def delete(self, path):
+        """
+        Delete a Node as ZooKeeper.delete(), then invalidate it and
+        its parent's children.
+        """
+        try:
+            return self.zk.delete(path)
+        finally:
+            self.invalidate(path)
+            self._forget(('children', dirname(path)))
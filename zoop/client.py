@@ -23,7 +23,7 @@ import threading
 
 import zookeeper
 
-from zoop import exceptions, watch
+from zoop import exceptions, result, watch
 
 OPEN_ACL_UNSAFE = dict(perms=zookeeper.PERM_ALL, scheme = 'world', id='anyone')
 
@@ -33,19 +33,28 @@ class BaseZK(object):
     """
     flavour = 'Base Client'
 
-    def __init__(self, connection):
+    def __init__(self, connection, executor=None, coalesce=None):
         """
         Create the zookeeper.client instance
 
+        Pass a zoop.watch.DispatchPool as `executor` to run watch
+        callbacks off libzookeeper's completion thread, and a number
+        of seconds as `coalesce` to collapse bursts of watch events
+        (see zoop.watch.Watcher).
+
         Arguments:
         - `connection`: string host:port
+        - `executor`: DispatchPool
+        - `coalesce`: float - seconds
         """
         self.connwait = 15.0
         self.connected = False
         self.cv = threading.Condition()
         self.server = connection
         self._zk = None
-        self.watcher = watch.Watcher(self._zk)
+        self.watcher = watch.Watcher(self._zk, executor=executor,
+                                     coalesce=coalesce)
+        self.known_paths = set()
         return
 
     def __repr__(self):
@@ -143,14 +152,221 @@ class BaseZK(object):
         """
         raise NotImplementedError("!")
 
-    def watch(self, *a, **kw):
+    def watch(self, path, callback, event, payload=False):
         """
-        This is a method stub for subclasses to override.
+        Begin watching `path` for events of type `event`.
+        When one happens, execute `callback`, with two
+        arguments, the path of the ZooKeeper Even and the event type
+
+        If `payload` is True, `callback` also gets what was read when
+        the watch was re-armed (see zoop.watch.Watcher.spyon)
+
+        Arguments:
+        - `path`: string - Path to watch
+        - `callback`: callable
+        - `event`: int - a zoop.Event attribute
+        - `payload`: bool
 
         Return: None
-        Exceptions: NotImplementedError
+        Exceptions: None
         """
-        raise NotImplementedError("!")
+        self.watcher.spyon(path, callback, event, payload=payload)
+        return
+
+    def watch_tree(self, path, callback):
+        """
+        Begin watching `path` and every Node below it. When a Node is
+        created, changed or deleted, execute `callback` with its path
+        and the Event type. See zoop.watch.TreeWatch.
+
+        Arguments:
+        - `path`: string - Path to watch
+        - `callback`: callable
+
+        Return: TreeWatch - close() it to stop watching
+        Exceptions: None
+        """
+        return self.watcher.watch_tree(path, callback)
+
+    def unwatch(self, path, callback, event=None):
+        """
+        Stop calling `callback` for events of type `event`
+        (or of any type) at `path`.
+
+        Arguments:
+        - `path`: string - Path we were watching
+        - `callback`: callable
+        - `event`: int - a zoop.Event attribute
+
+        Return: None
+        Exceptions: None
+        """
+        if event is None:
+            self.watcher.unspy(path, callback)
+        else:
+            self.watcher.unspy(path, callback, event)
+        return
+
+    """
+    Asynchronous primitives.
+
+    These map directly onto the libzookeeper a* calls, and return an
+    AsyncResult as soon as the request is sent, so many requests can be
+    in flight on the one session. Every flavour of client has them.
+    """
+
+    def _async(self, path, callback):
+        """
+        Create the AsyncResult for a request on `path`, along with the
+        function our completion callbacks use to settle it.
+
+        Arguments:
+        - `path`: string
+        - `callback`: callable or None - linked to the result
+
+        Return: tuple of (AsyncResult, callable)
+        Exceptions: None
+        """
+        res = result.AsyncResult()
+        if callback is not None:
+            res.rawlink(callback)
+
+        @result.completing
+        def settle(rc, value=None):
+            if rc == zookeeper.OK:
+                res.set(value)
+            else:
+                res.set_exception(result.error_for(rc, path))
+            return
+
+        return res, settle
+
+    def acreate(self, path, value='', acl=[OPEN_ACL_UNSAFE], flags=0,
+                callback=None):
+        """
+        Asynchronously create a new Node at `path` containing `value`.
+
+        Arguments:
+        - `path`: string - new path
+        - `value`: string - value of the Node
+        - `acl`: list - list of Access Control flags
+        - `flags`: int - the ZooKeeper flags (SEQUENCE|EPHEMERAL)
+        - `callback`: callable - called with the AsyncResult on completion
+
+        Return: AsyncResult - resolves to the path actually created
+        Exceptions: None
+        """
+        res, settle = self._async(path, callback)
+
+        def completion(handle, rc, created):
+            settle(rc, created)
+
+        zookeeper.acreate(self._zk, path, value, acl, flags, completion)
+        return res
+
+    def adelete(self, path, version=-1, callback=None):
+        """
+        Asynchronously delete the Node at `path`
+
+        Arguments:
+        - `path`: string
+        - `version`: int - expected version, -1 for any
+        - `callback`: callable - called with the AsyncResult on completion
+
+        Return: AsyncResult - resolves to None
+        Exceptions: None
+        """
+        res, settle = self._async(path, callback)
+
+        def completion(handle, rc):
+            settle(rc)
+
+        self.known_paths.discard(path)
+        zookeeper.adelete(self._zk, path, version, completion)
+        return res
+
+    def aexists(self, path, watch=None, callback=None):
+        """
+        Asynchronously determine whether the Node at `path` exists
+
+        Arguments:
+        - `path`: string
+        - `watch`: callable - optional watcher function
+        - `callback`: callable - called with the AsyncResult on completion
+
+        Return: AsyncResult - resolves to a dict of stats or None
+        Exceptions: None
+        """
+        res, settle = self._async(path, callback)
+
+        def completion(handle, rc, stat):
+            if rc == zookeeper.NONODE:
+                rc, stat = zookeeper.OK, None
+            settle(rc, stat)
+
+        zookeeper.aexists(self._zk, path, watch, completion)
+        return res
+
+    def aget(self, path, watch=None, callback=None):
+        """
+        Asynchronously get the value of the Node at `path`
+
+        Arguments:
+        - `path`: string
+        - `watch`: callable - optional watcher function
+        - `callback`: callable - called with the AsyncResult on completion
+
+        Return: AsyncResult - resolves to a tuple of (Value, Statsdict)
+        Exceptions: None
+        """
+        res, settle = self._async(path, callback)
+
+        def completion(handle, rc, value, stat):
+            settle(rc, (value, stat))
+
+        zookeeper.aget(self._zk, path, watch, completion)
+        return res
+
+    def aget_children(self, path, watch=None, callback=None):
+        """
+        Asynchronously list the child nodes of `path`
+
+        Arguments:
+        - `path`: string
+        - `watch`: callable - optional watcher function
+        - `callback`: callable - called with the AsyncResult on completion
+
+        Return: AsyncResult - resolves to a list of strings
+        Exceptions: None
+        """
+        res, settle = self._async(path, callback)
+
+        def completion(handle, rc, children):
+            settle(rc, children)
+
+        zookeeper.aget_children(self._zk, path, watch, completion)
+        return res
+
+    def aset(self, path, value, version=-1, callback=None):
+        """
+        Asynchronously set the value of the Node at `path`
+
+        Arguments:
+        - `path`: string
+        - `value`: string
+        - `version`: int - expected version, -1 for any
+        - `callback`: callable - called with the AsyncResult on completion
+
+        Return: AsyncResult - resolves to the new Statsdict
+        Exceptions: None
+        """
+        res, settle = self._async(path, callback)
+
+        def completion(handle, rc, stat):
+            settle(rc, stat)
+
+        zookeeper.aset(self._zk, path, value, version, completion)
+        return res
 
     """
     The following are either aliases, or generic abstractions that
@@ -187,33 +403,220 @@ class BaseZK(object):
         """
         Recursively make all nodes in the given path
 
+        We remember the paths we have made, so making them again is
+        free, and only the nodes below the deepest path we already know
+        about are created. Those creates are sent as one Transaction,
+        and nodes that turn out to exist already are fine. From a
+        libzookeeper callback, where we can't wait for a Transaction,
+        they are made one at a time with synchronous calls.
+
+        If another client deletes a path we made, call forget_path()
+        before making it again.
+
         Arguments:
         - `path`: string
 
         Return: None
         Exceptions: None
         """
-        paths = path.split('/')
-        for i, path in enumerate(paths):
-            p = join(join(paths[:i]), path)
-            if not self.exists(p):
-                self.create(p)
+        if path in self.known_paths:
+            return
+        parts = [p for p in path.split('/') if p]
+        paths = ['/' + '/'.join(parts[:i + 1]) for i in range(len(parts))]
+        frist = len(paths)
+        while frist > 0 and paths[frist - 1] not in self.known_paths:
+            frist -= 1
+
+        if result.on_completion_thread():
+            for p in paths[frist:]:
+                try:
+                    zookeeper.create(self._zk, p, '', [OPEN_ACL_UNSAFE], 0)
+                except zookeeper.NodeExistsException:
+                    pass
+            self.known_paths.update(paths)
+            return
 
-    def rm_rf(self, path):
+        with self.transaction() as txn:
+            for p in paths[frist:]:
+                txn.create(p)
+        for res in txn.results:
+            if isinstance(res, exceptions.Error) and \
+                    not isinstance(res, exceptions.NodeExistsError):
+                raise res
+        self.known_paths.update(paths)
+        return
+
+    def forget_path(self, path):
+        """
+        Forget that `path` and anything below it has been made,
+        so the next mkdirp() checks with the server again.
+
+        Arguments:
+        - `path`: string
+
+        Return: None
+        Exceptions: None
+        """
+        prefix = path.rstrip('/') + '/'
+        for known in list(self.known_paths):
+            if known == path or known.startswith(prefix):
+                self.known_paths.discard(known)
+        return
+
+    def rm_rf(self, path, window=1000, progress=None):
         """
         Recursively delete all nodes below the given path
 
+        The tree is listed a level at a time with pipelined
+        get_children requests, then deleted deepest level first in
+        batches of `window` pipelined deletes. Nodes that somebody
+        else deletes while we work are ignored, and a Node that somebody
+        creates children under is listed and removed again, so we only
+        return once it is gone.
+
+        If `progress` is passed, it is called after each batch with two
+        arguments, the number of nodes deleted so far and the total.
+
         Arguments:
         - `path`: string
+        - `window`: int - maximum requests in flight
+        - `progress`: callable
 
         Return: None
         Exceptions: None
         """
-        kids = self.ls(path)
-        if kids:
-            for k in kids:
-                self.rm_rf(join(path, k))
-        return self.rm(path)
+        levels = [[path]]
+        while levels[-1]:
+            kids = self.get_children_many(levels[-1], window)
+            levels.append([join(parent, k)
+                           for parent, names in zip(levels[-1], kids) if names
+                           for k in names])
+        levels.pop()
+
+        self.forget_path(path)
+        total = sum(len(level) for level in levels)
+        deleted = 0
+        for level in reversed(levels):
+            for i in range(0, len(level), window):
+                batch = level[i:i + window]
+                results = self._pipeline(self.adelete, batch, window,
+                                         keep=(exceptions.NotEmptyError,))
+                for node, res in zip(batch, results):
+                    if isinstance(res, exceptions.NotEmptyError):
+                        self.rm_rf(node, window) # Written to as we worked
+                deleted += len(batch)
+                if progress is not None:
+                    progress(deleted, total)
+        return
+
+    def _pipeline(self, request, paths, window, keep=()):
+        """
+        Call `request` for each of `paths`, keeping no more than
+        `window` requests in flight at once, and collect the results
+        in order. Missing Nodes give None rather than raising, and
+        errors of the types in `keep` are collected in place of a
+        result.
+
+        Must not be called from a libzookeeper callback, as the replies
+        we wait for are delivered on that thread.
+
+        Arguments:
+        - `request`: callable - one of our a* methods
+        - `paths`: iterable of strings
+        - `window`: int - maximum requests in flight
+        - `keep`: tuple of exception classes
+
+        Return: list
+        Exceptions:
+        - CompletionThreadError: Called from a libzookeeper callback
+        - Whatever error a request fails with, other than NoNodeError
+          or those in `keep`
+        """
+        result._refuse()
+        slots = threading.Semaphore(window)
+
+        def release(res):
+            slots.release()
+
+        pending = []
+        for path in paths:
+            slots.acquire()
+            try:
+                res = request(path)
+            except Exception:
+                slots.release()
+                raise
+            res.rawlink(release)
+            pending.append(res)
+
+        results = []
+        for res in pending:
+            try:
+                results.append(res.get())
+            except exceptions.NoNodeError:
+                results.append(None)
+            except keep as err:
+                results.append(err)
+        return results
+
+    def exists_many(self, paths, window=1000):
+        """
+        Determine whether each of the Nodes at `paths` exists.
+
+        The requests are pipelined, `window` at a time, so this takes
+        roughly one round trip per `window` paths.
+
+        Arguments:
+        - `paths`: iterable of strings
+        - `window`: int - maximum requests in flight
+
+        Return: list of dicts of stats or None, in the order of `paths`
+        Exceptions: None
+        """
+        return self._pipeline(self.aexists, paths, window)
+
+    def get_many(self, paths, window=1000):
+        """
+        Get the value of each of the Nodes at `paths`.
+
+        The requests are pipelined, `window` at a time, so this takes
+        roughly one round trip per `window` paths.
+
+        Arguments:
+        - `paths`: iterable of strings
+        - `window`: int - maximum requests in flight
+
+        Return: list of (Value, Statsdict) tuples, or None where the
+                Node does not exist, in the order of `paths`
+        Exceptions: None
+        """
+        return self._pipeline(self.aget, paths, window)
+
+    def get_children_many(self, paths, window=1000):
+        """
+        List the child nodes of each of `paths`.
+
+        The requests are pipelined, `window` at a time, so this takes
+        roughly one round trip per `window` paths.
+
+        Arguments:
+        - `paths`: iterable of strings
+        - `window`: int - maximum requests in flight
+
+        Return: list of lists of strings, or None where the Node does
+                not exist, in the order of `paths`
+        Exceptions: None
+        """
+        return self._pipeline(self.aget_children, paths, window)
+
+    def transaction(self):
+        """
+        Returns a new Transaction to batch operations on this client.
+
+        Return: Transaction
+        Exceptions: None
+        """
+        return Transaction(self)
 
     """
     Factory methods to return objects that require an instance of the
@@ -241,6 +644,192 @@ class BaseZK(object):
         return queue.Queue(self, path, prefix=prefix)
 
 
+class Transaction(object):
+    """
+    Build up a batch of create/set/delete/check operations, then send
+    them all at once with commit().
+
+    The python bindings for libzookeeper don't expose the server's
+    multi() request, so the batch is NOT atomic: each operation
+    succeeds or fails on its own, and nothing is rolled back. It is
+    pipelined however - the batch costs one round trip rather than
+    one per operation, and ZooKeeper applies the requests from a
+    session in the order they were sent, so later operations see the
+    effects of earlier ones.
+
+    A check() is a barrier: we wait for it before sending anything
+    after it, and if it fails, the rest of the batch is not sent - its
+    results are SkippedErrors. Each check costs a round trip of its
+    own, and another client may still change the Node between our
+    check and the operations that follow it.
+
+    >>> with zk.transaction() as txn:
+    ...     txn.create('/foo')
+    ...     txn.create('/foo/bar', 'Frist')
+    ...     txn.delete('/goo')
+    >>> txn.results
+    ['/foo', '/foo/bar', NoNodeError('The Node /goo does not exist',)]
+    """
+
+    def __init__(self, client):
+        self.zk = client
+        self.operations = []
+        self.results = None
+
+    def __repr__(self):
+        return "<Transaction of {0} operations for {1}>".format(
+            len(self.operations), self.zk.server)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def create(self, path, value='', acl=[OPEN_ACL_UNSAFE], flags=0):
+        """
+        Add the creation of a Node at `path` to the batch.
+
+        Arguments:
+        - `path`: string - new path
+        - `value`: string - value of the Node
+        - `acl`: list - list of Access Control flags
+        - `flags`: int - the ZooKeeper flags (SEQUENCE|EPHEMERAL)
+
+        Return: None
+        Exceptions: None
+        """
+        self.operations.append((self.zk.acreate, (path, value, acl, flags),
+                                False))
+
+    def set(self, path, value, version=-1):
+        """
+        Add setting the value of the Node at `path` to the batch.
+
+        Arguments:
+        - `path`: string
+        - `value`: string
+        - `version`: int - expected version, -1 for any
+
+        Return: None
+        Exceptions: None
+        """
+        self.operations.append((self.zk.aset, (path, value, version), False))
+
+    def delete(self, path, version=-1):
+        """
+        Add deleting the Node at `path` to the batch.
+
+        Arguments:
+        - `path`: string
+        - `version`: int - expected version, -1 for any
+
+        Return: None
+        Exceptions: None
+        """
+        self.operations.append((self.zk.adelete, (path, version), False))
+
+    def check(self, path, version):
+        """
+        Add a check that the Node at `path` is at `version` to the batch.
+        If it fails, nothing after it in the batch is sent.
+
+        Arguments:
+        - `path`: string
+        - `version`: int
+
+        Return: None
+        Exceptions: None
+        """
+        def acheck(path, version):
+            checked = result.AsyncResult()
+
+            def exists(res):
+                if res.exception is not None:
+                    checked.set_exception(res.exception)
+                elif res.value is None:
+                    checked.set_exception(result.error_for(zookeeper.NONODE, path))
+                elif res.value['version'] != version:
+                    checked.set_exception(
+                        result.error_for(zookeeper.BADVERSION, path))
+                else:
+                    checked.set(True)
+
+            self.zk.aexists(path, callback=exists)
+            return checked
+
+        self.operations.append((acheck, (path, version), True))
+
+    def commit(self, timeout=None):
+        """
+        Send every operation in the batch, then wait for them all.
+
+        The result of each operation is stored in `results` in the
+        order the operations were added: the value it returned, or the
+        exception instance it failed with. Operations after a failed
+        check() get a SkippedError.
+
+        If sending an operation raises, `results` holds what happened
+        to the operations already sent, followed by that exception,
+        and the exception is raised once they have all finished.
+
+        Must not be called from a libzookeeper callback, as the replies
+        we wait for are delivered on that thread - nothing is sent.
+
+        Arguments:
+        - `timeout`: float - seconds to wait for each reply
+
+        Return: list
+        Exceptions:
+        - Timeout: A reply did not arrive in time
+        - CompletionThreadError: Called from a libzookeeper callback
+        """
+        result._refuse()
+        self.results = []
+        pending, error = [], None
+        for i, (func, args, barrier) in enumerate(self.operations):
+            try:
+                pending.append(func(*args))
+            except Exception as err:
+                error = err
+                break
+            if barrier:
+                self._collect(pending, timeout)
+                pending = []
+                if isinstance(self.results[-1], Exception):
+                    skipped = len(self.operations) - i - 1
+                    self.results.extend(exceptions.SkippedError(
+                            "An earlier check failed") for n in range(skipped))
+                    return self.results
+        self._collect(pending, timeout)
+        if error is not None:
+            self.results.append(error)
+            raise error
+        return self.results
+
+    def _collect(self, pending, timeout):
+        """
+        Wait for each of the AsyncResults in `pending`, adding what
+        they came to to our results.
+
+        Arguments:
+        - `pending`: list of AsyncResult
+        - `timeout`: float - seconds to wait for each reply
+
+        Return: None
+        Exceptions:
+        - Timeout: A reply did not arrive in time
+        """
+        for res in pending:
+            if not res.wait(timeout):
+                raise exceptions.Timeout("Transaction did not complete in time")
+            if res.exception is not None:
+                self.results.append(res.exception)
+            else:
+                self.results.append(res.value)
+
+
 class ZooKeeper(BaseZK):
     """
     The ZooKeeper client
@@ -288,6 +877,7 @@ class ZooKeeper(BaseZK):
         Return: None
         Exceptions: NoNodeError
         """
+        self.known_paths.discard(path)
         try:
             zookeeper.delete(self._zk, path)
         except zookeeper.NoNodeException:
@@ -319,18 +909,19 @@ class ZooKeeper(BaseZK):
         """
         return zookeeper.get(self._zk, path, watch)
 
-    def get_children(self, path):
+    def get_children(self, path, watch=None):
         """
         Return a list of strings representing the child nodes of `path`
 
         Arguments:
         - `path`: string
+        - `watch`: callable - optional watcher function
 
         Return: list of strings
         Exceptions: NoNodeError
         """
         # !!! Wrap the ZooKeeper exceptions
-        return zookeeper.get_children(self._zk, path, None)
+        return zookeeper.get_children(self._zk, path, watch)
 
     def set(self, path, value):
         """
@@ -346,94 +937,110 @@ class ZooKeeper(BaseZK):
         zookeeper.set(self._zk, path, value)
         return
 
-    def watch(self, path, callback, event):
-        """
-        Begin watching `path` for events of type `event`.
-        When one happens, execute `callback`, with two
-        arguments, the path of the ZooKeeper Even and the event type
-
-        Arguments:
-        - `path`: string - Path to watch
-        - `callback`: callable
-        - `event`: int - a zoop.Event attribute
-
-        Return: None
-        Exceptions: None
-        """
-        self.watcher.spyon(path, callback, event)
-        return
-
 
 class AsyncZooKeeper(BaseZK):
     """
     A ZooKeeper client that uses the Asynchronous
     libzookeeper API.
 
-    Methods can be expected to take an additional
-    callback parameter.
+    Methods return an AsyncResult immediately rather than waiting
+    for the server, and can be expected to take an additional
+    callback parameter, which is called with the AsyncResult once
+    the request completes.
+
+    >>> zk = AsyncZooKeeper('localhost:2181')
+    >>> zk.connect()
+    >>> results = [zk.get(p) for p in ('/foo', '/bar', '/baz')]
+    >>> [r.get() for r in results]
+    [('Foo', {...}), ('Bar', {...}), ('Baz', {...})]
     """
     flavour = 'Async Client'
 
-    def create(self, *a, **kw):
+    def create(self, path, value='', acl=[OPEN_ACL_UNSAFE], flags=0,
+               callback=None):
         """
-        This is a method stub for subclasses to override.
+        Create a new Node at `path` containing `value` on our ZooKeeper instance.
 
-        Return: None
-        Exceptions: NotImplementedError
-        """
-        raise NotImplementedError("!")
+        Arguments:
+        - `path`: string - new path
+        - `value`: string - value of the Node
+        - `acl`: list - list of Access Control flags
+        - `flags`: int - the ZooKeeper flags (SEQUENCE|EPHEMERAL)
+        - `callback`: callable - called with the AsyncResult on completion
 
-    def delete(self, *a, **kw):
+        Return: AsyncResult - resolves to the path actually created
+        Exceptions: None (NodeExistsError and NoNodeError are raised by
+                    the AsyncResult)
         """
-        This is a method stub for subclasses to override.
+        return self.acreate(path, value, acl, flags, callback=callback)
 
-        Return: None
-        Exceptions: NotImplementedError
+    def delete(self, path, version=-1, callback=None):
         """
-        raise NotImplementedError("!")
+        Delete the ZooKeeper Node at `path`
 
-    def exists(self, *a, **kw):
+        Arguments:
+        - `path`: string
+        - `version`: int - expected version, -1 for any
+        - `callback`: callable - called with the AsyncResult on completion
+
+        Return: AsyncResult
+        Exceptions: None (NoNodeError is raised by the AsyncResult)
         """
-        This is a method stub for subclasses to override.
+        return self.adelete(path, version, callback=callback)
 
-        Return: None
-        Exceptions: NotImplementedError
+    def exists(self, path, watch=None, callback=None):
         """
-        raise NotImplementedError("!")
+        Determine whether the ZooKeeper Node at `path` exists
 
-    def get(self, *a, **kw):
+        Arguments:
+        - `path`: string
+        - `watch`: callable - optional watcher function
+        - `callback`: callable - called with the AsyncResult on completion
+
+        Return: AsyncResult - resolves to a dict of stats or None
+        Exceptions: None
         """
-        This is a method stub for subclasses to override.
+        return self.aexists(path, watch, callback=callback)
 
-        Return: None
-        Exceptions: NotImplementedError
+    def get(self, path, watch=None, callback=None):
         """
-        raise NotImplementedError("!")
+        Get the value of the ZooKeeper Node at `path`
 
-    def get_children(self, *a, **kw):
+        Arguments:
+        - `path`: string
+        - `watch`: callable - optional watcher function
+        - `callback`: callable - called with the AsyncResult on completion
+
+        Return: AsyncResult - resolves to a tuple of (Value, Statsdict)
+        Exceptions: None (NoNodeError is raised by the AsyncResult)
         """
-        This is a method stub for subclasses to override.
+        return self.aget(path, watch, callback=callback)
 
-        Return: None
-        Exceptions: NotImplementedError
+    def get_children(self, path, watch=None, callback=None):
         """
+        List the child nodes of `path`
 
-        raise NotImplementedError("!")
+        Arguments:
+        - `path`: string
+        - `watch`: callable - optional watcher function
+        - `callback`: callable - called with the AsyncResult on completion
 
-    def set(self, *a, **kw):
+        Return: AsyncResult - resolves to a list of strings
+        Exceptions: None (NoNodeError is raised by the AsyncResult)
         """
-        This is a method stub for subclasses to override.
+        return self.aget_children(path, watch, callback=callback)
 
-        Return: None
-        Exceptions: NotImplementedError
+    def set(self, path, value, version=-1, callback=None):
         """
-        raise NotImplementedError("!")
+        Set the value of the ZooKeeper Node at `path`
 
-    def watch(self, *a, **kw):
-        """
-        This is a method stub for subclasses to override.
+        Arguments:
+        - `path`: string
+        - `value`: string
+        - `version`: int - expected version, -1 for any
+        - `callback`: callable - called with the AsyncResult on completion
 
-        Return: None
-        Exceptions: NotImplementedError
+        Return: AsyncResult - resolves to the new Statsdict
+        Exceptions: None (NoNodeError is raised by the AsyncResult)
         """
-        raise NotImplementedError("!")
+        return self.aset(path, value, version, callback=callback)
@@ -0,0 +1,300 @@
+# Copyright (c) 2012 David Miller (david@deadpansincerity.com)
+#
+# This file is part of zoop (http://github.com/davidmiller/zoop)
+#
+# zoop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+zoop.election
+
+Leader election on top of the zoop Lock machinery
+"""
+from os.path import basename, join
+import threading
+
+import zookeeper
+
+from zoop import exceptions
+from zoop.lock import BaseLock, _now, _sequence
+
+_UNKNOWN = object()
+
+class Election(BaseLock):
+    """
+    Stand for leadership of NAME, identifying ourselves as IDENTIFIER.
+
+    Candidates queue with ephemeral sequence nodes, each watching only
+    the candidate ahead of it, so when the leader goes exactly one
+    candidate wakes to take over, however many are standing.
+
+    >>> zk = ZooKeeper('localhost:2181')
+    >>> zk.connect()
+    >>> election = Election(zk, 'scheduler', 'host-a')
+    >>> election.run(schedule_everything)
+    >>> election.leader()
+    'host-b'
+    """
+    prefix = 'candidate-'
+    # Candidates in one process each stand in ZooKeeper
+    exclusive = False
+
+    def __init__(self, handle, name, identifier='', root='/zoopelections',
+                 metrics=None):
+        """
+        Store instance vars and ensure that the Node exists
+
+        Arguments:
+        - `handle`: ZooKeeper
+        - `name`: str
+        - `identifier`: str - what leader() reports while we lead
+        - `root`: str
+        - `metrics`: callable - see BaseLock
+
+        Return: None
+        Exceptions: None
+        """
+        super(Election, self).__init__(handle, name, root=root,
+                                       metrics=metrics)
+        self.identifier = identifier
+        self.node = None
+        self.standing = None
+        self.lost = None
+        self._wakeup = None
+        self._elected_at = None
+        self._leader = _UNKNOWN
+        return
+
+    def __repr__(self):
+        return "<Election for {0}>".format(self.path)
+
+    @property
+    def is_leader(self):
+        """
+        Predicate to indicate whether we currently lead.
+
+        Return: bool
+        Exceptions: None
+        """
+        return self.node is not None
+
+    def _create_waitnode(self):
+        """
+        Create our candidate node. It goes when our session does,
+        handing leadership on.
+
+        Return: tuple of strings -
+               * Full path of the child
+               * The nodename of the child
+        Exceptions: None
+        """
+        nodepath = self.zk.create(join(self.path, self.prefix),
+                                  value=self.identifier,
+                                  flags=zookeeper.SEQUENCE | zookeeper.EPHEMERAL)
+        self.standing = nodepath
+        return nodepath, basename(nodepath)
+
+    def _acquire(self, deadline):
+        """
+        Stand until we lead, giving up at DEADLINE, then keep an eye
+        on our node so we know if we lose it.
+
+        Arguments:
+        - `deadline`: float on the _now() clock, or None
+
+        Return: bool - whether we were elected
+        Exceptions: None
+        """
+        self._wakeup = threading.Event()
+        nodepath, keyname = self._create_waitnode()
+        nodepath = self._wait(nodepath, keyname, deadline, cv=self._wakeup)
+        if nodepath is None or nodepath != self.standing:
+            self.standing = None
+            return False
+        self.node = nodepath
+        self._elected_at = _now()
+        self.zk.exists(nodepath, self._watch_node)
+        return True
+
+    def _cancelled(self, nodepath):
+        """
+        Predicate to indicate whether we have resigned while standing
+        with the node at NODEPATH.
+
+        Arguments:
+        - `nodepath`: str
+
+        Return: bool
+        Exceptions: None
+        """
+        return nodepath != self.standing
+
+    def _stepped_down(self):
+        """
+        Record how long we led, if we were leading.
+
+        Return: None
+        Exceptions: None
+        """
+        elected_at, self._elected_at = self._elected_at, None
+        if elected_at is not None:
+            self._record('hold', _now() - elected_at)
+        return
+
+    def _watch_node(self, handle, etype, state, path):
+        """
+        Watcher for our own node while we lead. If it goes without
+        our resigning, tell whoever is interested.
+
+        Arguments:
+        - `handle`: int
+        - `etype`: int
+        - `state`: int
+        - `path`: str
+
+        Return: None
+        Exceptions: None
+        """
+        if etype == zookeeper.SESSION_EVENT:
+            if state != zookeeper.EXPIRED_SESSION_STATE:
+                return
+        elif path != self.node:
+            return # We've resigned
+        elif etype != zookeeper.DELETED_EVENT:
+            self.zk.exists(path, self._watch_node)
+            return
+
+        self.node = self.standing = None
+        self._stepped_down()
+        if self.lost is not None:
+            self.lost()
+
+    def release(self):
+        """
+        Stop leading (or standing), handing leadership on. If we
+        are still standing, elect() returns False.
+
+        Return: True
+        Exceptions: None
+        """
+        self.node = None
+        node, self.standing = self.standing, None
+        if self._wakeup is not None:
+            self._wakeup.set()
+        self._stepped_down()
+        if node is None:
+            return True # We never stood!
+        try:
+            self.zk.delete(node)
+        except (zookeeper.NoNodeException, exceptions.NoNodeError):
+            pass
+        return True
+
+    resign = release
+
+    def elect(self, timeout=None, blocking=True):
+        """
+        Stand until we lead.
+
+        If a timeout parameter is passed, only wait this long to be
+        elected. If blocking is False, don't wait at all.
+
+        Arguments:
+        - `timeout`: int
+        - `blocking`: bool
+
+        Return: bool - whether we were elected
+        Exceptions: None
+        """
+        return self.acquire(timeout=timeout, blocking=blocking)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Block until we lead, then call FUNC with ARGS and KWARGS,
+        resigning once it returns. If we resign before we are
+        elected, FUNC is never called.
+
+        Arguments:
+        - `func`: callable
+
+        Return: Whatever FUNC returns, or None if we weren't elected
+        Exceptions: Whatever FUNC raises
+        """
+        if not self.elect():
+            return None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.resign()
+
+    def volunteer(self, elected, lost=None):
+        """
+        Stand for election in the background. Once we lead, call
+        ELECTED; if we then lose our node without resigning (say our
+        session expired) call LOST.
+
+        Both are called without arguments: ELECTED on a daemon
+        thread, LOST on libzookeeper's watcher thread, so it should
+        return quickly.
+
+        Arguments:
+        - `elected`: callable
+        - `lost`: callable
+
+        Return: threading.Thread - standing for election
+        Exceptions: None
+        """
+        self.lost = lost
+
+        def stand():
+            if self.elect():
+                elected()
+
+        thread = threading.Thread(target=stand)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _forget_leader(self, handle, etype, state, path):
+        """
+        Watcher for the leader's node - whatever happened to it, we
+        need to look again.
+
+        Return: None
+        Exceptions: None
+        """
+        self._leader = _UNKNOWN
+
+    def leader(self):
+        """
+        The identifier of the current leader, or None if nobody
+        is standing.
+
+        We remember the answer until the leader's node changes or
+        goes, so while leadership is stable this costs nothing.
+
+        Return: str or None
+        Exceptions: None
+        """
+        leader = self._leader
+        while leader is _UNKNOWN:
+            kids = self.zk.get_children(self.path)
+            if not kids:
+                return None
+            head = join(self.path, min(kids, key=_sequence))
+            try:
+                leader = self.zk.get(head, self._forget_leader)[0]
+            except (zookeeper.NoNodeException, exceptions.NoNodeError):
+                continue # Already gone - who's next?
+            self._leader = leader
+        return leader
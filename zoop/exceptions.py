@@ -21,3 +21,18 @@ class NoNodeError(Error):
 
 class Empty(Error):
     "The item in question is empty."
+
+class NotEmptyError(Error):
+    "This Node has children"
+
+class BadVersionError(Error):
+    "The Node is not at the version we expected"
+
+class Timeout(Error):
+    "We waited, but it didn't happen in time."
+
+class SkippedError(Error):
+    "An earlier check in the Transaction failed, so this was never sent"
+
+class CompletionThreadError(Error):
+    "We'd wait on libzookeeper's completion thread for a reply only it delivers"
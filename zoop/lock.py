@@ -20,28 +20,135 @@ zoop.lock
 
 A distributed Lock on top of ZooKeeper
 """
-from os.path import join
+from os.path import basename, join
 import threading
 import time
+import weakref
 
 import zookeeper
 
 from zoop import exceptions
 
+# Timeouts shouldn't stretch or shrink when the wall clock is adjusted
+_now = getattr(time, 'monotonic', time.time)
+
+def _sequence(node):
+    """
+    The sequence number ZooKeeper appended to NODE.
+
+    Arguments:
+    - `node`: str
+
+    Return: str
+    Exceptions: None
+    """
+    return node[node.rfind('-') + 1:]
+
+def _ahead(nodes, node):
+    """
+    The Nodes in NODES queued ahead of NODE, in the order listed.
+    One pass with no sort - whoever is at the front only needs to
+    find that nobody has a lower sequence number.
+
+    Arguments:
+    - `nodes`: list of str
+    - `node`: str
+
+    Return: list of str
+    Exceptions: None
+    """
+    seq = _sequence(node)
+    return [n for n in nodes if _sequence(n) < seq]
+
+class _Arbiter(object):
+    """
+    Lets one thread in this process at a time wait for (or hold) an
+    exclusive Lock in ZooKeeper. The rest queue here, so ZooKeeper
+    sees one wait node per process rather than one per thread.
+
+    A Condition rather than a bare threading.Lock, as the latter
+    can't time out on Python 2.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.held = False
+
+    def acquire(self, deadline=None):
+        """
+        Wait for our turn, giving up at DEADLINE.
+
+        Arguments:
+        - `deadline`: float on the _now() clock, or None
+
+        Return: bool - whether it is our turn
+        Exceptions: None
+        """
+        with self.cond:
+            while self.held:
+                if deadline is None:
+                    self.cond.wait()
+                    continue
+                remaining = deadline - _now()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            self.held = True
+            return True
+
+    def release(self):
+        """
+        Let the next thread have its turn.
+
+        Return: None
+        Exceptions: None
+        """
+        with self.cond:
+            self.held = False
+            self.cond.notify()
+
+# Arbiters are per session, as separate sessions hold separate Locks
+_arbiters = weakref.WeakKeyDictionary()
+_arbiters_lock = threading.Lock()
+
+def _arbiter(handle, key):
+    """
+    The _Arbiter that threads using HANDLE share for KEY.
+
+    Arguments:
+    - `handle`: ZooKeeper
+    - `key`: hashable
+
+    Return: _Arbiter
+    Exceptions: None
+    """
+    with _arbiters_lock:
+        arbiters = _arbiters.setdefault(handle, {})
+        if key not in arbiters:
+            arbiters[key] = _Arbiter()
+        return arbiters[key]
+
 class BaseLock(object):
     """
     A base for all subsequent locks to inherit from.
     """
     prefix = 'baselock-'
+    # Holders exclude each other, so local threads can take turns
+    # before queueing in ZooKeeper.
+    exclusive = True
 
-    def __init__(self, handle, name, root='/zooplocks'):
+    def __init__(self, handle, name, root='/zooplocks', metrics=None):
         """
         Store instance vars and ensure that the Node exists
 
+        If passed, METRICS is called as metrics(lock, event, value)
+        as we wait for and hold the Lock - see LockStats.
+
         Arguments:
         - `handle`: ZooKeeper
         - `name`: str
         - `root`: str
+        - `metrics`: callable
 
         Return: None
         Exceptions: None
@@ -50,14 +157,15 @@ class BaseLock(object):
         self.name = name
         self.root = root
         self.path = join(root, name)
+        self.metrics = metrics
         self.tlocal = threading.local()
         self.tlocal.revoked = []
         self.tlocal.locking = None
         self.tlocal.acquired = False
-        if not self.zk.exists(root):
-            self.zk.create(root)
-        if not self.zk.exists(self.path):
-            self.zk.create(self.path)
+        self.arbiter = None
+        if self.exclusive:
+            self.arbiter = _arbiter(handle, (self.path, self.prefix))
+        self.zk.mkdirp(self.path)
         return
 
     def __repr__(self):
@@ -69,6 +177,20 @@ class BaseLock(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.release()
 
+    def _record(self, event, value):
+        """
+        Tell our metrics sink, if we have one, about EVENT.
+
+        Arguments:
+        - `event`: str - one of LockStats.events
+        - `value`: number
+
+        Return: None
+        Exceptions: None
+        """
+        if self.metrics is not None:
+            self.metrics(self, event, value)
+
     @property
     def revoked(self):
         """
@@ -80,63 +202,153 @@ class BaseLock(object):
         """
         return bool(self.tlocal.revoked)
 
-    def acquire(self, timeout=None):
+    def acquire(self, timeout=None, blocking=True):
         """
         Attempt to acquire the lock.
 
         If a timeout parameter is passed, only wait this long
-        for acquisition.
+        for acquisition. If blocking is False, don't wait at all.
+
+        Threads sharing our ZooKeeper session take turns locally
+        before queueing for an exclusive Lock.
 
         Arguments:
         - `timeout`: int
+        - `blocking`: bool
 
         Return: bool - whether we acquired the Lock or not
         Exceptions: None
         """
-        # This implementation is based upon the Mozilla Services
-        # ztools lock at https://github.com/mozilla-services/zktools
-        # with some additional encapsulation and error handling added.
         self.tlocal.revoked = []
+        if not blocking:
+            timeout = 0
+        tstart = _now()
+        deadline = None
+        if timeout is not None:
+            deadline = tstart + timeout
+
+        acquired = False
+        if self.arbiter is None:
+            acquired = self._acquire(deadline)
+        elif self.arbiter.acquire(deadline):
+            try:
+                acquired = self._acquire(deadline)
+            finally:
+                if not acquired:
+                    self.arbiter.release()
+        else:
+            self._record('timeout', 1)
+
+        if not acquired:
+            return False
+        self.tlocal.acquired_at = _now()
+        self._record('acquire', self.tlocal.acquired_at - tstart)
+        return True
+
+    def _acquire(self, deadline):
+        """
+        Queue for the lock in ZooKeeper, giving up at DEADLINE.
 
+        Arguments:
+        - `deadline`: float on the _now() clock, or None
+
+        Return: bool - whether we acquired the Lock or not
+        Exceptions: None
+        """
         nodepath, keyname = self._create_waitnode()
-        cv = threading.Event()
+        nodepath = self._wait(nodepath, keyname, deadline)
+        if nodepath is None:
+            return False
+        self.tlocal.lock_node = nodepath
+        return True
+
+    def _wait(self, nodepath, keyname, deadline, blockers=None, cv=None):
+        """
+        Wait for our wait node at NODEPATH to reach the front of the
+        queue, giving up (and removing it) at DEADLINE, or as soon as
+        we are _cancelled().
+
+        If we already know which nodes are BLOCKING us, we needn't
+        list them again. Pass an Event as CV to be able to wake us.
+
+        Arguments:
+        - `nodepath`: str
+        - `keyname`: str - the nodename of NODEPATH
+        - `deadline`: float on the _now() clock, or None
+        - `blockers`: list of strings
+        - `cv`: threading.Event
+
+        Return: str - the path of our wait node, which may have been
+                created again - or None if we gave up
+        Exceptions: None
+        """
+        # This implementation is based upon the Mozilla Services
+        # ztools lock at https://github.com/mozilla-services/zktools
+        # with some additional encapsulation and error handling added.
+        if cv is None:
+            cv = threading.Event()
 
         def lockwatch(handle, etype, state, path):
             cv.set()
 
-        tstart = time.time()
-        frist = True
-        while not self.tlocal.acquired:
+        listed = blockers is not None
+        while True:
             cv.clear()
+            if self._cancelled(nodepath):
+                return None
+
+            if not blockers:
+                # Sequence numbers only grow, so once we have listed the
+                # nodes ahead of us nobody new can join them - we only
+                # need to list again when all of them have gone.
+                kids = self.zk.get_children(self.path)
+
+                if len(kids) == 0 or not keyname in kids:
+                    # Only really for connection issues
+                    nodepath, keyname = self._create_waitnode()
+                    self._record('recreate', 1)
+                    continue
+
+                acquired, blockers = self.has_lock(keyname, kids)
+                if not listed:
+                    listed = True
+                    self._record('depth', len(blockers or ()))
+                if acquired:
+                    break
+
+            if not self._watch_blockers(blockers, lockwatch):
+                continue # Already free
 
-            if not frist and timeout is not None and time.time() - tstart > timeout:
-                try:
-                    self.zk.delete(nodepath)
-                except exceptions.NoNodeError:
-                    pass
-                return False
-            frist = False
-
-            kids = self.zk.get_children(self.path)
-
-            if len(kids) == 0 or not keyname in kids:
-                # Only really for connection issues
-                nodepath, keyname = self._create_waitnode()
-                continue
+            # Nothing to ask ZooKeeper until our watch fires
+            if deadline is None:
+                cv.wait()
+            else:
+                remaining = deadline - _now()
+                if remaining > 0:
+                    cv.wait(remaining)
+                if not cv.is_set():
+                    try:
+                        self.zk.delete(nodepath)
+                    except exceptions.NoNodeError:
+                        pass
+                    self._record('timeout', 1)
+                    return None
+            self._record('wakeups', 1)
 
-            self.acquired, blocking = self.has_lock(keyname, kids)
-            if self.acquired:
-                break
+        return nodepath
 
-            last_blocker = join(self.path, blocking[-1])
-            if not self.zk.exists(last_blocker, lockwatch):
-                continue # Already free
+    def _cancelled(self, nodepath):
+        """
+        Predicate to indicate whether we should stop waiting with
+        the wait node at NODEPATH. Locks only ever time out.
 
-            if timeout is not None:
-                cv.wait(timeout - (time.time() - tstart))
+        Arguments:
+        - `nodepath`: str
 
-        self.tlocal.lock_node = nodepath
-        return True
+        Return: bool
+        Exceptions: None
+        """
+        return False
 
     def _create_waitnode(self):
         """
@@ -176,6 +388,26 @@ class BaseLock(object):
         keyname = nodepath.split('/')[-1]
         return nodepath, keyname
 
+    def _watch_blockers(self, blocking, watch):
+        """
+        Set WATCH to fire when we may have stopped being blocked,
+        dropping from BLOCKING any Nodes we find have already gone.
+
+        We watch only our immediate predecessor, so that each release
+        wakes one waiter rather than the whole herd.
+
+        Arguments:
+        - `blocking`: list of strings - the nodes ahead of ours
+        - `watch`: callable - watcher function
+
+        Return: bool - whether there is anything to wait for
+        Exceptions: None
+        """
+        if self.zk.exists(join(self.path, blocking[-1]), watch):
+            return True
+        blocking.pop()
+        return False
+
     def has_lock(self, keypath, locknodes):
         """
         Determine whether the current Thread has the Lock.
@@ -195,11 +427,11 @@ class BaseLock(object):
                 or None.
         Exceptions: None
         """
-        locknodes.sort(key=lambda val: val[val.rfind('-') + 1:])
-
-        if keypath == locknodes[0]:
+        ahead = _ahead(locknodes, keypath)
+        if not ahead:
             return True, None
-        return False, locknodes[:locknodes.index(keypath)]
+        ahead.sort(key=_sequence)
+        return False, ahead
 
     def release(self):
         """
@@ -211,10 +443,21 @@ class BaseLock(object):
         self.tlocal.revoked = []
         self.acquired = False
         try:
-            self.zk.delete(self.tlocal.lock_node)
-            del self.tlocal.lock_node
-        except (zookeeper.NoNodeException, AttributeError):
-            pass # We never had the Lock!
+            nodepath = self.tlocal.lock_node
+        except AttributeError:
+            return True # We never had the Lock!
+        del self.tlocal.lock_node
+        acquired_at = getattr(self.tlocal, 'acquired_at', None)
+        if acquired_at is not None:
+            self.tlocal.acquired_at = None
+            self._record('hold', _now() - acquired_at)
+        try:
+            self.zk.delete(nodepath)
+        except (zookeeper.NoNodeException, exceptions.NoNodeError):
+            pass
+        finally:
+            if self.arbiter is not None:
+                self.arbiter.release()
         return True
 
 class Lock(BaseLock):
@@ -232,3 +475,453 @@ class Lock(BaseLock):
     []
     """
     prefix = 'lock-'
+
+def _leases(node):
+    """
+    The number of leases a Semaphore NODE holds.
+
+    Arguments:
+    - `node`: str
+
+    Return: int
+    Exceptions: None
+    """
+    return int(node.split('-')[-2])
+
+class Semaphore(BaseLock):
+    """
+    Let up to MAX_LEASES holders in at once.
+
+    Each wait node records how many leases it wants in its name, so
+    we can tell whether we fit from one listing.
+
+    >>> zk = ZooKeeper('localhost:2181')
+    >>> zk.connect()
+    >>> sem = Semaphore(zk, 'database', 10)
+    >>> with sem:
+    ...     print zk.get_children('/zooplocks/database')
+    ...
+    ['lease-1-0000001']
+    """
+    exclusive = False
+
+    def __init__(self, handle, name, max_leases, root='/zooplocks',
+                 metrics=None):
+        """
+        Store instance vars and ensure that the Node exists
+
+        Arguments:
+        - `handle`: ZooKeeper
+        - `name`: str
+        - `max_leases`: int
+        - `root`: str
+        - `metrics`: callable - see BaseLock
+
+        Return: None
+        Exceptions: None
+        """
+        super(Semaphore, self).__init__(handle, name, root=root,
+                                        metrics=metrics)
+        self.max_leases = max_leases
+        return
+
+    def __repr__(self):
+        return "<Semaphore({0}) for {1}>".format(self.max_leases, self.path)
+
+    @property
+    def prefix(self):
+        return 'lease-{0}-'.format(getattr(self.tlocal, 'leases', 1))
+
+    def acquire(self, timeout=None, blocking=True, leases=1):
+        """
+        Attempt to acquire LEASES leases.
+
+        If a timeout parameter is passed, only wait this long
+        for acquisition. If blocking is False, don't wait at all.
+
+        Arguments:
+        - `timeout`: int
+        - `blocking`: bool
+        - `leases`: int
+
+        Return: bool - whether we acquired the leases or not
+        Exceptions:
+        - ValueError: We asked for more leases than there are
+        """
+        if not 0 < leases <= self.max_leases:
+            raise ValueError("Can't take {0} of {1} leases".format(
+                    leases, self.max_leases))
+        self.tlocal.leases = leases
+        return super(Semaphore, self).acquire(timeout=timeout,
+                                              blocking=blocking)
+
+    def _watch_blockers(self, blocking, watch):
+        """
+        Any holder ahead of us might be the one whose leases we need,
+        so watch the whole listing, dropping from BLOCKING any Nodes
+        that have gone.
+
+        Arguments:
+        - `blocking`: list of strings - the nodes ahead of ours
+        - `watch`: callable - watcher function
+
+        Return: bool - whether there is anything to wait for
+        Exceptions: None
+        """
+        kids = set(self.zk.get_children(self.path, watch))
+        blocking[:] = [n for n in blocking if n in kids]
+        taken = sum(_leases(n) for n in blocking)
+        if taken + self.tlocal.leases <= self.max_leases:
+            del blocking[:]
+            return False
+        return True
+
+    def has_lock(self, keypath, locknodes):
+        """
+        Determine whether the current Thread has its leases.
+        We do if they fit alongside everybody ahead of us.
+
+        Arguments:
+        - `keypath`: string - this thread's node
+        - `locknodes`: list of strings all wait nodes
+
+        Return: tuple of (bool, list or None)
+        Exceptions: None
+        """
+        ahead = _ahead(locknodes, keypath)
+        taken = sum(_leases(n) for n in ahead)
+        if taken + _leases(keypath) <= self.max_leases:
+            return True, None
+        ahead.sort(key=_sequence)
+        return False, ahead
+
+class ReadLock(BaseLock):
+    """
+    The shared half of a ReadWriteLock.
+
+    Readers only wait for writers that queued before them, so any
+    number of readers may hold the Lock together.
+    """
+    prefix = 'read-'
+    exclusive = False
+
+    def has_lock(self, keypath, locknodes):
+        """
+        Determine whether the current Thread has the Lock.
+        Only write- nodes ahead of ours block us.
+
+        Arguments:
+        - `keypath`: string - this thread's node
+        - `locknodes`: list of strings all wait nodes
+
+        Return: tuple of (bool, list or None)
+        Exceptions: None
+        """
+        blocking = [n for n in _ahead(locknodes, keypath)
+                    if n.startswith(WriteLock.prefix)]
+        if not blocking:
+            return True, None
+        blocking.sort(key=_sequence)
+        return False, blocking
+
+class WriteLock(BaseLock):
+    """
+    The exclusive half of a ReadWriteLock.
+
+    Writers wait for every node ahead of them, reader or writer.
+    """
+    prefix = 'write-'
+
+class ReadWriteLock(object):
+    """
+    Many readers or one writer.
+
+    Both halves queue under the same Node, so readers and writers
+    are served in the order they arrived.
+
+    >>> zk = ZooKeeper('localhost:2181')
+    >>> zk.connect()
+    >>> rw = ReadWriteLock(zk, 'config')
+    >>> with rw.read:
+    ...     print zk.get_children('/zooplocks/config')
+    ...
+    ['read-0000001']
+    """
+
+    def __init__(self, handle, name, root='/zooplocks', metrics=None):
+        """
+        Create the read and write halves of our Lock.
+
+        Arguments:
+        - `handle`: ZooKeeper
+        - `name`: str
+        - `root`: str
+        - `metrics`: callable - see BaseLock
+
+        Return: None
+        Exceptions: None
+        """
+        self.read = ReadLock(handle, name, root=root, metrics=metrics)
+        self.write = WriteLock(handle, name, root=root, metrics=metrics)
+        self.path = self.read.path
+        return
+
+    def __repr__(self):
+        return "<ReadWriteLock for {0}>".format(self.path)
+
+class LockStats(object):
+    """
+    A metrics sink for Locks that keeps running totals per Lock path,
+    and can render them for a Prometheus scrape.
+
+    >>> stats = LockStats()
+    >>> lk = Lock(zk, 'mylock', metrics=stats)
+    >>> with lk:
+    ...     pass
+    ...
+    >>> stats.stats['/zooplocks/mylock']['acquire']
+    {'count': 1, 'sum': 0.0042, 'max': 0.0042}
+    """
+    # event: (metric name, type, help)
+    events = {
+        'acquire': ('zoop_lock_acquire_seconds', 'summary',
+                    'Time from asking for a Lock to holding it'),
+        'hold': ('zoop_lock_hold_seconds', 'summary',
+                 'Time a Lock was held for'),
+        'depth': ('zoop_lock_queue_depth', 'summary',
+                  'Wait nodes ahead of ours when we queued'),
+        'wakeups': ('zoop_lock_wakeups_total', 'counter',
+                    'Times a watch woke a waiter'),
+        'recreate': ('zoop_lock_recreated_total', 'counter',
+                     'Wait nodes that went missing and were created again'),
+        'timeout': ('zoop_lock_timeouts_total', 'counter',
+                    'Acquires that gave up'),
+        }
+
+    def __init__(self):
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<LockStats for {0} locks>".format(len(self.stats))
+
+    def __call__(self, lock, event, value):
+        """
+        Add VALUE to the totals for EVENT on LOCK.
+
+        Arguments:
+        - `lock`: BaseLock
+        - `event`: str
+        - `value`: number
+
+        Return: None
+        Exceptions: None
+        """
+        with self._lock:
+            events = self.stats.setdefault(lock.path, {})
+            total = events.setdefault(event, {'count': 0, 'sum': 0, 'max': 0})
+            total['count'] += 1
+            total['sum'] += value
+            total['max'] = max(total['max'], value)
+
+    def prometheus(self):
+        """
+        Render our totals in the Prometheus text exposition format.
+
+        Return: str
+        Exceptions: None
+        """
+        with self._lock:
+            stats = dict((path, dict((e, dict(t)) for e, t in events.items()))
+                         for path, events in self.stats.items())
+        lines = []
+        for event in sorted(self.events):
+            metric, kind, help = self.events[event]
+            lines.append('# HELP {0} {1}'.format(metric, help))
+            lines.append('# TYPE {0} {1}'.format(metric, kind))
+            for path in sorted(stats):
+                if event not in stats[path]:
+                    continue
+                total = stats[path][event]
+                label = '{{lock="{0}"}}'.format(path)
+                if kind == 'counter':
+                    lines.append('{0}{1} {2}'.format(metric, label, total['sum']))
+                    continue
+                lines.append('{0}_sum{1} {2}'.format(metric, label, total['sum']))
+                lines.append('{0}_count{1} {2}'.format(metric, label, total['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class MultiLock(object):
+    """
+    Hold several Locks at once.
+
+    All our wait nodes are created in one batch, and every queue is
+    listed in one more, so when nobody is in the way we hold them all
+    in a couple of round trips rather than a couple per Lock.
+
+    Holding our place in every queue while we wait could deadlock
+    against another MultiLock, so when we find ourselves blocked we
+    keep our places only up to that Lock (in the canonical, sorted
+    order), queueing again for the rest once we hold it.
+
+    >>> zk = ZooKeeper('localhost:2181')
+    >>> zk.connect()
+    >>> with MultiLock(zk, ['accounts', 'ledger']):
+    ...     print zk.get_children('/zooplocks/ledger')
+    ...
+    ['lock-0000001']
+    """
+
+    def __init__(self, handle, names, root='/zooplocks', metrics=None):
+        """
+        Create the Locks we are to hold, in canonical order.
+
+        Arguments:
+        - `handle`: ZooKeeper
+        - `names`: iterable of str
+        - `root`: str
+        - `metrics`: callable - see BaseLock
+
+        Return: None
+        Exceptions: None
+        """
+        self.zk = handle
+        self.locks = [Lock(handle, name, root=root, metrics=metrics)
+                      for name in sorted(set(names))]
+        self.tlocal = threading.local()
+        return
+
+    def __repr__(self):
+        return "<MultiLock for {0}>".format(
+            ', '.join(lk.path for lk in self.locks))
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def _enqueue(self, locks):
+        """
+        Create a wait node for each of LOCKS in one batch.
+
+        Arguments:
+        - `locks`: list of Lock
+
+        Return: list of str - the paths of our wait nodes
+        Exceptions: Whatever a create failed with
+        """
+        txn = self.zk.transaction()
+        for lk in locks:
+            txn.create(join(lk.path, lk.prefix), value="0",
+                       flags=zookeeper.SEQUENCE)
+        nodes = txn.commit()
+        failed = [n for n in nodes if isinstance(n, Exception)]
+        if failed:
+            self._dequeue([n for n in nodes if not isinstance(n, Exception)])
+            raise failed[0]
+        return nodes
+
+    def _dequeue(self, nodes):
+        """
+        Remove our wait NODES in one batch.
+
+        Arguments:
+        - `nodes`: list of str
+
+        Return: None
+        Exceptions: None
+        """
+        if not nodes:
+            return
+        txn = self.zk.transaction()
+        for node in nodes:
+            txn.delete(node)
+        txn.commit()
+
+    def acquire(self, timeout=None, blocking=True):
+        """
+        Attempt to acquire every one of our Locks.
+
+        If a timeout parameter is passed, only wait this long
+        for acquisition. If blocking is False, don't wait at all.
+
+        Arguments:
+        - `timeout`: int
+        - `blocking`: bool
+
+        Return: bool - whether we acquired all the Locks or not
+        Exceptions: None
+        """
+        if not blocking:
+            timeout = 0
+        tstart = _now()
+        deadline = None
+        if timeout is not None:
+            deadline = tstart + timeout
+
+        held = []
+        queued = set() # Every wait node of ours that is still there
+        pending = self.locks
+        try:
+            while pending:
+                nodes = self._enqueue(pending)
+                queued.update(nodes)
+                listings = self.zk.get_children_many(
+                    [lk.path for lk in pending])
+
+                for i, lk in enumerate(pending):
+                    keyname = basename(nodes[i])
+                    listing = listings[i] or []
+                    if keyname not in listing:
+                        blockers = None # Lost our place - _wait() queues again
+                        break
+                    acquired, blockers = lk.has_lock(keyname, listing)
+                    lk._record('depth', len(blockers or ()))
+                    if not acquired:
+                        break
+                    held.append(nodes[i])
+                else:
+                    break
+
+                # Keep our place only up to the Lock we're blocked on
+                self._dequeue(nodes[i + 1:])
+                queued.difference_update(nodes[i + 1:])
+                node = lk._wait(nodes[i], keyname, deadline, blockers)
+                queued.discard(nodes[i])
+                if node is None: # _wait() counted the timeout for lk
+                    self._dequeue(held)
+                    for other in self.locks:
+                        if other is not lk:
+                            other._record('timeout', 1)
+                    return False
+                queued.add(node)
+                held.append(node)
+                pending = pending[i + 1:]
+        except Exception:
+            self._dequeue(sorted(queued))
+            raise
+
+        self.tlocal.nodes = held
+        self.tlocal.acquired_at = _now()
+        for lk in self.locks:
+            lk._record('acquire', self.tlocal.acquired_at - tstart)
+        return True
+
+    def release(self):
+        """
+        Release all our Locks in one batch.
+
+        Return: True
+        Exceptions: None
+        """
+        nodes = getattr(self.tlocal, 'nodes', None)
+        if nodes is None:
+            return True # We never had the Locks!
+        self.tlocal.nodes = None
+        self._dequeue(nodes)
+        held = _now() - self.tlocal.acquired_at
+        for lk in self.locks:
+            lk._record('hold', held)
+        return True
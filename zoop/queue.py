@@ -28,7 +28,7 @@ import os
 
 import zookeeper
 
-from zoop import enums, exceptions, lock
+from zoop import enums, exceptions, lock, result
 
 class Queue(object):
     """
@@ -59,8 +59,7 @@ class Queue(object):
         self.zk = client
         self.path = path
         self.prefix = prefix
-        if not self.zk.exists(path):
-            self.zk.create(path)
+        self.zk.mkdirp(path)
         name = os.path.basename(path) + '-lock'
         self.lock = lock.Lock(client, name, os.path.dirname(path))
 
@@ -86,22 +85,106 @@ class Queue(object):
         Exceptions: None
         """
         kids = self.zk.get_children(self.path)
-        for k in kids:
-            self.zk.delete(os.path.join(self.path, k))
+        with self.zk.transaction() as txn:
+            for k in kids:
+                txn.delete(os.path.join(self.path, k))
         return
 
     def get(self):
         """
         Return the next item from the Queue
 
-        Return: string data item
+        The read and the delete of an item are pipelined - whoever
+        deletes the item is the one who gets it, so two consumers
+        never both get the same item.
+
+        Called from a watch callback on libzookeeper's completion
+        thread, where we can't wait for pipelined replies, we make
+        the requests one at a time with synchronous calls instead.
+
+        Return: tuple of (string data item, Statsdict)
+        Exceptions: Empty
+        """
+        if result.on_completion_thread():
+            return self._get_inline()
+        for frist in self.sorted(): # This can raise Empty()
+            ipath = os.path.join(self.path, frist)
+            item = self.zk.aget(ipath)
+            claim = self.zk.adelete(ipath)
+            try:
+                claim.get()
+            except exceptions.NoNodeError:
+                continue # Another consumer got there first
+            return item.get()
+        raise exceptions.Empty("Queue at {0} has no items".format(self.path))
+
+    def _get_inline(self):
+        """
+        get() with synchronous calls, for the completion thread.
+
+        Return: tuple of (string data item, Statsdict)
         Exceptions: Empty
         """
-        frist = self.sorted()[0] # This can raise Empty()
-        ipath = os.path.join(self.path, frist)
-        item = self.zk.get(ipath)
-        self.zk.delete(ipath)
-        return item
+        for frist in self.sorted(): # This can raise Empty()
+            ipath = os.path.join(self.path, frist)
+            try:
+                item = self.zk.get(ipath)
+                self.zk.delete(ipath)
+            except (zookeeper.NoNodeException, exceptions.NoNodeError):
+                continue # Another consumer got there first
+            return item
+        raise exceptions.Empty("Queue at {0} has no items".format(self.path))
+
+    def get_many(self, max_items, window=1000):
+        """
+        Return up to `max_items` items from the front of the Queue.
+
+        One sorted listing serves the whole batch, and the reads and
+        deletes are pipelined, `window` items at a time. As with get(),
+        items another consumer deletes first are skipped.
+
+        If any other read or delete fails, we still collect the rest
+        of its window before raising, so the items we have already
+        taken off the Queue are not lost - they are the `items`
+        attribute of the exception.
+
+        Arguments:
+        - `max_items`: int
+        - `window`: int - maximum items in flight
+
+        Return: list of string data items
+        Exceptions:
+        - Empty
+        - Whatever a read or delete failed with
+        """
+        if max_items <= 0:
+            return []
+        names = self.sorted() # This can raise Empty()
+        items = []
+        start = 0
+        error = None
+        while error is None and len(items) < max_items and start < len(names):
+            batch = names[start:start + min(window, max_items - len(items))]
+            start += len(batch)
+            pending = []
+            for name in batch:
+                ipath = os.path.join(self.path, name)
+                pending.append((self.zk.aget(ipath), self.zk.adelete(ipath)))
+            for item, claim in pending:
+                try:
+                    claim.get()
+                    items.append(item.get())
+                except exceptions.NoNodeError:
+                    continue # Another consumer got there first
+                except Exception as err:
+                    if error is None:
+                        error = err
+        if error is not None:
+            error.items = items
+            raise error
+        if not items:
+            raise exceptions.Empty("Queue at {0} has no items".format(self.path))
+        return items
 
     def put(self, item):
         """
@@ -117,6 +200,33 @@ class Queue(object):
                               value=item,
                               flags=zookeeper.SEQUENCE)
 
+    def put_many(self, items, window=1000):
+        """
+        Put each of `items` at the end of the queue, in order.
+
+        The creates are pipelined, `window` at a time.
+
+        Arguments:
+        - `items`: iterable of strings - data to add
+        - `window`: int - maximum creates in flight
+
+        Return: list of the paths of the new items
+        Exceptions: Whatever a create failed with - the other items
+                    are still added
+        """
+        items = list(items)
+        paths = []
+        for i in range(0, len(items), window):
+            with self.zk.transaction() as txn:
+                for item in items[i:i + window]:
+                    txn.create(os.path.join(self.path, self.prefix),
+                               value=item, flags=zookeeper.SEQUENCE)
+            paths.extend(txn.results)
+        for path in paths:
+            if isinstance(path, Exception):
+                raise path
+        return paths
+
     def qsize(self):
         """
         Return the size of the queue.
@@ -167,18 +277,16 @@ class Queue(object):
         >>> myq.put("Frist")
         Watchit got ['q-00000001'] !
         """
-        def watcher(event, path):
+        def watcher(path, event, kids):
             """
-            Watch for items added to the Queue, then remove the latest and
-            run the callback on it.
+            Watch for items added to the Queue, and run the callback
+            on the listing the watch was re-armed with.
             """
-            try:
-                kids = self.sorted()
-            except exceptions.Empty:
+            if not kids:
                 return # Deleted event
-            return callback(kids)
+            return callback(sorted(kids))
 
-        self.zk.watch(self.path, watcher, enums.Event.Child)
+        self.zk.watch(self.path, watcher, enums.Event.Child, payload=True)
         return
 
     def watchitem(self, callback):
@@ -191,6 +299,9 @@ class Queue(object):
         argument, the data for the item that has just been
         added to the queue.
 
+        Without an executor, the callback runs on libzookeeper's
+        completion thread, so it must not block on AsyncResults.
+
         Arguments:
         - `callback`: callable
 
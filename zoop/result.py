@@ -0,0 +1,267 @@
+# Copyright (c) 2012 David Miller (david@deadpansincerity.com)
+#
+# This file is part of zoop (http://github.com/davidmiller/zoop)
+#
+# zoop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+zoop.result
+
+Handles for the results of asynchronous ZooKeeper operations.
+
+libzookeeper runs completion callbacks on its own thread, so an
+AsyncResult is the thing that calling code holds on to (and blocks
+on, if it likes) while the request is in flight.
+
+That thread delivers every reply, so blocking on one from a completion
+or watch callback would never return - we raise CompletionThreadError
+instead. Synchronous calls are fine there, as libzookeeper completes
+those on its IO thread.
+
+>>> res = zk.aget('/zookeeper')
+>>> res.get(timeout=5)
+('', {'version': 0, ...})
+"""
+import functools
+import threading
+
+import zookeeper
+
+from zoop import exceptions
+
+_local = threading.local()
+
+_ERRORS = {
+    zookeeper.NONODE: (exceptions.NoNodeError, "The Node {0} does not exist"),
+    zookeeper.NODEEXISTS: (exceptions.NodeExistsError,
+                           "Can't create {0} as it already exists"),
+    zookeeper.NOTEMPTY: (exceptions.NotEmptyError, "The Node {0} has children"),
+    zookeeper.BADVERSION: (exceptions.BadVersionError,
+                           "Version mismatch for the Node {0}"),
+    zookeeper.CONNECTIONLOSS: (exceptions.LostConnectionError,
+                               "Lost connection while operating on {0}"),
+    zookeeper.SESSIONEXPIRED: (exceptions.LostConnectionError,
+                               "Session expired while operating on {0}"),
+    }
+
+def error_for(rc, path):
+    """
+    Given a libzookeeper return code, build the zoop exception that
+    we would have raised for the synchronous version of the call.
+
+    Arguments:
+    - `rc`: int - return code passed to a completion callback
+    - `path`: string - the Node the request concerned
+
+    Return: zoop.exceptions.Error
+    Exceptions: None
+    """
+    if rc in _ERRORS:
+        errcls, errstr = _ERRORS[rc]
+        return errcls(errstr.format(path))
+    return exceptions.Error("{0}: {1}".format(zookeeper.zerror(rc), path))
+
+
+def completing(func):
+    """
+    Decorator for the functions libzookeeper calls on its completion
+    thread, marking the thread as such while they run.
+
+    Arguments:
+    - `func`: callable
+
+    Return: callable
+    Exceptions: None
+    """
+    @functools.wraps(func)
+    def marked(*args, **kwargs):
+        depth = getattr(_local, 'depth', 0)
+        _local.depth = depth + 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.depth = depth
+    return marked
+
+def on_completion_thread():
+    """
+    Predicate to indicate whether we are running in a completion or
+    watch callback on libzookeeper's completion thread.
+
+    Return: bool
+    Exceptions: None
+    """
+    return getattr(_local, 'depth', 0) > 0
+
+def _refuse():
+    """
+    Raise CompletionThreadError if we are on the completion thread.
+
+    Return: None
+    Exceptions:
+    - CompletionThreadError
+    """
+    if on_completion_thread():
+        raise exceptions.CompletionThreadError(
+            "Can't wait for a reply on libzookeeper's completion thread")
+    return
+
+class AsyncResult(object):
+    """
+    A future-like handle on the result of an asynchronous request.
+
+    >>> res = AsyncResult()
+    >>> res.set('Frist')
+    >>> res.get()
+    'Frist'
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.value = None
+        self.exception = None
+
+    def __repr__(self):
+        if not self.ready():
+            return "<AsyncResult pending>"
+        if self.exception is not None:
+            return "<AsyncResult exception={0!r}>".format(self.exception)
+        return "<AsyncResult value={0!r}>".format(self.value)
+
+    def ready(self):
+        """
+        Predicate to indicate whether the request has completed.
+
+        Return: bool
+        Exceptions: None
+        """
+        return self._event.is_set()
+
+    def successful(self):
+        """
+        Predicate to indicate whether the request completed without error.
+
+        Return: bool
+        Exceptions: None
+        """
+        return self.ready() and self.exception is None
+
+    def set(self, value=None):
+        """
+        Complete the request with `value`
+
+        Arguments:
+        - `value`: object
+
+        Return: None
+        Exceptions: None
+        """
+        self._complete(value, None)
+
+    def set_exception(self, exception):
+        """
+        Complete the request with an error.
+
+        Arguments:
+        - `exception`: Exception instance
+
+        Return: None
+        Exceptions: None
+        """
+        self._complete(None, exception)
+
+    def _complete(self, value, exception):
+        """
+        Store the outcome, wake waiters and run linked callbacks.
+
+        Arguments:
+        - `value`: object
+        - `exception`: Exception or None
+
+        Return: None
+        Exceptions: None
+        """
+        with self._lock:
+            if self._event.is_set():
+                return # First outcome wins
+            self.value = value
+            self.exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            cb(self)
+
+    def get(self, timeout=None):
+        """
+        Block until the request completes, then return the value or
+        raise the exception it completed with.
+
+        Arguments:
+        - `timeout`: float - seconds to wait, None for forever
+
+        Return: object
+        Exceptions:
+        - Timeout: The request did not complete in time
+        - CompletionThreadError: Called from a callback before the
+                                 request completed
+        - Whatever error the request completed with
+        """
+        if not self._event.is_set():
+            _refuse()
+        if not self._event.wait(timeout):
+            # Python 2.6's Event.wait returns None, so check again.
+            if not self._event.is_set():
+                raise exceptions.Timeout("Request did not complete in time")
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def wait(self, timeout=None):
+        """
+        Block until the request completes without raising its error.
+
+        Arguments:
+        - `timeout`: float - seconds to wait, None for forever
+
+        Return: bool - whether the request completed
+        Exceptions:
+        - CompletionThreadError: Called from a callback before the
+                                 request completed
+        """
+        if not self._event.is_set():
+            _refuse()
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+    def rawlink(self, callback):
+        """
+        Run `callback` with this AsyncResult as the only argument once
+        the request completes. If it already has, run it now.
+
+        Callbacks usually run on the libzookeeper completion thread, so
+        they should be quick and must not block on other requests.
+
+        Arguments:
+        - `callback`: callable
+
+        Return: None
+        Exceptions: None
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
@@ -21,17 +21,89 @@ zoop.tree
 Representing ZooKeeper Node trees.
 
 >>> t = Tree()
->>> t.add_nodes('/foo/bar/goo/car')
+>>> t.add_nodes('/foo/bar', ['goo', 'car'])
 """
+from array import array
+from collections import namedtuple
+from itertools import chain
+from os.path import join
+import re
+import sys
+
+from zoop import exceptions
+
+try:
+    xrange
+except NameError: # Python 3
+    xrange = range
+
+_MISSING = object()
+
+TreeDiff = namedtuple('TreeDiff', 'added removed changed')
+
+def _data_changed(old, new):
+    """
+    Has the Node been written to (or deleted and recreated) between
+    the Statsdicts `old` and `new`?
+
+    Arguments:
+    - `old`: dict
+    - `new`: dict
+
+    Return: bool
+    Exceptions: None
+    """
+    for f in ('czxid', 'mzxid', 'version'):
+        if old.get(f, -1) != new.get(f, -1):
+            return True
+    return False
+
+def _wanted(pattern, exclude):
+    """
+    Return a predicate for Node names that match the regexp `pattern`
+    (if given) and don't match the regexp `exclude` (if given).
+
+    Arguments:
+    - `pattern`: str - regexp
+    - `exclude`: str - regexp
+
+    Return: callable
+    Exceptions: None
+    """
+    if pattern is not None:
+        pattern = re.compile(pattern)
+    if exclude is not None:
+        exclude = re.compile(exclude)
+
+    def wanted(name):
+        if pattern is not None and not pattern.search(name):
+            return False
+        if exclude is not None and exclude.search(name):
+            return False
+        return True
+
+    return wanted
+
 class Tree(object):
+    stat_fields = ('czxid', 'mzxid', 'pzxid', 'version', 'cversion',
+                   'numChildren')
+    # Where from_zk() started, and how many levels it listed
+    root = '/'
+    level = None
+
     def __init__(self):
         self.nodes = {}
+        self.stats = {}
 
     def __repr__(self):
         return "<zoop Tree>"
 
-    @staticmethod
-    def from_zk(zk, root='/', level=None, pattern=None, exclude=None):
+    def __contains__(self, path):
+        return self._find(path) is not _MISSING
+
+    @classmethod
+    def from_zk(cls, zk, root='/', level=None, pattern=None, exclude=None,
+                window=1000, stats=False):
         """
         Inspect the ZooKeeper instance connected in `zk, and create a
         tree representing the schema starting at `root`, and descending
@@ -43,62 +115,863 @@ class Tree(object):
         If the `exclude` argument is passed, exclude any Nodes whose name
         matches the regexp `exclude`
 
+        The tree is crawled breadth first, listing each level with
+        pipelined get_children requests, `window` at a time. Nodes that
+        are filtered out are not descended into.
+
+        If `stats` is True, also store the stat fields of each Node we
+        list, which lets us refresh() the Tree later.
+
         Arguments:
         - `zk`: ZooKeeper
         - `root`: str - the node to start at.
         - `level`: int - the number of child Nodes to descend.
         - `pattern`: str - regexp
         - `exclude`: str - regexp
+        - `window`: int - maximum requests in flight
+        - `stats`: bool - store stat fields
 
-        Return: Tree
+        Return: Tree (or the subclass this is called on)
         Exceptions: None
         """
-        return Tree()
+        tree = cls()
+        tree.root, tree.level = root, level
+        tree._crawl(zk, [root], _wanted(pattern, exclude), level, window,
+                    stats, collect=False)
+        return tree
+
+    def _levels_left(self, path):
+        """
+        Return how many more levels from_zk() would have listed
+        below `path`, or None for no limit.
+
+        Arguments:
+        - `path`: str
+
+        Return: int or None
+        Exceptions: None
+        """
+        if self.level is None:
+            return None
+        depth = len([p for p in path.split('/') if p])
+        return self.level - depth + len([p for p in self.root.split('/') if p])
+
+    def _crawl(self, zk, frontier, wanted, level, window, stats,
+               collect=True):
+        """
+        List the Nodes at `frontier` and everything below them a level
+        at a time, adding the children that are `wanted`.
+
+        The children we list are new to the Tree, so we add them
+        to the handles of their parents as we go.
+
+        Arguments:
+        - `zk`: ZooKeeper
+        - `frontier`: list of strings
+        - `wanted`: callable - predicate for Node names
+        - `level`: int - the number of child Nodes to descend.
+        - `window`: int - maximum requests in flight
+        - `stats`: bool - store stat fields
+        - `collect`: bool - return the paths added
+
+        Return: list of the paths added, or None if not `collect`
+        Exceptions: None
+        """
+        added = [] if collect else None
+        below = [[self._handle(path) for path in frontier]]
+        depth = 0
+        while frontier and (level is None or depth < level):
+            listings = zk.get_children_many(frontier, window)
+            if stats:
+                statlist = zk.exists_many(frontier, window)
+            handles = chain.from_iterable(below)
+            descend, below = [], []
+            for i, path in enumerate(frontier):
+                handle, kids = next(handles), listings[i]
+                if kids is None:
+                    continue # Deleted while we crawled
+                if stats and statlist[i] is not None:
+                    self._set_stat(path, handle, statlist[i])
+                kids = [k for k in kids if wanted(k)]
+                if kids:
+                    below.append(self._adopt(path, handle, kids))
+                    descend.extend(join(path, k) for k in kids)
+            if collect:
+                added.extend(descend)
+            frontier = descend
+            depth += 1
+        return added
+
+    def _handle(self, path):
+        """
+        Return the handle _crawl() should use for the Node at `path`,
+        which we will add children to.
+
+        Arguments:
+        - `path`: str
+
+        Return: handle
+        Exceptions: None
+        """
+        return None # add_nodes() finds it by path
+
+    def _adopt(self, path, node, names):
+        """
+        Add the Nodes named in `names`, which we don't have yet, as
+        children of the Node at `path`, whose handle is `node`.
+
+        Arguments:
+        - `path`: str
+        - `node`: handle as returned by _handle() or _adopt()
+        - `names`: list of strings
+
+        Return: sequence of the handles of the new Nodes
+        Exceptions: None
+        """
+        self.add_nodes(path, names)
+        return [None] * len(names)
 
     def add_nodes(self, path, nodes):
-        # This is very possibly not the API you are looking for
+        """
+        Add the Nodes named in `nodes` as children of `path`,
+        creating any parents we haven't seen along the way.
+
+        Arguments:
+        - `path`: str
+        - `nodes`: list of strings
+
+        Return: None
+        Exceptions: None
+        """
         pathlist = [p for p in path.split('/') if p]
-        print pathlist
         current = self.nodes
         for path in pathlist:
             if not path in current or current[path] == None:
                 current[path] = {}
             current = current[path]
         for n in nodes:
-            current[n] = None
+            if n not in current:
+                current[n] = None
 
-    def tree(self):
+    def _root(self):
         """
-        Return a string representation of the Nodes
-        in this ZooKeeper Instance
+        Return the handle for the root Node.
+
+        Return: dict
+        Exceptions: None
+        """
+        return self.nodes
+
+    def _children(self, node):
+        """
+        Return the children of the Node with the handle `node`.
+
+        Arguments:
+        - `node`: handle as returned by _root() or _children()
+
+        Return: list of (name, handle) tuples, sorted by name
+        Exceptions: None
+        """
+        if not node:
+            return []
+        return [(name, node[name]) for name in sorted(node)]
+
+    def _find(self, path):
+        """
+        Return the handle for the Node at `path`, or _MISSING
+
+        Arguments:
+        - `path`: str
+
+        Return: handle
+        Exceptions: None
+        """
+        node = self.nodes
+        for name in [p for p in path.split('/') if p]:
+            if not node or name not in node:
+                return _MISSING
+            node = node[name]
+        return node
+
+    def children(self, path):
+        """
+        Return the names of the children of `path` in this Tree
+
+        Arguments:
+        - `path`: str
+
+        Return: list of strings
+        Exceptions: NoNodeError
+        """
+        node = self._find(path)
+        if node is _MISSING:
+            raise exceptions.NoNodeError("{0} is not in this Tree".format(path))
+        return [name for name, child in self._children(node)]
+
+    def _walk(self, path):
+        """
+        Generate (path, handle) for `path` and every Node below it,
+        depth first in name order.
+
+        Arguments:
+        - `path`: str
+
+        Return: generator of (str, handle) tuples
+        Exceptions: NoNodeError
+        """
+        node = self._find(path)
+        if node is _MISSING:
+            raise exceptions.NoNodeError("{0} is not in this Tree".format(path))
+        stack = [(path, node)]
+        while stack:
+            path, node = stack.pop()
+            yield path, node
+            for name, handle in reversed(self._children(node)):
+                stack.append((join(path, name), handle))
+
+    def paths(self, path='/'):
+        """
+        Generate the paths of `path` and every Node below it,
+        depth first in name order.
+
+        Arguments:
+        - `path`: str
+
+        Return: generator of strings
+        Exceptions: NoNodeError
+        """
+        for path, node in self._walk(path):
+            yield path
+
+    def _remove(self, path):
+        """
+        Remove the Node at `path` and everything below it, if we have it.
+
+        Arguments:
+        - `path`: str
+
+        Return: None
+        Exceptions: None
+        """
+        pathlist = [p for p in path.split('/') if p]
+        if not pathlist or path not in self:
+            return
+        for gone in self.paths(path):
+            self.stats.pop(self._statkey(gone), None)
+        parent, current = None, self.nodes
+        for name in pathlist[:-1]:
+            parent, current = current, current[name]
+        del current[pathlist[-1]]
+        if not current and parent is not None:
+            parent[pathlist[-2]] = None
+
+    def _statkey(self, path):
+        """
+        Return `path` normalised as a key for self.stats
+
+        Arguments:
+        - `path`: str
 
         Return: str
         Exceptions: None
         """
-        lines = ['/']
+        return '/' + '/'.join(p for p in path.split('/') if p)
+
+    def set_stat(self, path, stat):
+        """
+        Store the interesting fields of the Statsdict `stat`
+        against the Node at `path`, adding it if need be.
+
+        Arguments:
+        - `path`: str
+        - `stat`: dict
+
+        Return: None
+        Exceptions: None
+        """
+        if path not in self:
+            parent, name = path.rstrip('/').rsplit('/', 1)
+            self.add_nodes(parent or '/', [name])
+        self.stats[self._statkey(path)] = dict(
+            (f, stat.get(f, -1)) for f in self.stat_fields)
+
+    def _set_stat(self, path, node, stat):
+        """
+        Store `stat` against the Node at `path`, whose handle is `node`.
+
+        Arguments:
+        - `path`: str
+        - `node`: handle
+        - `stat`: dict
+
+        Return: None
+        Exceptions: None
+        """
+        self.set_stat(path, stat)
+
+    def _stat(self, path, node):
+        """
+        Return the stat fields stored against the Node at `path`,
+        whose handle is `node`.
+
+        Arguments:
+        - `path`: str
+        - `node`: handle
+
+        Return: dict or None
+        Exceptions: None
+        """
+        return self.stats.get(self._statkey(path))
+
+    def stat(self, path):
+        """
+        Return the stat fields stored against the Node at `path`
+
+        Arguments:
+        - `path`: str
+
+        Return: dict or None
+        Exceptions: NoNodeError
+        """
+        node = self._find(path)
+        if node is _MISSING:
+            raise exceptions.NoNodeError("{0} is not in this Tree".format(path))
+        return self._stat(path, node)
+
+    def diff(self, other):
+        """
+        Compare this Tree with `other`, typically a later snapshot
+        of the same namespace.
+
+        `added` lists the paths only in `other` and `removed` those only
+        in this Tree. `changed` lists the paths in both whose data
+        changed, which we can only tell where both Trees have stats.
+
+        Arguments:
+        - `other`: Tree
+
+        Return: TreeDiff of lists of paths
+        Exceptions: None
+        """
+        added, removed, changed = [], [], []
+        stack = [('/', self._root(), other._root())]
+        while stack:
+            path, mine, theirs = stack.pop()
+            old, new = self._stat(path, mine), other._stat(path, theirs)
+            if old is not None and new is not None and \
+                    _data_changed(old, new):
+                changed.append(path)
+            kids = dict(other._children(theirs))
+            for name, handle in reversed(self._children(mine)):
+                child = join(path, name)
+                if name in kids:
+                    stack.append((child, handle, kids.pop(name)))
+                else:
+                    removed.extend(self.paths(child))
+            for name in sorted(kids):
+                added.extend(other.paths(join(path, name)))
+        return TreeDiff(added, removed, changed)
+
+    def refresh(self, zk, root=None, pattern=None, exclude=None, window=1000):
+        """
+        Bring this Tree up to date with the ZooKeeper instance
+        connected in `zk`, from `root` down - by default, from the
+        root the Tree was built from.
+
+        Rather than listing every Node again, we fetch the stat of each
+        Node we know of with pipelined exists requests, and only list
+        those whose `cversion` or `pzxid` has moved since we last saw
+        them (or that we have no stat for). New Nodes are crawled as
+        from_zk() would, and Nodes that have gone are removed.
+
+        We descend no further than the `level` the Tree was built
+        with, and never list the ancestors of the root it was built
+        from. Pass the `pattern` and `exclude` it was built with too.
+
+        Arguments:
+        - `zk`: ZooKeeper
+        - `root`: str - the node to start at, defaults to the Tree's root
+        - `pattern`: str - regexp
+        - `exclude`: str - regexp
+        - `window`: int - maximum requests in flight
+
+        Return: TreeDiff of the paths added, removed and changed
+        Exceptions: NoNodeError
+        """
+        if root is None:
+            root = self.root
+        wanted = _wanted(pattern, exclude)
+        top = self._statkey(self.root)
+        known = list(self._walk(root))
+        statlist = zk.exists_many([path for path, node in known], window)
+
+        added, removed, changed = [], [], []
+        gone, relist, listed = [], [], {}
+        for (path, node), stat in zip(known, statlist):
+            if gone and path.startswith(gone[-1].rstrip('/') + '/'):
+                removed.append(path)
+                continue
+            if stat is None:
+                gone.append(path)
+                removed.append(path)
+                continue
+            key = self._statkey(path)
+            if key != top and (top + '/').startswith(key.rstrip('/') + '/'):
+                continue # An ancestor of the root we were built from
+            left = self._levels_left(path)
+            if left is not None and left <= 0:
+                continue # Past the level we were built to
+            old = self._stat(path, node)
+            if old is None or old['cversion'] != stat.get('cversion', -1) \
+                    or old['pzxid'] != stat.get('pzxid', -1):
+                relist.append(path)
+                listed[path] = [name for name, h in self._children(node)]
+            if old is not None and _data_changed(old, stat):
+                changed.append(path)
+            if old != dict((f, stat.get(f, -1)) for f in self.stat_fields):
+                self.set_stat(path, stat)
 
-        def rectree(nodes, prefix):
-            nodenames = sorted(nodes.keys())
-            for i, child in enumerate(nodenames):
-                lines.append('{0}|-- {1}'.format(prefix, child))
-                if nodes[child]:
+        seen, fresh = set(gone), []
+        for path, kids in zip(relist, zk.get_children_many(relist, window)):
+            if kids is None:
+                kids = [] # Deleted since we asked for its stat
+                seen.add(path)
+                gone.append(path)
+                removed.extend(self.paths(path))
+            kids = set(k for k in kids if wanted(k))
+            for name in listed[path]:
+                child = join(path, name)
+                if name not in kids and child not in seen:
+                    seen.add(child)
+                    gone.append(child)
+                    removed.extend(self.paths(child))
+            new = sorted(kids.difference(listed[path]))
+            if new:
+                fresh.append((path, new))
+
+        for path in gone:
+            self._remove(path)
+        frontiers = {}
+        for path, new in fresh:
+            self.add_nodes(path, new)
+            kids = [join(path, k) for k in new]
+            added.extend(kids)
+            frontiers.setdefault(self._levels_left(kids[0]), []).extend(kids)
+        for left, frontier in frontiers.items():
+            if left is None or left > 0:
+                added.extend(self._crawl(zk, frontier, wanted, left, window,
+                                         True))
+        unique = set()
+        removed = [p for p in removed if not (p in unique or unique.add(p))]
+        return TreeDiff(added, removed, changed)
+
+    def iter_lines(self, path='/', depth=None, max_children=None):
+        """
+        Generate the lines of the string representation of the Nodes
+        below `path` one at a time, so that we only hold the listings
+        along the current branch in memory.
+
+        If `depth` is given, don't descend more than `depth` levels
+        below `path`. If `max_children` is given, only list that many
+        children of any one Node, followed by a count of the rest.
+
+        Arguments:
+        - `path`: str
+        - `depth`: int
+        - `max_children`: int
+
+        Return: generator of str
+        Exceptions: NoNodeError
+        """
+        node = self._find(path)
+        if node is _MISSING:
+            raise exceptions.NoNodeError("{0} is not in this Tree".format(path))
+        yield path
+
+        def listing(node, prefix):
+            kids = self._children(node)
+            more = 0
+            if max_children is not None and len(kids) > max_children:
+                more = len(kids) - max_children
+                kids = kids[:max_children]
+            return enumerate(kids, 1), len(kids), more, prefix
+
+        stack = [listing(node, ' ')]
+        while stack:
+            kids, count, more, prefix = stack[-1]
+            for i, (child, handle) in kids:
+                yield '{0}|-- {1}'.format(prefix, child)
+                if depth is None or len(stack) < depth:
                     nodefix = ' ' * 4
-                    if i + 1 < len(nodenames):
+                    if i < count or more:
                         nodefix = '|{0}'.format(nodefix[1:])
                     subfix = '{0}{1}'.format(prefix, nodefix)
-                    rectree(nodes[child], subfix)
+                    stack.append(listing(handle, subfix))
+                break
+            else:
+                stack.pop()
+                if more:
+                    yield '{0}|-- ... {1} more'.format(prefix, more)
 
-        rectree(self.nodes, ' ')
-        return "\n".join(lines)
+    def tree(self):
+        """
+        Return a string representation of the Nodes
+        in this ZooKeeper Instance
 
-    def pprint(self):
+        Return: str
+        Exceptions: None
+        """
+        return "\n".join(self.iter_lines())
+
+    def pprint(self, stream=None, path='/', depth=None, max_children=None):
         """
         Print a string representation of the Nodes
-        in this ZooKeeper Instance
+        in this ZooKeeper Instance to `stream` a line at a time.
+
+        Arguments:
+        - `stream`: file-like object - defaults to sys.stdout
+        - `path`: str
+        - `depth`: int
+        - `max_children`: int
 
         Return: None
-        Exceptions: None
+        Exceptions: NoNodeError
         """
-        print self.tree()
+        if stream is None:
+            stream = sys.stdout
+        for line in self.iter_lines(path, depth=depth, max_children=max_children):
+            stream.write(line + '\n')
         return
 
+
+class CompactTree(Tree):
+    """
+    A Tree for very large namespaces.
+
+    Rather than nested dicts, Nodes are numbered and stored in flat
+    arrays: an interned table of names, each Node's name and parent,
+    and once compacted, the offset and count of each Node's children,
+    which are stored contiguously and sorted by name. That's a handful
+    of machine words per Node rather than a dict.
+
+    The indexes we need to add or remove Nodes by path cost a dict
+    entry per Node, so we only build them when asked to, and drop
+    them when we compact. from_zk() never needs them, and interns
+    names only once it has finished crawling.
+
+    Stat fields may optionally be stored per Node with set_stat().
+
+    >>> t = CompactTree.from_zk(zk)
+    >>> t.children('/zookeeper')
+    ['quota']
+    >>> t.stat('/zookeeper')['numChildren']
+    1
+    """
+    def __init__(self):
+        self.names = []
+        self._name_ids = None
+        self.name = array('i', [-1]) # Node 0 is the root
+        self.parent = array('i', [-1])
+        self.first_child = None
+        self.child_count = None
+        self.stats = None
+        self._index = None
+
+    def __repr__(self):
+        return "<zoop CompactTree of {0} Nodes>".format(len(self))
+
+    def __len__(self):
+        self._compacted()
+        return len(self.name) - 1
+
+    @classmethod
+    def from_zk(cls, *args, **kwargs):
+        """
+        Crawl the ZooKeeper instance as Tree.from_zk(), then compact.
+
+        Return: CompactTree
+        Exceptions: None
+        """
+        tree = super(CompactTree, cls).from_zk(*args, **kwargs)
+        tree.compact()
+        return tree
+
+    def _naming(self):
+        """
+        Return the name -> id index of our name table, rebuilding
+        it if we've been compacted since.
+
+        Return: dict
+        Exceptions: None
+        """
+        if self._name_ids is None:
+            self._name_ids = dict((name, i) for i, name in enumerate(self.names))
+        return self._name_ids
+
+    def _intern(self, name):
+        """
+        Return the id of `name` in our name table, adding it if need be.
+
+        Arguments:
+        - `name`: str
+
+        Return: int
+        Exceptions: None
+        """
+        name_ids = self._naming()
+        try:
+            return name_ids[name]
+        except KeyError:
+            name_ids[name] = len(self.names)
+            self.names.append(name)
+            return name_ids[name]
+
+    def _building(self):
+        """
+        Return the (parent, name) -> Node index we use while adding
+        Nodes, rebuilding it if we've been compacted since.
+
+        Names added by _adopt() aren't interned until we compact,
+        so we do that first.
+
+        Return: dict
+        Exceptions: None
+        """
+        if self._index is None:
+            self._compacted()
+            self._index = dict(((self.parent[i] << 32) | self.name[i], i)
+                               for i in range(1, len(self.name)))
+        return self._index
+
+    def _add(self, parent, name):
+        """
+        Return the id of the child called `name` of `parent`,
+        adding it if need be.
+
+        Arguments:
+        - `parent`: int
+        - `name`: str
+
+        Return: int
+        Exceptions: None
+        """
+        index = self._building()
+        nameid = self._intern(name)
+        key = (parent << 32) | nameid
+        if key not in index:
+            index[key] = len(self.name)
+            self.name.append(nameid)
+            self.parent.append(parent)
+            if self.stats is not None:
+                for col in self.stats.values():
+                    col.append(-1)
+            self.first_child = self.child_count = None
+        return index[key]
+
+    def add_nodes(self, path, nodes):
+        """
+        Add the Nodes named in `nodes` as children of `path`,
+        creating any parents we haven't seen along the way.
+
+        Arguments:
+        - `path`: str
+        - `nodes`: list of strings
+
+        Return: None
+        Exceptions: None
+        """
+        current = self._add_path(path)
+        for n in nodes:
+            self._add(current, n)
+
+    def _handle(self, path):
+        return self._add_path(path)
+
+    def _adopt(self, path, node, names):
+        """
+        Append the Nodes named in `names` as children of `node`
+        without consulting the indexes, which we drop - it is rebuilt
+        if we need it again. Their names are interned when we compact.
+        """
+        self._index = self._name_ids = None
+        first = len(self.name)
+        self.name.extend(xrange(len(self.names), len(self.names) + len(names)))
+        self.names.extend(names)
+        self.parent.extend(array('i', [node]) * len(names))
+        if self.stats is not None:
+            for col in self.stats.values():
+                col.extend(array('l', [-1]) * len(names))
+        self.first_child = self.child_count = None
+        return xrange(first, len(self.name))
+
+    def _add_path(self, path):
+        """
+        Return the id of the Node at `path`, adding it and any
+        parents if need be.
+
+        Arguments:
+        - `path`: str
+
+        Return: int
+        Exceptions: None
+        """
+        current = 0
+        for name in [p for p in path.split('/') if p]:
+            current = self._add(current, name)
+        return current
+
+    def compact(self):
+        """
+        Renumber the Nodes breadth first so that each Node's children
+        are contiguous and sorted by name, intern their names, build the
+        child offset arrays, and drop the indexes used while adding Nodes.
+
+        The children of each Node are grouped with a counting sort
+        over the parent array, so we only need a few more arrays.
+
+        This happens automatically when the Tree is first read after
+        Nodes are added.
+
+        Return: None
+        Exceptions: None
+        """
+        size = len(self.name)
+        parent, names, name = self.parent, self.names, self.name
+        start = array('i', [0]) * (size + 1)
+        for i in range(1, size):
+            if parent[i] >= 0: # Removed Nodes have no parent
+                start[parent[i] + 1] += 1
+        for i in range(size):
+            start[i + 1] += start[i]
+        slots = array('i', [0]) * start[size]
+        fill = array('i', start)
+        for i in range(1, size):
+            if parent[i] >= 0:
+                slots[fill[parent[i]]] = i
+                fill[parent[i]] += 1
+        del fill
+
+        order = array('i', [0])
+        first_child = array('i')
+        child_count = array('i')
+        pos = 0
+        while pos < len(order):
+            node = order[pos]
+            children = slots[start[node]:start[node + 1]]
+            first_child.append(len(order))
+            child_count.append(len(children))
+            order.extend(sorted(children, key=lambda c: names[name[c]]))
+            pos += 1
+        del slots, start
+
+        renumber = array('i', [0]) * size
+        for new, old in enumerate(order):
+            renumber[old] = new
+        parent = self.parent
+        self.names, self.name, ids = [], array('i', [-1]), {}
+        for old in order[1:]:
+            nameid = ids.get(names[name[old]])
+            if nameid is None:
+                nameid = ids[names[name[old]]] = len(self.names)
+                self.names.append(names[name[old]])
+            self.name.append(nameid)
+        names = ids = None
+        self.parent = array('i', [-1])
+        self.parent.extend(renumber[parent[old]] for old in order[1:])
+        if self.stats is not None:
+            for f, col in self.stats.items():
+                self.stats[f] = array('l', (col[old] for old in order))
+        self.first_child = first_child
+        self.child_count = child_count
+        self._index = None
+        self._name_ids = None
+
+    def _compacted(self):
+        """
+        Make sure the child offset arrays are up to date.
+
+        Return: None
+        Exceptions: None
+        """
+        if self.first_child is None:
+            self.compact()
+
+    def _root(self):
+        self._compacted()
+        return 0
+
+    def _children(self, node):
+        self._compacted()
+        first = self.first_child[node]
+        return [(self.names[self.name[c]], c)
+                for c in range(first, first + self.child_count[node])]
+
+    def _find(self, path):
+        self._compacted()
+        node = 0
+        for name in [p for p in path.split('/') if p]:
+            lo = self.first_child[node]
+            hi = lo + self.child_count[node]
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.names[self.name[mid]] < name:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo == self.first_child[node] + self.child_count[node] or \
+                    self.names[self.name[lo]] != name:
+                return _MISSING
+            node = lo
+        return node
+
+    def set_stat(self, path, stat):
+        """
+        Store the interesting fields of the Statsdict `stat`
+        against the Node at `path`, adding it if need be.
+
+        Arguments:
+        - `path`: str
+        - `stat`: dict
+
+        Return: None
+        Exceptions: None
+        """
+        self._set_stat(path, self._add_path(path), stat)
+
+    def _set_stat(self, path, node, stat):
+        if self.stats is None:
+            self.stats = dict((f, array('l', [-1]) * len(self.name))
+                              for f in self.stat_fields)
+        for f in self.stat_fields:
+            self.stats[f][node] = stat.get(f, -1)
+
+    def _stat(self, path, node):
+        if self.stats is None or self.stats['version'][node] == -1:
+            return None
+        return dict((f, self.stats[f][node]) for f in self.stat_fields)
+
+    def _remove(self, path):
+        """
+        Detach the Node at `path` from its parent, if we have it.
+        It and everything below it are dropped when we next compact.
+
+        Arguments:
+        - `path`: str
+
+        Return: None
+        Exceptions: None
+        """
+        index, name_ids = self._building(), self._naming()
+        node, key = 0, None
+        for name in [p for p in path.split('/') if p]:
+            if name not in name_ids:
+                return
+            key = (node << 32) | name_ids[name]
+            if key not in index:
+                return
+            node = index[key]
+        if key is None:
+            return
+        del index[key]
+        self.parent[node] = -1
+        self.first_child = self.child_count = None
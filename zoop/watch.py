@@ -21,13 +21,173 @@ zoop.watcher
 Callbacks for state change go here!
 """
 import collections
+from os.path import join
 import threading
+import traceback
+try:
+    import Queue as queue
+except ImportError: # Python 3
+    import queue
 
 PLock = threading.RLock()
 
 import zookeeper
 
-from zoop import enums, exceptions
+from zoop import enums, exceptions, result
+
+class DispatchPool(object):
+    """
+    Run watch callbacks on a pool of worker threads, so that they
+    never hold up libzookeeper's completion thread.
+
+    Every task for a given key (the path, for watches) goes to the
+    same worker, so callbacks for one path run in the order their
+    events arrived. Each worker queues up to `maxsize` tasks; when
+    a worker's queue is full, `policy` decides what happens to a
+    new task:
+
+    - 'spill': queue it anyway, beyond `maxsize` (the default). Order
+      is kept and nothing is lost, at the cost of unbounded memory
+      while the worker is backed up. `spilled` counts these tasks.
+    - 'drop': discard it, counting it in `dropped`.
+    - 'inline': run it on the submitting thread. Tasks already queued
+      for the same key may then run after it, so per-key ordering is
+      not kept for tasks that overflow.
+
+    We never wait for room: the submitting thread is usually
+    libzookeeper's completion thread, and a callback waiting on a
+    reply would never get one while that thread is blocked.
+
+    >>> pool = DispatchPool(workers=8, maxsize=10000, policy='drop')
+    >>> zk = ZooKeeper('localhost:2181', executor=pool)
+    """
+    policies = ('spill', 'drop', 'inline')
+
+    def __init__(self, workers=4, maxsize=1000, policy='spill'):
+        """
+        Start the worker threads
+
+        Arguments:
+        - `workers`: int - number of threads
+        - `maxsize`: int - tasks queued per worker
+        - `policy`: str - one of 'spill', 'drop' or 'inline'
+
+        Return: None
+        Exceptions: ValueError
+        """
+        if policy not in self.policies:
+            raise ValueError("Unknown dispatch policy {0}".format(policy))
+        self.policy = policy
+        self.dropped = 0
+        self.spilled = 0
+        self._lock = threading.Lock()
+        self._queues = [queue.Queue(maxsize) for i in range(workers)]
+        self._overflows = [collections.deque() for i in range(workers)]
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, args=(i,))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def __repr__(self):
+        return "<zoop DispatchPool of {0} workers>".format(len(self._threads))
+
+    def _work(self, i):
+        """
+        Worker thread main loop - run tasks from queue `i` until we
+        get None, topping the queue up from its overflow as we go.
+
+        Arguments:
+        - `i`: int - our worker number
+
+        Return: None
+        Exceptions: None
+        """
+        q, overflow = self._queues[i], self._overflows[i]
+        while True:
+            task = q.get()
+            with self._lock:
+                while overflow:
+                    try:
+                        q.put_nowait(overflow[0])
+                    except queue.Full:
+                        break
+                    overflow.popleft()
+            if task is None:
+                return
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def _spill(self, i, task):
+        """
+        Queue `task` for worker `i`, beyond its maxsize if need be.
+        Once anything has spilled, later tasks spill behind it, so
+        they keep their order.
+
+        Arguments:
+        - `i`: int
+        - `task`: tuple of (func, args), or None to stop the worker
+
+        Return: bool - whether the task spilled
+        Exceptions: None
+        """
+        q, overflow = self._queues[i], self._overflows[i]
+        with self._lock:
+            if not overflow:
+                try:
+                    q.put_nowait(task)
+                    return False
+                except queue.Full:
+                    pass
+            overflow.append(task)
+            return True
+
+    def submit(self, key, func, *args):
+        """
+        Run `func(*args)` on the worker for `key`.
+
+        Arguments:
+        - `key`: hashable - tasks with equal keys run in order
+        - `func`: callable
+        - `*args`: arguments for `func`
+
+        Return: bool - False if the task was dropped
+        Exceptions: None
+        """
+        i = hash(key) % len(self._queues)
+        if self.policy == 'spill':
+            if self._spill(i, (func, args)):
+                self.spilled += 1
+            return True
+        try:
+            self._queues[i].put_nowait((func, args))
+        except queue.Full:
+            if self.policy == 'drop':
+                self.dropped += 1
+                return False
+            func(*args)
+        return True
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers once they have run the tasks already queued.
+
+        Arguments:
+        - `wait`: bool - wait for the workers to finish
+
+        Return: None
+        Exceptions: None
+        """
+        for i in range(len(self._queues)):
+            self._spill(i, None)
+        if wait:
+            for t in self._threads:
+                t.join()
+        return
 
 class Watcher(object):
     """
@@ -45,23 +205,54 @@ class Watcher(object):
     """
 
     _watch_funcs = {
-        enums.Event.Deleted: zookeeper.get,
-        enums.Event.Changed: zookeeper.get,
-        enums.Event.Child: zookeeper.get_children
+        enums.Event.Deleted: zookeeper.aget,
+        enums.Event.Changed: zookeeper.aget,
+        enums.Event.Child: zookeeper.aget_children
+        }
+
+    # The kind of server watch that delivers each event type, and the
+    # kinds of watch each event type uses up.
+    _kinds = {
+        enums.Event.Deleted: 'data',
+        enums.Event.Changed: 'data',
+        enums.Event.Child: 'child'
+        }
+    _fires = {
+        enums.Event.Deleted: ('data', 'child'),
+        enums.Event.Changed: ('data',),
+        enums.Event.Child: ('child',)
         }
 
-    def __init__(self, zkh):
+    def __init__(self, zkh, executor=None, coalesce=None):
         """
         Store vars
 
+        If `executor` is given, callbacks are handed to its submit()
+        (see DispatchPool) rather than run on libzookeeper's
+        completion thread.
+
+        If `coalesce` is given, events for a path and type are
+        collected for `coalesce` seconds (0 means just while the
+        callbacks are running) and delivered once, with one re-arm.
+
         Arguments:
         - `zkh`: zookeeper instance handle
+        - `executor`: DispatchPool
+        - `coalesce`: float - seconds
 
         Return: None
         Exceptions: None
         """
         self._zk = zkh
+        self.executor = executor
+        self.coalesce = coalesce
+        self.coalesced = 0
         self.callbacks = collections.defaultdict(lambda: collections.defaultdict(list))
+        self.payload_callbacks = collections.defaultdict(
+            lambda: collections.defaultdict(list))
+        self._armed = set()
+        self._pending = {}
+        self._plock = threading.Lock()
 
     def set_zhandle(self, handle):
         """
@@ -73,13 +264,27 @@ class Watcher(object):
         without having calling code understand the internal
         implementation details of the Watcher class.
 
+        Watches belong to a session, so none of ours are armed on a
+        new handle: we arm everything that is subscribed again.
+
         Arguments:
         - `handle`: ZooKeeper instance handle
 
         Return: None
         Exceptions: None
         """
-        self._zk = handle
+        with self._plock:
+            self._zk = handle
+            self._armed.clear()
+            subscribed = set()
+            for registry in (self.callbacks, self.payload_callbacks):
+                for path, events in registry.items():
+                    for etype, callbacks in events.items():
+                        if callbacks:
+                            subscribed.add((path, etype))
+        if handle is not None:
+            for path, etype in sorted(subscribed):
+                self._arm(path, etype)
         return
 
     def set_global(self):
@@ -92,12 +297,22 @@ class Watcher(object):
         zookeeper.set_watcher(self._zk, self.dispatch)
         return
 
+    @result.completing
     def dispatch(self, zk, etype, conn, path):
         """
         Callback for libzookeeper that fires when ZooKeeper events occur.
 
-        Dispatch to our own callbacks.
-        Then re-watch the node/event type
+        Re-watch the node/event type without waiting for the reply,
+        then dispatch to our own callbacks, via our executor if we
+        have one. Callbacks that asked for the payload are called
+        when the re-arm replies.
+
+        If we coalesce events, a delivery that is already pending
+        or running for this path and event type absorbs this one,
+        and every callback is called when the re-arm replies.
+
+        We only re-arm while somebody is subscribed, and only once
+        per path and kind of watch, however many subscribers there are.
 
         Arguments:
         - `zk`: handle to the ZooKeeper connection
@@ -110,31 +325,258 @@ class Watcher(object):
 
         """
         if etype == enums.Event.Session:
+            if conn == zookeeper.EXPIRED_SESSION_STATE:
+                with self._plock:
+                    self._armed.clear() # Gone with the session
             return
 
-        if etype in self._watch_funcs:
-            self._watch_funcs[etype](self._zk, path, self.dispatch)
+        with self._plock:
+            fired = [(path, kind) for kind in self._fires.get(etype, ())]
+            armed = [key for key in fired if key in self._armed]
+            self._armed.difference_update(fired)
+        if etype == enums.Event.Deleted and fired and not armed:
+            return # Both of our watches on a Node fire when it's deleted
 
-        if self.callbacks[path][etype] > 0:
-            for cb in self.callbacks[path][etype]:
-                cb(path, etype)
+        if self.coalesce is None:
+            rich = self._subscribers(self.payload_callbacks, path, etype)
+            if rich:
+                def fetched(payload):
+                    self._submit(path, self._run, rich, path, etype, payload)
+                self._rearm(path, etype, fetched)
+            else:
+                self._rearm(path, etype)
+            callbacks = self._subscribers(self.callbacks, path, etype)
+            if callbacks:
+                self._submit(path, self._run, callbacks, path, etype)
+            return
 
-        def watchit(h, t, s, p):
-            self.dispatch(h, t, s, p)
+        key = (path, etype)
+        with self._plock:
+            state = self._pending.get(key)
+            if state is not None:
+                if state == 'running':
+                    self._pending[key] = 'dirty'
+                self.coalesced += 1
+                return
+            self._pending[key] = 'pending'
+        if self.coalesce:
+            timer = threading.Timer(self.coalesce, self._flush, (path, etype))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._flush(path, etype)
+        return
+
+    def _submit(self, path, func, *args):
+        """
+        Call `func(*args)` now, or on our executor if we have one.
 
+        Arguments:
+        - `path`: string - orders the calls on the executor
+        - `func`: callable
+        - `*args`: arguments for `func`
+
+        Return: None
+        Exceptions: None
+        """
+        if self.executor is None:
+            func(*args)
+        else:
+            self.executor.submit(path, func, *args)
+        return
+
+    def _subscribers(self, registry, path, etype):
+        """
+        Return a copy of the callbacks in `registry` for `path` and
+        `etype`, without adding empty entries to it.
+
+        Arguments:
+        - `registry`: dict - self.callbacks or self.payload_callbacks
+        - `path`: string
+        - `etype`: Enum - Event type
+
+        Return: list of callables
+        Exceptions: None
+        """
+        return list(registry.get(path, {}).get(etype, ()))
+
+    def _subscribed(self, path, kind):
+        """
+        Does anybody want the events that a watch of `kind` on `path`
+        delivers? Call with self._plock held.
+
+        Arguments:
+        - `path`: string
+        - `kind`: string - 'data' or 'child'
+
+        Return: bool
+        Exceptions: None
+        """
+        for registry in (self.callbacks, self.payload_callbacks):
+            events = registry.get(path, {})
+            for etype, callbacks in events.items():
+                if callbacks and self._kinds.get(etype) == kind:
+                    return True
+        return False
+
+    def _rearm(self, path, etype, fetched=None):
+        """
+        Re-watch `path` after an `etype` event, as _arm().
+        After a deletion there's no Node to set a watch on.
+
+        Arguments:
+        - `path`: string
+        - `etype`: Enum - Event type
+        - `fetched`: callable
+
+        Return: None
+        Exceptions: None
+        """
+        if etype == enums.Event.Deleted:
+            if fetched is not None:
+                fetched(None)
+            return
+        self._arm(path, etype, fetched)
         return
 
-    def spyon(self, path, callback, *events):
+    def _arm(self, path, etype, fetched=None):
+        """
+        Watch `path` for `etype` without waiting for the reply,
+        unless that kind of watch is already armed or nobody is
+        subscribed.
+
+        If `fetched` is given, read `path` regardless and call it with
+        what we read: the list of children for Child events, otherwise
+        (value, Statsdict), or None if the Node has gone.
+
+        Arguments:
+        - `path`: string
+        - `etype`: Enum - Event type
+        - `fetched`: callable
+
+        Return: None
+        Exceptions: None
+        """
+        if etype not in self._watch_funcs:
+            if fetched is not None:
+                fetched(None)
+            return
+        key = (path, self._kinds[etype])
+        with self._plock:
+            arm = key not in self._armed and self._subscribed(*key)
+            if arm:
+                self._armed.add(key)
+        if not arm and fetched is None:
+            return
+
+        def completion(handle, rc, *payload):
+            if rc != zookeeper.OK:
+                if arm: # No watch is left on a Node that isn't there
+                    with self._plock:
+                        self._armed.discard(key)
+                payload = None
+            elif len(payload) == 1:
+                payload = payload[0]
+            if fetched is not None:
+                fetched(payload)
+
+        watcher = arm and self.dispatch or None
+        self._watch_funcs[etype](self._zk, path, watcher, completion)
+        return
+
+    def _flush(self, path, etype):
+        """
+        Start delivering the events we have coalesced for `path` and
+        `etype`: re-arm, then run the callbacks with the reply.
+
+        Arguments:
+        - `path`: string
+        - `etype`: Enum - Event type
+
+        Return: None
+        Exceptions: None
+        """
+        with self._plock:
+            self._pending[(path, etype)] = 'running'
+
+        def fetched(payload):
+            self._submit(path, self._deliver, path, etype, payload)
+
+        self._rearm(path, etype, fetched)
+        return
+
+    def _deliver(self, path, etype, payload):
+        """
+        Run all the callbacks for `path` and `etype`, then either
+        start over if more events arrived meanwhile, or finish - even
+        if a callback raised, so the subscription doesn't go quiet.
+
+        Arguments:
+        - `path`: string
+        - `etype`: Enum - Event type
+        - `payload`: as passed to payload callbacks
+
+        Return: None
+        Exceptions: Whatever a callback raised
+        """
+        key = (path, etype)
+        try:
+            self._run(self._subscribers(self.callbacks, path, etype),
+                      path, etype)
+            self._run(self._subscribers(self.payload_callbacks, path, etype),
+                      path, etype, payload)
+        finally:
+            with self._plock:
+                again = self._pending[key] == 'dirty'
+                if not again:
+                    del self._pending[key]
+            if again:
+                self._flush(path, etype)
+        return
+
+    def _run(self, callbacks, path, etype, *payload):
+        """
+        Call each of `callbacks` with `path`, `etype` and the
+        `payload`, if any.
+
+        Arguments:
+        - `callbacks`: list of callables
+        - `path`: string
+        - `etype`: Enum - Event type
+        - `*payload`: what the re-arm read
+
+        Return: None
+        Exceptions: None
+        """
+        for cb in callbacks:
+            cb(path, etype, *payload)
+        return
+
+    def spyon(self, path, callback, *events, **kw):
         """
         Begin watching `path` for events of type `event`.
         When one happens, execute `callback`, with two
         arguments, the path of the ZooKeeper Event and the Event type.
 
+        Pass payload=True to have `callback` called with a third
+        argument, what we read when we re-armed the watch: the list of
+        children for Child events, otherwise (value, Statsdict), or
+        None if the Node has gone. That saves reading it again.
+
+        If `initial` is also True, `callback` is called straight away
+        with the payload of the read that arms the watch, so it starts
+        from the current state.
+
+        However many callbacks spy on a path, we keep one ZooKeeper
+        watch of each kind armed on it.
+
         Arguments:
         - `path`: string - Path to watch
         - `callback`: callable
         - `*events`: int - one or more zoop.Event attribute. Must pass
                            at least one
+        - `payload`: bool - pass the re-armed read to `callback`
+        - `initial`: bool - pass the current payload to `callback` now
 
         Return: None
         Exceptions:
@@ -143,12 +585,284 @@ class Watcher(object):
         if not events: # Valid syntax, but invalid semantics
             errmsg = "You must pass at least one Event to spy on"
             raise exceptions.NoEventError(errmsg)
+        registry = self.callbacks
+        if kw.get('payload'):
+            registry = self.payload_callbacks
         for e in events:
-            self.callbacks[path][e].append(callback)
+            with self._plock:
+                registry[path][e].append(callback)
+            if kw.get('payload') and kw.get('initial'):
+                def fetched(payload, etype=e):
+                    self._submit(path, callback, path, etype, payload)
+                self._arm(path, e, fetched)
+            else:
+                self._arm(path, e)
+        return
+
+    def watch_tree(self, root, callback):
+        """
+        Call `callback` with the path and Event type of every Created,
+        Changed and Deleted event at or below `root`, until the
+        TreeWatch we return is closed.
+
+        Arguments:
+        - `root`: string - Path to watch
+        - `callback`: callable
+
+        Return: TreeWatch
+        Exceptions: None
+        """
+        treewatch = TreeWatch(self, root, callback)
+        treewatch.start()
+        return treewatch
+
+    def unspy(self, path, callback, *events):
+        """
+        Stop calling `callback` for events of type `events`
+        (or of any type if none are passed) at `path`.
+
+        Once nobody is spying on a path, we stop re-arming its
+        watches. ZooKeeper can't cancel a watch that is already
+        armed, so that one fires one last time, to no one.
+
+        Arguments:
+        - `path`: string - Path we were watching
+        - `callback`: callable
+        - `*events`: int - zoop.Event attributes
+
+        Return: None
+        Exceptions: None
+        """
+        with self._plock:
+            for registry in (self.callbacks, self.payload_callbacks):
+                if path not in registry:
+                    continue
+                subscribed = registry[path]
+                for e in list(events or subscribed.keys()):
+                    callbacks = subscribed.get(e, [])
+                    while callback in callbacks:
+                        callbacks.remove(callback)
+                    if not callbacks:
+                        subscribed.pop(e, None)
+                if not subscribed:
+                    del registry[path]
+        return
+
+
+class TreeWatch(object):
+    """
+    Watch every Node at or below a root for Created, Changed and
+    Deleted events.
+
+    We keep an index of the children of every Node in the
+    subtree, spy on each Node's data and children through our Watcher,
+    and work out what was created or deleted by comparing each new
+    listing with the index. Nodes that exist when we start are not
+    reported as Created.
+
+    If the root is deleted, we watch for it being created again, and
+    then report it and everything below it as Created.
+
+    >>> def cb(path, event):
+    ...     print path, event
+    >>> tw = zk.watch_tree('/config', cb)
+    >>> zk.create('/config/new')
+    /config/new 1
+    >>> tw.close()
+    """
+    def __init__(self, watcher, root, callback):
+        """
+        Store vars
+
+        Arguments:
+        - `watcher`: Watcher
+        - `root`: string - Path to watch
+        - `callback`: callable
+
+        Return: None
+        Exceptions: None
+        """
+        self.watcher = watcher
+        self.root = root
+        self.callback = callback
+        self.children = {}
+        self.closed = False
+        self._awaiting = False
+        self._quiet = set()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<zoop TreeWatch on {0}>".format(self.root)
+
+    def __contains__(self, path):
+        return path in self.children
+
+    def start(self):
+        """
+        Begin watching.
+
+        Return: None
+        Exceptions: None
+        """
+        self.watcher.spyon(self.root, self._root_deleted, enums.Event.Deleted)
+        self._add(self.root, True)
+        return
+
+    def close(self):
+        """
+        Stop watching.
+
+        Return: None
+        Exceptions: None
+        """
+        with self._lock:
+            self.closed = True
+            paths = list(self.children)
+            self.children.clear()
+        self.watcher.unspy(self.root, self._root_deleted)
+        for path in paths:
+            self.watcher.unspy(path, self._changed)
+            self.watcher.unspy(path, self._listed)
+        return
+
+    def _add(self, path, quiet):
+        """
+        Start indexing and spying on the Node at `path`.
+
+        Arguments:
+        - `path`: string
+        - `quiet`: bool - the Node was there when we started, so
+                          its children aren't news
+
+        Return: None
+        Exceptions: None
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.children[path] = None
+            if quiet:
+                self._quiet.add(path)
+        self.watcher.spyon(path, self._changed, enums.Event.Changed)
+        self.watcher.spyon(path, self._listed, enums.Event.Child,
+                           payload=True, initial=True)
+        return
+
+    def _drop(self, path):
+        """
+        Forget the Node at `path` and everything below it, deepest
+        first, reporting each as Deleted.
+
+        Arguments:
+        - `path`: string
 
-            def cb(h, t, s, p):
-                self.dispatch(h, t, s, p)
+        Return: None
+        Exceptions: None
+        """
+        with self._lock:
+            if path not in self.children:
                 return
+            order, stack = [], [path]
+            while stack:
+                path = stack.pop()
+                order.append(path)
+                self._quiet.discard(path)
+                kids = self.children.pop(path, None) or ()
+                stack.extend(join(path, name) for name in kids)
+        for path in reversed(order):
+            self.watcher.unspy(path, self._changed)
+            self.watcher.unspy(path, self._listed)
+            self.callback(path, enums.Event.Deleted)
+        return
+
+    def _changed(self, path, etype):
+        """
+        Watcher callback - a Node's data changed.
+        """
+        if not self.closed and path in self.children:
+            self.callback(path, etype)
+        return
 
-            print self._watch_funcs[e](self._zk, path, cb)
+    def _listed(self, path, etype, kids):
+        """
+        Payload watcher callback - compare the latest listing of `path`
+        with our index, dropping Nodes that have gone and adding the
+        new ones.
+
+        Arguments:
+        - `path`: string
+        - `etype`: Enum - Event type
+        - `kids`: list of strings, or None if `path` has gone
+
+        Return: None
+        Exceptions: None
+        """
+        if kids is None:
+            return # We'll hear about it from the parent's listing
+        kids = set(kids)
+        with self._lock:
+            if self.closed or path not in self.children:
+                return
+            known = self.children[path]
+            quiet = known is None and path in self._quiet
+            self._quiet.discard(path)
+            known = known or set()
+            self.children[path] = kids
+        for name in sorted(known - kids):
+            self._drop(join(path, name))
+        for name in sorted(kids - known):
+            child = join(path, name)
+            if not quiet:
+                self.callback(child, enums.Event.Created)
+            self._add(child, quiet)
+        return
+
+    def _root_deleted(self, path, etype):
+        """
+        Watcher callback - the root has gone, and so has everything.
+        Watch for it coming back.
+        """
+        self._drop(self.root)
+        with self._lock:
+            if self.closed or self._awaiting:
+                return
+            self._awaiting = True
+        zookeeper.aexists(self.watcher._zk, self.root, self._root_event,
+                          self._root_exists)
+        return
+
+    @result.completing
+    def _root_event(self, handle, etype, state, path):
+        """
+        Watcher for the root while it's gone. An exists watch is left
+        even on a Node that isn't there, and fires when it's created.
+        """
+        if etype == enums.Event.Created:
+            self.watcher._submit(self.root, self._root_created)
+        return
+
+    @result.completing
+    def _root_exists(self, handle, rc, stat):
+        """
+        Completion for our exists watch on the root - it may have come
+        back before we asked.
+        """
+        if rc == zookeeper.OK:
+            self.watcher._submit(self.root, self._root_created)
+        return
+
+    def _root_created(self):
+        """
+        The root is back - report it, and index and spy on it again,
+        reporting everything below it as Created too.
+
+        Return: None
+        Exceptions: None
+        """
+        with self._lock:
+            if self.closed or not self._awaiting:
+                return
+            self._awaiting = False
+        self.callback(self.root, enums.Event.Created)
+        self._add(self.root, False)
         return